@@ -0,0 +1,488 @@
+"""
+Benchmarks de RuruBot contra una Bot API simulada en el mismo proceso.
+
+Cada escenario se ejecuta en un subproceso con un PERSIST_DIR temporal y limpio,
+construye la Application real de bot.py (mismos handlers que en producción) y le
+inyecta Updates sintéticos con app.process_update(). Las llamadas a Telegram las
+responde StubRequest sin red.
+
+Uso:
+    python bench.py                         # todos los escenarios
+    python bench.py messages all_3000       # solo algunos
+    python bench.py --scale 0.1             # versión reducida (10 % de carga)
+    python bench.py --compare bench_results/20261019T080000.json
+    python bench.py --codec                 # codecs JSON con un roster de 50k miembros
+
+Los resultados se guardan en bench_results/<timestamp>.json.
+"""
+from typing import Any, Dict, List
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results")
+BOT_ID = 424242
+ADMIN_ID = 1
+
+
+def _read_proc(path: str) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                parts = value.split()
+                if parts and parts[0].isdigit():
+                    out[key.strip()] = int(parts[0])
+    except OSError:
+        pass
+    return out
+
+
+def _rss_kb() -> Dict[str, int]:
+    status = _read_proc("/proc/self/status")
+    if status:
+        return {"rss_kb": status.get("VmRSS", 0), "peak_rss_kb": status.get("VmHWM", 0)}
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {"rss_kb": peak, "peak_rss_kb": peak}
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def make_stub_request():
+    """Crea un BaseRequest que responde a la Bot API sin salir del proceso."""
+    from telegram.request import BaseRequest
+
+    class StubRequest(BaseRequest):
+        def __init__(self) -> None:
+            self.calls: Dict[str, int] = {}
+            self._next_id = 1000
+            self._polls = 0
+
+        @property
+        def read_timeout(self):
+            return None
+
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+        def _message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+            self._next_id += 1
+            chat_id = int(params.get("chat_id", 0) or 0)
+            return {
+                "message_id": int(params.get("message_id") or self._next_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "RuruBot", "username": "rurubot"},
+                "text": str(params.get("text") or params.get("question") or ""),
+            }
+
+        def _result(self, api: str, params: Dict[str, Any]) -> Any:
+            if api == "getMe":
+                return {"id": BOT_ID, "is_bot": True, "first_name": "RuruBot", "username": "rurubot"}
+            if api in ("getChatMember",):
+                uid = int(params.get("user_id", 0))
+                return {
+                    "status": "administrator" if uid == ADMIN_ID else "member",
+                    "user": {"id": uid, "is_bot": False, "first_name": f"u{uid}"},
+                    "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True,
+                    "can_delete_messages": True, "can_manage_video_chats": True, "can_restrict_members": True,
+                    "can_promote_members": False, "can_change_info": True, "can_invite_users": True,
+                    "can_post_stories": False, "can_edit_stories": False, "can_delete_stories": False,
+                } if uid == ADMIN_ID else {
+                    "status": "member",
+                    "user": {"id": uid, "is_bot": False, "first_name": f"u{uid}"},
+                }
+            if api == "getChatAdministrators":
+                return [{
+                    "status": "creator", "is_anonymous": False,
+                    "user": {"id": ADMIN_ID, "is_bot": False, "first_name": "admin"},
+                }]
+            if api == "getChat":
+                return {"id": int(params.get("chat_id", 0)), "type": "supergroup", "title": "bench",
+                        "accent_color_id": 0, "max_reaction_count": 11}
+            if api == "sendPoll":
+                self._polls += 1
+                msg = self._message(params)
+                options = params.get("options") or []
+                if isinstance(options, str):
+                    options = json.loads(options)
+                msg["poll"] = {
+                    "id": f"poll{self._polls}",
+                    "question": str(params.get("question", "")),
+                    "options": [{"text": o if isinstance(o, str) else o.get("text", ""), "voter_count": 0} for o in options],
+                    "total_voter_count": 0, "is_closed": False, "is_anonymous": False,
+                    "type": "quiz", "allows_multiple_answers": False,
+                }
+                return msg
+            if api in ("sendMessage", "editMessageText", "sendPhoto", "sendVideo", "sendDocument", "editMessageReplyMarkup", "editMessageCaption"):
+                return self._message(params)
+            if api == "stopPoll":
+                return {"id": "x", "question": "q", "options": [], "total_voter_count": 0, "is_closed": True,
+                        "is_anonymous": False, "type": "quiz", "allows_multiple_answers": False}
+            return True
+
+        async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+            api = url.rsplit("/", 1)[-1]
+            self.calls[api] = self.calls.get(api, 0) + 1
+            params = request_data.parameters if request_data is not None else {}
+            body = {"ok": True, "result": self._result(api, params)}
+            return 200, json.dumps(body).encode("utf-8")
+
+    return StubRequest()
+
+
+def _user(uid: int) -> Dict[str, Any]:
+    return {"id": uid, "is_bot": False, "first_name": f"Usuario{uid}", "username": f"user{uid}"}
+
+
+class Driver:
+    """Genera Updates sintéticos y mide el tiempo de cada app.process_update()."""
+
+    def __init__(self, bot_module, app, stub) -> None:
+        self.bot = bot_module
+        self.app = app
+        self.stub = stub
+        self.update_id = 0
+        self.message_id = 0
+        self.latencies: List[float] = []
+
+    def _next(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def message(self, chat_id: int, uid: int, text: str, reply_to: int | None = None) -> Dict[str, Any]:
+        self.message_id += 1
+        msg: Dict[str, Any] = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"chat {chat_id}"},
+            "from": _user(uid),
+            "text": text,
+        }
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if reply_to:
+            msg["reply_to_message"] = {
+                "message_id": self.message_id - 1, "date": int(time.time()),
+                "chat": msg["chat"], "from": _user(reply_to), "text": "hola",
+            }
+        return {"update_id": self._next(), "message": msg}
+
+    def callback(self, chat_id: int, message_id: int, uid: int, data: str) -> Dict[str, Any]:
+        return {
+            "update_id": self._next(),
+            "callback_query": {
+                "id": str(self.update_id), "from": _user(uid), "chat_instance": str(chat_id), "data": data,
+                "message": {
+                    "message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                    "from": {"id": BOT_ID, "is_bot": True, "first_name": "RuruBot"}, "text": "tablero",
+                },
+            },
+        }
+
+    def poll_answer(self, poll_id: str, uid: int, option: int) -> Dict[str, Any]:
+        return {"update_id": self._next(), "poll_answer": {"poll_id": poll_id, "user": _user(uid), "option_ids": [option]}}
+
+    async def feed(self, raw: Dict[str, Any]) -> None:
+        from telegram import Update
+        update = Update.de_json(raw, self.app.bot)
+        started = time.perf_counter()
+        await self.app.process_update(update)
+        self.latencies.append(time.perf_counter() - started)
+
+    async def feed_many(self, raws: List[Dict[str, Any]]) -> None:
+        await asyncio.gather(*(self.feed(r) for r in raws))
+
+
+async def scenario_messages(d: Driver, scale: float) -> Dict[str, Any]:
+    """10k mensajes de texto repartidos en 200 chats."""
+    total, chats, users = int(10000 * scale), max(1, int(200 * scale)), 50
+    rnd = random.Random(1)
+    for i in range(total):
+        chat = -100000 - rnd.randrange(chats)
+        await d.feed(d.message(chat, 10 + rnd.randrange(users), f"mensaje {i}"))
+    return {"updates": total}
+
+
+async def scenario_all_3000(d: Driver, scale: float) -> Dict[str, Any]:
+    """@all en un chat con 3.000 miembros (sin confirmación; sin las pausas entre bloques)."""
+    members = int(3000 * scale)
+    chat = -200000
+    now = time.time()
+    d.bot.save_roster({str(chat): {
+        str(1000 + i): {"first": f"U{i}", "username": f"user{i}", "name": f"U{i}", "is_bot": False,
+                        "last_ts": now, "messages": 1}
+        for i in range(members)
+    }})
+    d.bot.set_chat_setting(chat, "all_confirm", False)
+    real_sleep = asyncio.sleep
+    async def no_sleep(delay, result=None):
+        return await real_sleep(0, result)
+    asyncio.sleep = no_sleep
+    try:
+        await d.feed(d.message(chat, ADMIN_ID, "@all prueba de carga"))
+        await asyncio.gather(*d.bot.ALL_TASKS.values())
+    finally:
+        asyncio.sleep = real_sleep
+    return {"updates": 1, "members": members}
+
+
+async def scenario_trivia_500(d: Driver, scale: float) -> Dict[str, Any]:
+    """Una ronda de trivia con 500 respuestas (la última es la correcta)."""
+    answers = int(500 * scale)
+    chat = -300000
+    d.bot.set_chat_setting(chat, "trivia_enabled", True)
+    await d.feed(d.message(chat, ADMIN_ID, "/trivia_start"))
+    state = d.bot.load_trivia_state()
+    poll_id, info = next((k, v) for k, v in state.items() if isinstance(v, dict) and v.get("chat_id") == chat)
+    correct = info["question_snapshot"]["answer"]
+    wrong = (correct + 1) % len(info["question_snapshot"]["choices"])
+    for i in range(answers):
+        option = correct if i == answers - 1 else wrong
+        await d.feed(d.poll_answer(poll_id, 5000 + i, option))
+    return {"updates": answers + 1}
+
+
+async def scenario_ttt_100(d: Driver, scale: float) -> Dict[str, Any]:
+    """100 partidas de tres en raya simultáneas, una jugada por partida en cada ronda."""
+    games = max(1, int(100 * scale))
+    rnd = random.Random(2)
+    boards = []
+    for g in range(games):
+        chat = -400000 - g
+        await d.feed(d.message(chat, 20 + g * 2, "/ttt", reply_to=21 + g * 2))
+        msg_id = max(d.bot.TTT_GAMES[chat])
+        boards.append((chat, msg_id))
+    updates = games
+    while True:
+        batch = []
+        for chat, msg_id in boards:
+            state = d.bot.TTT_GAMES.get(chat, {}).get(msg_id)
+            if not state or state["status"] != "playing":
+                continue
+            free = [i for i in range(9) if not (state["x"] | state["o"]) >> i & 1]
+            uid = state["players"][f"{state['turn']}_id"]
+            batch.append(d.callback(chat, msg_id, uid, d.bot.cb_encode("ttt", "play", rnd.choice(free))))
+        if not batch:
+            break
+        updates += len(batch)
+        await d.feed_many(batch)
+    return {"updates": updates, "games": games}
+
+
+async def _sharded_messages(d: Driver, scale: float, shards: int) -> Dict[str, Any]:
+    """
+    Modo multiproceso: lanza `shards` workers (bot.run_worker con la API simulada) y les reparte
+    por stdin 20k mensajes de 200 chats igual que el proceso frontal. Se mide desde el primer
+    update hasta que todos los workers han terminado de procesar.
+    """
+    total, chats, users = int(20000 * scale), max(1, int(200 * scale)), 50
+    env = dict(os.environ, SHARDS=str(shards))
+    workers = []
+    for i in range(shards):
+        w = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--shard-worker", "--scale", "1",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, env=dict(env, SHARD_INDEX=str(i)),
+        )
+        await w.stdout.readline()
+        workers.append(w)
+    rnd = random.Random(1)
+    lines: List[List[bytes]] = [[] for _ in range(shards)]
+    for i in range(total):
+        chat = -100000 - rnd.randrange(chats)
+        raw = d.message(chat, 10 + rnd.randrange(users), f"mensaje {i}")
+        lines[chat % shards].append(json.dumps(raw).encode("utf-8") + b"\n")  # == bot.shard_of con SHARDS=shards
+    started = time.perf_counter()
+    async def feed(w, batch):
+        for line in batch:
+            w.stdin.write(line)
+            await w.stdin.drain()
+        w.stdin.close()
+        await w.wait()
+    await asyncio.gather(*(feed(w, lines[i]) for i, w in enumerate(workers)))
+    return {"updates": total, "shards": shards, "elapsed": time.perf_counter() - started}
+
+
+async def scenario_shards_1(d: Driver, scale: float) -> Dict[str, Any]:
+    return await _sharded_messages(d, scale, 1)
+
+
+async def scenario_shards_4(d: Driver, scale: float) -> Dict[str, Any]:
+    return await _sharded_messages(d, scale, 4)
+
+
+SCENARIOS = {
+    "messages": scenario_messages,
+    "all_3000": scenario_all_3000,
+    "trivia_500": scenario_trivia_500,
+    "ttt_100": scenario_ttt_100,
+    "shards_1": scenario_shards_1,
+    "shards_4": scenario_shards_4,
+}
+
+
+async def _run_scenario(name: str, scale: float) -> Dict[str, Any]:
+    import bot
+    bot._ensure_trivia_files()
+    stub = make_stub_request()
+    app = bot.build_application("123456:BENCH", request=stub, get_updates_request=make_stub_request())
+    await app.initialize()
+    io_before = _read_proc("/proc/self/io")
+    flush_before = sum(v for (n, _), v in bot.METRIC_COUNTERS.items() if n == "rurubot_flush_bytes_total")
+    d = Driver(bot, app, stub)
+    started = time.perf_counter()
+    extra = await SCENARIOS[name](d, scale)
+    elapsed = extra.pop("elapsed", None) or time.perf_counter() - started
+    await app.shutdown()
+    bot.writer_flush()
+    io_after = _read_proc("/proc/self/io")
+    flush_after = sum(v for (n, _), v in bot.METRIC_COUNTERS.items() if n == "rurubot_flush_bytes_total")
+    result = {
+        "scenario": name,
+        "scale": scale,
+        "seconds": round(elapsed, 4),
+        "updates_per_sec": round(extra.get("updates", 0) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(_percentile(d.latencies, 50) * 1000, 3),
+        "p99_ms": round(_percentile(d.latencies, 99) * 1000, 3),
+        "max_ms": round(max(d.latencies, default=0.0) * 1000, 3),
+        "flush_bytes": int(flush_after - flush_before),
+        "write_bytes": io_after.get("wchar", 0) - io_before.get("wchar", 0),
+        "api_calls": dict(sorted(stub.calls.items())),
+    }
+    result.update(extra)
+    result.update(_rss_kb())
+    return result
+
+
+def _codec_roster(members: int) -> Dict[str, Any]:
+    """Roster sintético de un chat con `members` miembros, con la forma de los registros reales."""
+    rnd = random.Random(7)
+    now = int(time.time())
+    chat = {}
+    for i in range(members):
+        uid = 10_000_000 + i
+        chat[str(uid)] = {
+            "name": f"Usuario {i} ñandú",
+            "username": f"user{i}" if i % 3 else None,
+            "is_bot": False,
+            "last_ts": now - rnd.randrange(90 * 86400),
+            "act": [rnd.randrange(20) if rnd.random() < 0.3 else 0 for _ in range(30)],
+            "act_day": now // 86400,
+        }
+    return {"-1001234567890": chat}
+
+
+def run_codec_bench(members: int, repeat: int = 3) -> List[Dict[str, Any]]:
+    """Compara tiempo de codificación/decodificación y bytes del roster con cada backend de bot.json_dumps."""
+    import bot
+    data = _codec_roster(members)
+    backends = [
+        ("json_indent", lambda d: json.dumps(d, ensure_ascii=False, indent=2).encode("utf-8"), json.loads),
+        ("json", None, None),
+    ]
+    if bot.orjson is not None:
+        backends.append(("orjson", None, None))
+    rows = []
+    for name, dumps, loads in backends:
+        if dumps is None:
+            bot.JSON_BACKEND = name
+            dumps, loads = bot.json_dumps, bot.json_loads
+        enc = dec = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            raw = dumps(data)
+            enc = min(enc, time.perf_counter() - started)
+            started = time.perf_counter()
+            back = loads(raw)
+            dec = min(dec, time.perf_counter() - started)
+        assert back == data
+        rows.append({"backend": name, "members": members, "encode_ms": round(enc * 1000, 1), "decode_ms": round(dec * 1000, 1), "bytes": len(raw)})
+    return rows
+
+
+def _print_table(results: List[Dict[str, Any]], previous: Dict[str, Dict[str, Any]]) -> None:
+    cols = ("updates_per_sec", "p50_ms", "p99_ms", "flush_bytes", "peak_rss_kb")
+    print(f"{'escenario':<12} " + " ".join(f"{c:>16}" for c in cols))
+    for r in results:
+        row = []
+        for c in cols:
+            cell = f"{r.get(c, 0):g}"
+            old = previous.get(r["scenario"], {}).get(c)
+            if old:
+                cell += f" ({(r.get(c, 0) - old) / old * 100:+.0f}%)"
+            row.append(f"{cell:>16}")
+        print(f"{r['scenario']:<12} " + " ".join(row))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks de RuruBot con Bot API simulada.")
+    parser.add_argument("scenarios", nargs="*", help=f"escenarios a ejecutar ({', '.join(SCENARIOS)})")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplicador de carga (por defecto 1.0)")
+    parser.add_argument("--compare", help="fichero de resultados anterior con el que comparar")
+    parser.add_argument("--out", default=RESULTS_DIR, help="directorio donde guardar los resultados")
+    parser.add_argument("--codec", action="store_true", help="compara los codecs JSON con un roster de 50k miembros (× --scale)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--shard-worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.shard_worker:
+        import bot
+        asyncio.run(bot.run_worker("123456:BENCH", request=make_stub_request(), get_updates_request=make_stub_request()))
+        return
+    if args.child:
+        print(json.dumps(asyncio.run(_run_scenario(args.child, args.scale))))
+        return
+    if args.codec:
+        rows = run_codec_bench(max(1, int(50_000 * args.scale)))
+        print(f"{'backend':<12} {'encode_ms':>10} {'decode_ms':>10} {'bytes':>12}")
+        for r in rows:
+            print(f"{r['backend']:<12} {r['encode_ms']:>10g} {r['decode_ms']:>10g} {r['bytes']:>12}")
+        return
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"escenario desconocido: {', '.join(unknown)}")
+    results = []
+    for name in names:
+        with tempfile.TemporaryDirectory(prefix="rurubench_") as tmp:
+            env = dict(os.environ, PERSIST_DIR=tmp, METRICS_PORT="0", LIST_URL="")
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", name, "--scale", str(args.scale)],
+                env=env, capture_output=True, text=True,
+            )
+        if proc.returncode != 0:
+            print(proc.stderr[-2000:], file=sys.stderr)
+            raise SystemExit(f"El escenario {name} ha fallado.")
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        print(f"✓ {name}: {results[-1]['seconds']} s", file=sys.stderr)
+    previous: Dict[str, Dict[str, Any]] = {}
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = {r["scenario"]: r for r in json.load(f).get("results", [])}
+    _print_table(results, previous)
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, time.strftime("%Y%m%dT%H%M%S") + ".json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"created": time.time(), "python": sys.version.split()[0], "results": results}, f, indent=2)
+    print(f"Resultados guardados en {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ChatType
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -15,22 +16,62 @@ from telegram.ext import (
 from typing import List, Dict, Any
 from zoneinfo import ZoneInfo
 import asyncio
+import atexit
+import base64
+import codecs
+import collections
+import contextlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+import cProfile
 import country_converter as coco
+import functools
+import gzip
+import hashlib
+import heapq
 import html
+import httpx
+import io
 import json
 import logging
 import os
+import pstats
 import pytz
 import random
 import re
 import requests
+import socket
+import sys
+import threading
 import time
+import traceback
 import unicodedata
 
 TOKEN = os.getenv("TOKEN")
 PERSIST_DIR = os.environ.get("PERSIST_DIR", "/data").strip() or "."
-ROSTER_FILE = os.path.join(PERSIST_DIR, "roster.json")
-SETTINGS_FILE = os.path.join(PERSIST_DIR, "settings.json")
+SHARDS = max(1, int(os.environ.get("SHARDS", "1") or 1))
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", "-1") or -1)
+SHARD_DIR = os.path.join(PERSIST_DIR, "shards", str(SHARD_INDEX)) if SHARD_INDEX >= 0 else PERSIST_DIR
+ROSTER_FILE = os.path.join(SHARD_DIR, "roster.json")
+SETTINGS_FILE = os.path.join(SHARD_DIR, "settings.json")
+GAMES_DIR = os.path.join(SHARD_DIR, "games")
+GAME_SNAPSHOT_TTL = 7 * 86400
+ACTIVITY_DAYS = 30
+ALL_JOBS_FILE = os.path.join(SHARD_DIR, "all_jobs.json")
+ALL_MAX_CHARS = 4096
+ALL_MAX_ENTITIES = 100
+ALL_PROGRESS_EVERY = 2.0
+ALL_BLOCK_RETRIES = 3
+ALL_JOBS: Dict[str, Dict[str, Any]] | None = None
+ALL_TASKS: Dict[int, asyncio.Task] = {}
+ROSTER_VERSIONS: Dict[str, int] = {}
+MENTION_CACHE: Dict[str, Dict[str, Any]] = {}
 LIST_URL = os.environ.get("LIST_URL", "")
 LIST_IMPORT_ONCE = os.environ.get("LIST_IMPORT_ONCE", "true").lower() in {"1", "true", "yes", "y"}
 LIST_IMPORT_MODE = os.environ.get("LIST_IMPORT_MODE", "merge").lower()
@@ -39,50 +80,435 @@ AUTO_RESPONDERS: Dict[int, Dict[int, str]] = {}
 _last_all: Dict[int, float] = {}
 _admin_last: Dict[int, float] = {}
 COMMANDS: Dict[str, Dict[str, Any]] = {}
+CALLBACKS: Dict[str, Any] = {}
+CALLBACK_ARITY: Dict[str, tuple[int, int]] = {}
+CB_PREFIX = "~"
+CB_VERSION = 1
+CB_ROUTE_IDS: Dict[str, int] = {
+    "ttt": 1,
+    "ppt": 2,
+    "allconfirm": 3,
+    "adminconfirm": 4,
+    "triviaimport": 5,
+    "cfg": 6,
+    "hub": 7,
+    "alljob": 8,
+}
+CB_ROUTE_NAMES: Dict[int, str] = {v: k for k, v in CB_ROUTE_IDS.items()}
 TTT_GAMES: Dict[int, Dict[int, Dict[str, Any]]] = {}
 TTT_EMPTY = "·"
 TTT_X = "❌"
 TTT_O = "⭕"
 logging.basicConfig(level=logging.INFO)
 SETTINGS_CACHE: Dict[str, Any] | None = None
+TRIVIA_ENABLED_CHATS: set[int] | None = None
 ROSTER_CACHE: Dict[str, Any] | None = None
-def load_settings() -> Dict[str, Any]:
-    global SETTINGS_CACHE
-    if SETTINGS_CACHE is not None:
-        return dict(SETTINGS_CACHE)
-    if os.path.exists(SETTINGS_FILE):
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0") or 0)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_HELP: Dict[str, tuple[str, str]] = {
+    "rurubot_handler_seconds": ("histogram", "Latencia de los handlers por callback."),
+    "rurubot_handler_errors_total": ("counter", "Excepciones lanzadas por los handlers."),
+    "rurubot_telegram_requests_total": ("counter", "Llamadas a la Bot API por método y código HTTP."),
+    "rurubot_telegram_request_seconds": ("histogram", "Latencia de las llamadas a la Bot API."),
+    "rurubot_telegram_retry_after_total": ("counter", "Respuestas 429 (RetryAfter) de la Bot API."),
+    "rurubot_flush_seconds": ("histogram", "Tiempo de escritura de ficheros persistentes."),
+    "rurubot_flush_bytes_total": ("counter", "Bytes escritos en ficheros persistentes."),
+    "rurubot_loop_lag_seconds": ("histogram", "Retraso del bucle de eventos medido por el latido."),
+    "rurubot_loop_stalls_total": ("counter", "Bloqueos del bucle por encima de STALL_THRESHOLD."),
+    "rurubot_writer_superseded_total": ("counter", "Escrituras descartadas por una más reciente del mismo fichero."),
+    "rurubot_writer_errors_total": ("counter", "Escrituras a disco fallidas en el hilo escritor."),
+}
+OWNER_IDS = {int(x) for x in re.split(r"[\s,]+", os.environ.get("OWNER_IDS", "")) if x.isdigit()}
+PROFILE_SLOW_CALLBACK = float(os.environ.get("PROFILE_SLOW_CALLBACK", "0.1") or 0.1)
+_profile_task: asyncio.Task | None = None
+STALL_THRESHOLD = float(os.environ.get("STALL_THRESHOLD", "0.5") or 0)
+STALL_STACK_DEPTH = 25
+LOOP_LAG_INTERVAL = 0.1
+_LOOP_WATCH: Dict[str, Any] = {"beat": 0.0, "stop": None}
+_HANDLER_RUNNING: Dict[Any, tuple[str, str]] = {}
+METRIC_COUNTERS: Dict[tuple, float] = {}
+METRIC_HISTOGRAMS: Dict[tuple, list] = {}
+_metrics_lock = threading.Lock()
+def metric_inc(name: str, labels: tuple = (), value: float = 1.0) -> None:
+    key = (name, labels)
+    with _metrics_lock:
+        METRIC_COUNTERS[key] = METRIC_COUNTERS.get(key, 0.0) + value
+def metric_observe(name: str, labels: tuple, value: float) -> None:
+    """Registra una observación en un histograma: [cubetas..., suma, total]."""
+    key = (name, labels)
+    with _metrics_lock:
+        h = METRIC_HISTOGRAMS.get(key)
+        if h is None:
+            h = METRIC_HISTOGRAMS[key] = [0] * len(METRIC_BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if value <= bound:
+                h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+def observe_flush(path: str, started: float, nbytes: int) -> None:
+    labels = (("file", os.path.basename(path)),)
+    metric_observe("rurubot_flush_seconds", labels, time.perf_counter() - started)
+    metric_inc("rurubot_flush_bytes_total", labels, nbytes)
+JSON_BACKEND = (os.environ.get("JSON_BACKEND") or ("orjson" if orjson else "json")).lower()
+if JSON_BACKEND == "orjson" and orjson is None:
+    JSON_BACKEND = "json"
+def json_dumps(data: Any) -> bytes:
+    """
+    Codec de persistencia: JSON compacto en UTF-8. Con orjson instalado (JSON_BACKEND=orjson, por
+    defecto si está disponible) se usa su codificador; si no puede con algún valor, cae en json.
+    """
+    if JSON_BACKEND == "orjson":
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+def json_loads(raw: bytes | str) -> Any:
+    """Inversa de json_dumps; lee también los ficheros antiguos (indentados, o con NaN de json)."""
+    if JSON_BACKEND == "orjson":
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw)
+def json_read(path: str) -> Any:
+    with open(path, "rb") as f:
+        return json_loads(f.read())
+WRITER_PENDING: Dict[str, tuple] = {}
+WRITER_ERRORS: Dict[str, str] = {}
+_writer_order: collections.deque = collections.deque()
+_writer_queued: set = set()
+_writer_cond = threading.Condition()
+_writer_thread: threading.Thread | None = None
+def _write_file_atomic(path: str, payload: bytes | None, label: str | None = None) -> None:
+    if payload is None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+    started = time.perf_counter()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        nbytes = f.tell()
+    os.replace(tmp, path)
+    observe_flush(label or path, started, nbytes)
+def _writer_loop() -> None:
+    while True:
+        with _writer_cond:
+            while not _writer_order:
+                _writer_cond.wait()
+            path = _writer_order.popleft()
+            _writer_queued.discard(path)
+            job = WRITER_PENDING[path]
+        try:
+            payload, label = job
+            if payload is not None and not isinstance(payload, bytes):
+                payload = json_dumps(payload)
+            _write_file_atomic(path, payload, label)
+            WRITER_ERRORS.pop(path, None)
+        except Exception as e:
+            logging.exception("❌ Error escribiendo en disco: %s", path)
+            WRITER_ERRORS[path] = f"{type(e).__name__}: {e}"
+            metric_inc("rurubot_writer_errors_total", (("file", os.path.basename(path)),))
+        with _writer_cond:
+            if WRITER_PENDING.get(path) is job:
+                del WRITER_PENDING[path]
+            _writer_cond.notify_all()
+def _writer_submit(path: str, payload: Any, label: str | None) -> None:
+    global _writer_thread
+    with _writer_cond:
+        if path in _writer_queued:
+            metric_inc("rurubot_writer_superseded_total")
+        else:
+            _writer_queued.add(path)
+            _writer_order.append(path)
+        WRITER_PENDING[path] = (payload, label)
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_writer_loop, name="persist-writer", daemon=True)
+            _writer_thread.start()
+        _writer_cond.notify_all()
+def persist_json(path: str, data: Any, label: str | None = None, mutable: bool = False) -> None:
+    """
+    Encola la escritura de `data` en `path` para el hilo escritor y vuelve enseguida; si ya había una
+    escritura pendiente para el mismo fichero, la nueva la sustituye. Por defecto se encola el objeto y
+    el hilo lo serializa, así que `data` debe ser una instantánea que nadie vuelva a modificar (settings,
+    roster). Con mutable=True el llamador sigue modificándolo y se serializa aquí.
+    """
+    _writer_submit(path, json_dumps(data) if mutable else data, label)
+def persist_delete(path: str, label: str | None = None) -> None:
+    _writer_submit(path, None, label)
+def persist_pending(path: str) -> tuple | None:
+    """
+    Devuelve (payload, label) si hay una escritura pendiente para `path`; payload None = borrado,
+    bytes = JSON ya serializado, otro valor = la instantánea encolada tal cual.
+    """
+    with _writer_cond:
+        return WRITER_PENDING.get(path)
+def writer_flush(path: str | None = None, timeout: float = 30.0) -> bool:
+    """Espera a que se escriban las escrituras pendientes (todas o las de `path`)."""
+    deadline = time.monotonic() + timeout
+    with _writer_cond:
+        while (path in WRITER_PENDING) if path else WRITER_PENDING:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                logging.error("❌ Quedan %d escrituras pendientes sin volcar", len(WRITER_PENDING))
+                return False
+            _writer_cond.wait(left)
+    return True
+atexit.register(writer_flush)
+_FILE_LOCKS: Dict[str, Dict[str, Any]] = {}
+_file_locks_guard = threading.Lock()
+@contextlib.contextmanager
+def file_lock(path: str):
+    """
+    Exclusión sobre un fichero compartido por todos los shards (journal del pool, log de auditoría,
+    backups): RLock entre hilos y flock exclusivo sobre path + ".lock" entre procesos. Es reentrante
+    en el mismo hilo, así que una función que ya lo tiene puede llamar a otra que también lo pide.
+    """
+    with _file_locks_guard:
+        lock = _FILE_LOCKS.setdefault(path, {"rlock": threading.RLock(), "f": None, "depth": 0})
+    with lock["rlock"]:
+        if lock["depth"] == 0 and fcntl is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            f = open(path + ".lock", "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            except Exception:
+                f.close()
+                raise
+            lock["f"] = f
+        lock["depth"] += 1
         try:
-            with open(SETTINGS_FILE, "r", encoding="utf-8") as f:
-                SETTINGS_CACHE = json.load(f)
-                if not isinstance(SETTINGS_CACHE, dict):
-                    SETTINGS_CACHE = {}
-                return dict(SETTINGS_CACHE)
+            yield
+        finally:
+            lock["depth"] -= 1
+            if lock["depth"] == 0 and lock["f"] is not None:
+                f, lock["f"] = lock["f"], None
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+def _metric_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"')
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+def render_metrics() -> str:
+    """Exposición de las métricas en formato de texto de Prometheus."""
+    with _metrics_lock:
+        counters = sorted(METRIC_COUNTERS.items())
+        histograms = sorted((k, list(v)) for k, v in METRIC_HISTOGRAMS.items())
+    out: list[str] = []
+    seen: set[str] = set()
+    def header(name: str) -> None:
+        if name not in seen:
+            seen.add(name)
+            kind, text = METRIC_HELP.get(name, ("untyped", ""))
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+    for (name, labels), value in counters:
+        header(name)
+        out.append(f"{name}{_metric_labels(labels)} {value:g}")
+    for (name, labels), h in histograms:
+        header(name)
+        for i, bound in enumerate(METRIC_BUCKETS):
+            out.append(f"{name}_bucket{_metric_labels(labels + (('le', f'{bound:g}'),))} {h[i]}")
+        out.append(f"{name}_bucket{_metric_labels(labels + (('le', '+Inf'),))} {h[-1]}")
+        out.append(f"{name}_sum{_metric_labels(labels)} {h[-2]:.6f}")
+        out.append(f"{name}_count{_metric_labels(labels)} {h[-1]}")
+    return "\n".join(out) + "\n"
+def shard_of(chat_id: int) -> int:
+    return chat_id % SHARDS
+def _shard_filter(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Se queda con las entradas de los chats de este shard (claves de chat, "chat_id" o subdiccionarios por chat)."""
+    out: Dict[str, Any] = {}
+    for k, v in data.items():
+        if isinstance(v, dict) and isinstance(v.get("chat_id"), int):
+            if shard_of(v["chat_id"]) == SHARD_INDEX:
+                out[k] = v
+        elif k.lstrip("-").isdigit():
+            if shard_of(int(k)) == SHARD_INDEX:
+                out[k] = v
+        elif isinstance(v, dict):
+            out[k] = _shard_filter(v)
+        else:
+            out[k] = v
+    return out
+def _shard_legacy(path: str):
+    """
+    En un worker de shard sin fichero propio todavía, parte del fichero común de PERSIST_DIR
+    filtrado a sus chats (migración desde el modo de un solo proceso). Devuelve None si no aplica.
+    """
+    if SHARD_INDEX < 0 or os.path.exists(path):
+        return None
+    legacy = os.path.join(PERSIST_DIR, os.path.basename(path))
+    try:
+        data = json_read(legacy)
+    except (OSError, ValueError):
+        return None
+    return _shard_filter(data) if isinstance(data, dict) else None
+def _load_json_dict(path: str) -> Dict[str, Any]:
+    pending = persist_pending(path)
+    if pending is not None and pending[0] is not None:
+        data = json_loads(pending[0]) if isinstance(pending[0], bytes) else pending[0]
+        if isinstance(data, dict):
+            return data
+    legacy = _shard_legacy(path)
+    if legacy is not None:
+        return legacy
+    if os.path.exists(path):
+        try:
+            data = json_read(path)
+            if isinstance(data, dict):
+                return data
         except Exception:
-            SETTINGS_CACHE = {}
-            return {}
-    SETTINGS_CACHE = {}
+            pass
     return {}
+def load_settings() -> Dict[str, Any]:
+    """
+    Devuelve la instantánea actual de settings sin copiarla. Es de solo lectura: para cambiarla
+    se construye un dict nuevo (save_settings_entry copia solo el nivel superior y la entrada tocada).
+    """
+    global SETTINGS_CACHE
+    if SETTINGS_CACHE is None:
+        SETTINGS_CACHE = _load_json_dict(SETTINGS_FILE)
+    return SETTINGS_CACHE
 def save_settings(s: Dict[str, Any]) -> None:
+    """Persiste `s` y, solo si se ha podido encolar, lo publica como nueva instantánea."""
     global SETTINGS_CACHE
     try:
-        os.makedirs(os.path.dirname(SETTINGS_FILE) or ".", exist_ok=True)
-        with open(SETTINGS_FILE, "w", encoding="utf-8") as f:
-            json.dump(s, f, ensure_ascii=False, indent=2)
-        SETTINGS_CACHE = dict(s)
+        persist_json(SETTINGS_FILE, s)
     except Exception as e:
         logging.exception("No se pudo guardar settings", exc_info=e)
+        return
+    SETTINGS_CACHE = s
+def save_settings_entry(key: str, value: Any) -> None:
+    s = dict(load_settings())
+    s[key] = value
+    save_settings(s)
 def get_chat_settings(cid: int) -> Dict[str, Any]:
-    s = load_settings()
-    return s.get(str(cid), {})
+    return load_settings().get(str(cid), {})
 def set_chat_setting(cid: int, key: str, value: Any) -> None:
-    s = load_settings()
-    ckey = str(cid)
-    if ckey not in s:
-        s[ckey] = {}
-    s[ckey][key] = value
-    save_settings(s)
+    chat = dict(get_chat_settings(cid))
+    chat[key] = value
+    save_settings_entry(str(cid), chat)
+    if key == "trivia_enabled" and TRIVIA_ENABLED_CHATS is not None:
+        if is_module_enabled(cid, key):
+            TRIVIA_ENABLED_CHATS.add(cid)
+        else:
+            TRIVIA_ENABLED_CHATS.discard(cid)
+def trivia_enabled_chats() -> set[int]:
+    """Índice de chats con la trivia activada; se construye una vez desde settings y lo mantiene set_chat_setting."""
+    global TRIVIA_ENABLED_CHATS
+    if TRIVIA_ENABLED_CHATS is None:
+        out = set()
+        for k, cfg in load_settings().items():
+            if isinstance(cfg, dict) and cfg.get("trivia_enabled", DEFAULTS["trivia_enabled"]):
+                try:
+                    out.add(int(k))
+                except ValueError:
+                    continue
+        TRIVIA_ENABLED_CHATS = out
+    return TRIVIA_ENABLED_CHATS
 def register_command(name: str, desc: str, admin: bool = False) -> None:
     COMMANDS[name] = {"desc": desc, "admin": admin}
+def register_callback(route: str, handler, nargs: tuple[int, int] = (1, 1)) -> None:
+    """Registra el handler de una ruta; nargs es el (mínimo, máximo) de argumentos que admite."""
+    CALLBACKS[route] = handler
+    CALLBACK_ARITY[route] = nargs
+def _cb_put_varint(n: int, out: bytearray) -> None:
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+def cb_encode(route: str, *args: int | str) -> str:
+    """
+    Codifica un callback_data compacto: "~" + base64url(versión, ruta, valores).
+    Cada valor es un varint con etiqueta en los 2 bits bajos: 0 entero >= 0, 1 entero < 0, 2 texto.
+    """
+    out = bytearray((CB_VERSION, CB_ROUTE_IDS[route]))
+    for v in args:
+        if isinstance(v, str):
+            raw = v.encode("utf-8")
+            _cb_put_varint((len(raw) << 2) | 2, out)
+            out += raw
+        elif v < 0:
+            _cb_put_varint((-v << 2) | 1, out)
+        else:
+            _cb_put_varint(v << 2, out)
+    data = CB_PREFIX + base64.urlsafe_b64encode(bytes(out)).rstrip(b"=").decode("ascii")
+    if len(data) > 64:
+        raise ValueError(f"callback_data demasiado largo para {route}: {len(data)} bytes")
+    return data
+def _cb_decode_legacy(data: str) -> tuple[str, list] | None:
+    """Traduce los callback_data en texto plano de teclados enviados antes del codec."""
+    parts = data.split(":")
+    route = parts[0]
+    try:
+        if route == "ttt" and len(parts) >= 4:
+            return route, [parts[1]] + [int(p) for p in parts[4:5]]
+        if route == "ppt" and len(parts) >= 4:
+            return route, [parts[1]] + parts[4:5]
+        if route in ("allconfirm", "adminconfirm") and len(parts) == 4:
+            return route, [parts[2], int(parts[3])]
+        if route == "triviaimport" and len(parts) == 5:
+            return route, [parts[2], parts[3], int(parts[4])]
+        if route in ("cfg", "hub") and len(parts) >= 2:
+            return route, parts[1:]
+    except ValueError:
+        return None
+    return None
+def cb_decode(data: str) -> tuple[str, list] | None:
+    """Devuelve (ruta, argumentos) o None si el callback_data no es válido."""
+    if not data.startswith(CB_PREFIX):
+        return _cb_decode_legacy(data)
+    body = data[len(CB_PREFIX):]
+    try:
+        raw = base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))
+    except ValueError:
+        return None
+    if len(raw) < 2 or raw[0] != CB_VERSION or raw[1] not in CB_ROUTE_NAMES:
+        return None
+    args: list = []
+    pos, end = 2, len(raw)
+    while pos < end:
+        n = shift = 0
+        while True:
+            if pos >= end:
+                return None
+            b = raw[pos]
+            pos += 1
+            n |= (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        tag, val = n & 3, n >> 2
+        if tag == 0:
+            args.append(val)
+        elif tag == 1:
+            args.append(-val)
+        elif tag == 2 and pos + val <= end:
+            args.append(raw[pos:pos + val].decode("utf-8", errors="replace"))
+            pos += val
+        else:
+            return None
+    return CB_ROUTE_NAMES[raw[1]], args
+async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Punto único de entrada de callbacks: decodifica una vez y despacha según la ruta."""
+    q = update.callback_query
+    decoded = cb_decode(q.data or "")
+    handler = CALLBACKS.get(decoded[0]) if decoded else None
+    if handler is None:
+        return await safe_q_answer(q)
+    lo, hi = CALLBACK_ARITY.get(decoded[0], (0, 0))
+    if not lo <= len(decoded[1]) <= hi:
+        return await safe_q_answer(q, txt_cb_expired(), show_alert=True)
+    return await handler(update, context, *decoded[1])
 def format_commands_list_botfather() -> str:
     lines = []
     for name in sorted(COMMANDS.keys()):
@@ -127,30 +553,39 @@ def is_module_enabled(chat_id: int, key: str) -> bool:
     cfg = _with_defaults(get_chat_settings(chat_id))
     return bool(cfg.get(key, DEFAULTS.get(key, False)))
 def load_roster() -> dict:
+    """Instantánea de solo lectura del roster (ver load_settings)."""
     global ROSTER_CACHE
-    if ROSTER_CACHE is not None:
-        return dict(ROSTER_CACHE)
-    if os.path.exists(ROSTER_FILE):
-        try:
-            with open(ROSTER_FILE, "r", encoding="utf-8") as f:
-                ROSTER_CACHE = json.load(f)
-                if not isinstance(ROSTER_CACHE, dict):
-                    ROSTER_CACHE = {}
-                return dict(ROSTER_CACHE)
-        except Exception:
-            ROSTER_CACHE = {}
-            return {}
-    ROSTER_CACHE = {}
-    return {}
+    if ROSTER_CACHE is None:
+        ROSTER_CACHE = _load_json_dict(ROSTER_FILE)
+    return ROSTER_CACHE
 def save_roster(roster: dict) -> None:
     global ROSTER_CACHE
     try:
-        os.makedirs(os.path.dirname(ROSTER_FILE) or ".", exist_ok=True)
-        with open(ROSTER_FILE, "w", encoding="utf-8") as f:
-            json.dump(roster, f, ensure_ascii=False, indent=2)
-        ROSTER_CACHE = dict(roster)
+        persist_json(ROSTER_FILE, roster)
     except Exception as e:
         logging.exception("No se pudo guardar roster", exc_info=e)
+        return
+    ROSTER_CACHE = roster
+    MENTION_CACHE.clear()
+def save_chat_roster(chat_id: int, chat_data: dict, members_changed: bool = True) -> None:
+    """
+    Sustituye el roster de un chat; el resto de chats se comparten con la instantánea anterior.
+    Con members_changed (altas, bajas o cambios de nombre) sube la versión del chat e invalida sus menciones.
+    """
+    global ROSTER_CACHE
+    key = str(chat_id)
+    roster = dict(load_roster())
+    roster[key] = chat_data
+    try:
+        persist_json(ROSTER_FILE, roster)
+    except Exception as e:
+        logging.exception("No se pudo guardar roster", exc_info=e)
+        return
+    ROSTER_CACHE = roster
+    if members_changed:
+        ROSTER_VERSIONS[key] = ROSTER_VERSIONS.get(key, 0) + 1
+def roster_version(chat_id: int) -> int:
+    return ROSTER_VERSIONS.get(str(chat_id), 0)
 async def prune_roster(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
     """
     Elimina del roster los usuarios que ya no están en el grupo.
@@ -170,8 +605,8 @@ async def prune_roster(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logging.warning(f"❌ Error consultando {uid_str}: {e}")
             cleaned[uid_str] = info
-    roster[str(chat_id)] = cleaned
-    save_roster(roster)
+    if len(cleaned) != len(chat_roster):
+        save_chat_roster(chat_id, cleaned)
 def _detect_name_changes(chat_id: int, user) -> dict:
     roster = load_roster()
     chat_data = roster.get(str(chat_id), {})
@@ -190,33 +625,78 @@ def _detect_name_changes(chat_id: int, user) -> dict:
         "old_first": old_first, "new_first": new_first,
         "old_user": old_user, "new_user": new_user
     }
-def upsert_roster_member(chat_id: int, user) -> None:
+def _activity_bump(rec: Dict[str, Any], today: int) -> None:
+    """
+    Suma un mensaje al contador diario de `rec`. "act" es un anillo de ACTIVITY_DAYS cubetas
+    indexado por día UTC % ACTIVITY_DAYS y "act_day" el último día escrito; las cubetas de los
+    días sin actividad se ponen a cero al avanzar.
+    """
+    act = list(rec.get("act") or ())
+    if len(act) != ACTIVITY_DAYS:
+        act = [0] * ACTIVITY_DAYS
+    last = int(rec.get("act_day", today))
+    for day in range(max(last + 1, today - ACTIVITY_DAYS + 1), today + 1):
+        act[day % ACTIVITY_DAYS] = 0
+    act[today % ACTIVITY_DAYS] += 1
+    rec["act"] = act
+    rec["act_day"] = today
+def _activity_seed(rec: Dict[str, Any], today: int) -> None:
+    """
+    Crea el anillo de actividad de un registro que no lo tiene. En registros antiguos (solo last_ts)
+    se siembra con un mensaje el día de last_ts, igual que cuenta activity_count para ellos.
+    """
+    act = rec.get("act")
+    if act and len(act) == ACTIVITY_DAYS and rec.get("act_day") is not None:
+        return
+    act = [0] * ACTIVITY_DAYS
+    last_ts = float(rec.get("last_ts") or 0)
+    day = int(last_ts // 86400) if last_ts else today
+    if last_ts and today - day < ACTIVITY_DAYS:
+        act[day % ACTIVITY_DAYS] = 1
+    rec["act"], rec["act_day"] = act, min(day, today)
+def activity_count(rec: Dict[str, Any], days: int, now: float | None = None) -> int:
+    """Mensajes de `rec` en los últimos `days` días (incluido hoy)."""
+    today = int((now if now is not None else time.time()) // 86400)
+    days = max(1, min(ACTIVITY_DAYS, days))
+    act, last = rec.get("act"), rec.get("act_day")
+    if not act or last is None:
+        return 1 if float(rec.get("last_ts") or 0) >= (today - days + 1) * 86400 else 0
+    return sum(act[d % ACTIVITY_DAYS] for d in range(max(today - days + 1, last - ACTIVITY_DAYS + 1), last + 1))
+def upsert_roster_member(chat_id: int, user, active: bool = True) -> None:
+    """Actualiza el registro de `user`; con active=False no cuenta el mensaje en su actividad diaria."""
     if not user:
         return
-    roster = load_roster()
-    key = str(chat_id)
-    chat_data = roster.get(key, {})
+    chat_data = dict(load_roster().get(str(chat_id), {}))
     uid = str(user.id)
     first = user.first_name or "Usuario"
     username = (user.username or "").lower() or None
     display = user.first_name or (("@" + username) if username else "Usuario")
-    rec = chat_data.get(uid) or {}
+    old = chat_data.get(uid)
+    rec = dict(old or {})
     rec["first"] = first
     rec["username"] = username
     rec["name"] = display
     rec["is_bot"] = getattr(user, "is_bot", False)
-    rec["last_ts"] = time.time()
+    now = time.time()
+    _activity_seed(rec, int(now // 86400))
+    rec["last_ts"] = now
     rec["messages"] = int(rec.get("messages", 0)) + 1 if "messages" in rec else 1
+    if active:
+        _activity_bump(rec, int(now // 86400))
     chat_data[uid] = rec
-    roster[key] = chat_data
-    save_roster(roster)
-def get_chat_roster(chat_id: int) -> List[dict]:
+    changed = old is None or old.get("name") != display or bool(old.get("is_bot")) != rec["is_bot"]
+    save_chat_roster(chat_id, chat_data, members_changed=changed)
+def get_chat_roster(chat_id: int, active_days: int = 0) -> List[dict]:
+    """Miembros normalizados del chat; con active_days > 0 solo los que han escrito en esos días."""
     roster = load_roster()
     data = roster.get(str(chat_id))
     if not data or not isinstance(data, dict):
         return []
+    now = time.time()
     norm = []
     for uid_str, info in data.items():
+        if active_days and not activity_count(info, active_days, now):
+            continue
         try:
             uid = int(uid_str)
         except Exception:
@@ -234,27 +714,63 @@ def get_chat_roster(chat_id: int) -> List[dict]:
 def _display_name(u: dict) -> str:
     name = (u.get("first_name") or u.get("username") or "usuario").strip()
     return name if name else "usuario"
-def build_mentions_html(members: List[dict]) -> List[str]:
-    seen = set()
-    clean = []
-    for u in members:
-        uid = u.get("id")
-        if not uid or uid in seen or u.get("is_bot"):
-            continue
-        seen.add(uid)
-        clean.append(u)
-    chunks, batch = [], []
-    for i, u in enumerate(clean, 1):
-        uid = u["id"]
-        name = _display_name(u)
-        mention = f'<a href="tg://user?id={uid}">{html.escape(name)}</a>'
+def _tg_len(text: str) -> int:
+    """Longitud tal y como la cuenta Telegram (unidades UTF-16)."""
+    return len(text.encode("utf-16-le")) // 2
+def _render_mention(uid: int, name: str) -> tuple[str, int]:
+    name = name[:64]
+    return f'<a href="tg://user?id={uid}">{html.escape(name)}</a>', _tg_len(name)
+def _pack_mentions(items, reserve_chars: int = 0, reserve_entities: int = 0) -> List[tuple[str, int]]:
+    """
+    Agrupa menciones ya renderizadas (html, longitud visible) en bloques (html, nº de menciones) tan llenos
+    como permiten los límites de Telegram (ALL_MAX_CHARS de texto y ALL_MAX_ENTITIES entidades).
+    """
+    max_chars = ALL_MAX_CHARS - reserve_chars
+    max_mentions = ALL_MAX_ENTITIES - reserve_entities
+    chunks, batch, used = [], [], 0
+    for mention, length in items:
+        cost = length + (2 if batch else 0)
+        if batch and (used + cost > max_chars or len(batch) >= max_mentions):
+            chunks.append((", ".join(batch), len(batch)))
+            batch, used, cost = [], 0, length
         batch.append(mention)
-        if i % 20 == 0:
-            chunks.append(", ".join(batch))
-            batch = []
+        used += cost
     if batch:
-        chunks.append(", ".join(batch))
+        chunks.append((", ".join(batch), len(batch)))
     return chunks
+def chat_mentions(chat_id: int) -> Dict[str, Any]:
+    """
+    Menciones renderizadas del chat, cacheadas por versión del roster:
+    {"version", "uids" (sin bots, en orden), "html" {uid: (html, longitud)}, "blocks" {(reserva): bloques}}.
+    """
+    key = str(chat_id)
+    version = roster_version(chat_id)
+    cached = MENTION_CACHE.get(key)
+    if cached is not None and cached["version"] == version:
+        return cached
+    uids, rendered = [], {}
+    for m in get_chat_roster(chat_id):
+        uid = m["id"]
+        if not uid or m["is_bot"] or uid in rendered:
+            continue
+        uids.append(uid)
+        rendered[uid] = _render_mention(uid, _display_name(m))
+    cached = MENTION_CACHE[key] = {"version": version, "uids": uids, "html": rendered, "blocks": {}}
+    return cached
+def chat_mention_blocks(chat_id: int, uids: List[int], reserve_chars: int = 0, reserve_entities: int = 0) -> List[tuple[str, int]]:
+    """Bloques para `uids`; si son todos los miembros del chat se reutilizan los ya empaquetados."""
+    cached = chat_mentions(chat_id)
+    if uids == cached["uids"]:
+        blocks = cached["blocks"].get((reserve_chars, reserve_entities))
+        if blocks is None:
+            blocks = cached["blocks"][(reserve_chars, reserve_entities)] = _pack_mentions(
+                (cached["html"][uid] for uid in uids), reserve_chars, reserve_entities
+            )
+        return blocks
+    rendered = cached["html"]
+    return _pack_mentions(
+        (rendered.get(uid) or _render_mention(uid, "usuario") for uid in uids), reserve_chars, reserve_entities
+    )
 ROSTER_LINE_RE = re.compile(r"^\s*\[?(\d+)\]?\s+(.+?)\s+\[?(-?\d+)\]?\s*$")
 def _import_list(url: str) -> tuple[int | None, dict[str, dict[str, Any]]]:
     if not url:
@@ -321,18 +837,16 @@ def ensure_import_once():
     ded_chat, parsed = _import_list(LIST_URL)
     if not parsed or ded_chat is None:
         return
+    if SHARD_INDEX >= 0 and shard_of(ded_chat) != SHARD_INDEX:
+        return
     cs = get_chat_settings(ded_chat)
     if LIST_IMPORT_ONCE and cs.get("list_import_done"):
         return
-    roster = load_roster()
-    key = str(ded_chat)
-    existing = roster.get(key, {})
+    existing = load_roster().get(str(ded_chat), {})
     if LIST_IMPORT_MODE == "seed" and existing:
         pass
     else:
-        merged = _merge_roster(existing, parsed, mode=LIST_IMPORT_MODE)
-        roster[key] = merged
-        save_roster(roster)
+        save_chat_roster(ded_chat, _merge_roster(existing, parsed, mode=LIST_IMPORT_MODE))
     if LIST_IMPORT_ONCE:
         set_chat_setting(ded_chat, "list_import_done", True)
 AFK_PHRASES_NORMAL = [
@@ -369,7 +883,7 @@ def txt_help_triggers() -> str:
     return ("\n\nAtajos sin barra (informativo):\n            "
             "brb / afk — activa afk\n"
             "hora [país] — hora del país (por defecto España)\n"
-            "🛡️ @all [motivo] — mencionar a todos\n"
+            "🛡️ @all [Nd] [motivo] — mencionar a todos (o solo a los activos en N días)\n"
             "@admin [motivo] — avisar solo a administradores")
 def txt_all_perm() -> str:
     return "🛡️ 🛡️ Solo los administradores pueden usar @all."
@@ -377,8 +891,10 @@ def txt_all_disabled() -> str:
     return "❌ La función @all está desactivada en este grupo."
 def txt_all_cooldown() -> str:
     return "⚠️ Debes esperar un poco antes de volver a usar @all."
-def txt_all_header(by_first: str, extra: str) -> str:
+def txt_all_header(by_first: str, extra: str, days: int = 0) -> str:
     out = f"@all por {by_first}"
+    if days:
+        out += f" (activos en los últimos {days} días)"
     if extra:
         out += f": {extra}"
     return out
@@ -400,6 +916,24 @@ def txt_only_initiator() -> str:
     return "Solo puede confirmar quien inició la acción."
 def txt_sending_mentions() -> str:
     return "Enviando menciones…"
+def txt_all_progress(sent: int, total: int) -> str:
+    return f"📣 Enviando menciones… {sent}/{total}"
+def txt_all_done(sent: int, blocks: int, failed: int = 0) -> str:
+    txt = f"✅ {sent} menciones enviadas en {blocks} mensajes."
+    if failed:
+        txt += f"\n⚠️ {failed} menciones no se pudieron enviar."
+    return txt
+def txt_all_cancelled(sent: int, total: int, failed: int = 0) -> str:
+    txt = f"⛔ @all cancelado ({sent}/{total} menciones enviadas)."
+    if failed:
+        txt += f"\n⚠️ {failed} menciones no se pudieron enviar."
+    return txt
+def txt_all_running() -> str:
+    return "⏳ Ya hay un @all en curso en este chat. Usa /cancel para detenerlo."
+def btn_stop() -> str:
+    return "Detener"
+def txt_cb_expired() -> str:
+    return "⌛ Este botón ha caducado o no es válido."
 def txt_canceled() -> str:
     return "❌ Cancelado."
 def txt_cancel_cmd() -> str:
@@ -603,6 +1137,7 @@ async def autoresponder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat.id not in AUTO_RESPONDERS:
         AUTO_RESPONDERS[chat.id] = {}
     AUTO_RESPONDERS[chat.id][target_user.id] = response_text
+    log_admin_action("autoresponder_on", admin_id=msg.from_user.id, detail={"user_id": target_user.id, "texto": response_text}, chat_id=chat.id)
     await msg.reply_text(txt_autoresp_on(target_user.first_name, response_text))
 async def autoresponder_off_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
@@ -630,6 +1165,7 @@ async def autoresponder_off_cmd(update: Update, context: ContextTypes.DEFAULT_TY
         return
     if chat.id in AUTO_RESPONDERS and target_user.id in AUTO_RESPONDERS[chat.id]:
         del AUTO_RESPONDERS[chat.id][target_user.id]
+        log_admin_action("autoresponder_off", admin_id=msg.from_user.id, detail={"user_id": target_user.id}, chat_id=chat.id)
         await msg.reply_text(txt_autoresp_off(target_user.first_name))
     else:
         await msg.reply_text(txt_autoresp_none(target_user.first_name))
@@ -712,55 +1248,174 @@ async def _check_all_permissions(context, chat_id: int, user_id: int) -> tuple[b
     if _last_all.get(chat_id) and time.time() - _last_all[chat_id] < cd:
         return False, txt_all_cooldown()
     return True, ""
+ALL_DAYS_RE = re.compile(r"^(\d{1,2})d\b\s*", re.IGNORECASE)
+def split_all_days(extra: str) -> tuple[int, str]:
+    """Separa el filtro opcional de actividad del motivo: "7d motivo" -> (7, "motivo")."""
+    m = ALL_DAYS_RE.match(extra or "")
+    if not m or not 1 <= int(m.group(1)) <= ACTIVITY_DAYS:
+        return 0, extra
+    return int(m.group(1)), extra[m.end():]
+def _all_jobs() -> Dict[str, Dict[str, Any]]:
+    global ALL_JOBS
+    if ALL_JOBS is None:
+        data = _load_json_file(ALL_JOBS_FILE, {})
+        ALL_JOBS = data if isinstance(data, dict) else {}
+    return ALL_JOBS
+def _all_jobs_save() -> None:
+    _save_json_file(ALL_JOBS_FILE, _all_jobs())
+def _all_status_text(job: Dict[str, Any], line: str) -> str:
+    return txt_all_header(job["by_name"], job["extra"], job["days"]) + "\n" + line
+def _all_stop_markup() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(btn_stop(), callback_data=cb_encode("alljob", "stop"))]])
+async def _all_edit_status(bot, chat_id: int, job: Dict[str, Any], line: str, markup=None) -> None:
+    if not job.get("status_id"):
+        return
+    try:
+        await bot.edit_message_text(
+            chat_id=chat_id, message_id=job["status_id"], text=_all_status_text(job, line), reply_markup=markup
+        )
+    except BadRequest:
+        pass
+    except Exception:
+        logging.exception("Fallo actualizando progreso @all")
+async def _run_all_job(bot, chat_id: int) -> None:
+    """
+    Envía los bloques pendientes de la tarea @all de `chat_id`. El progreso ("next") se guarda tras
+    cada bloque, así que si el bot se reinicia la tarea continúa donde se quedó (resume_all_jobs).
+    Un bloque que sigue fallando tras ALL_BLOCK_RETRIES intentos se cuenta en "failed" y se informa al final.
+    """
+    key = str(chat_id)
+    job = _all_jobs().get(key)
+    if not job:
+        return
+    uids = job["uids"]
+    motivo_html, reserve_chars, reserve_entities = "", 0, 0
+    if job["extra"]:
+        motivo_html = "\n\n" + txt_motivo_label() + html.escape(job["extra"])
+        reserve_chars = _tg_len("\n\n" + re.sub(r"<[^>]+>", "", txt_motivo_label()) + job["extra"])
+        reserve_entities = 1 + len(re.findall(r"(?:^|\s)(?:[@#/]\w|https?://)", job["extra"]))
+    blocks = chat_mention_blocks(chat_id, uids[job["next"]:] if job["next"] else uids, reserve_chars, reserve_entities)
+    total = len(uids)
+    last_edit = 0.0
+    try:
+        for block, count in blocks:
+            attempts = 0
+            sent = False
+            while True:
+                try:
+                    await bot.send_message(chat_id=chat_id, text=block + motivo_html, parse_mode="HTML", disable_web_page_preview=True)
+                    sent = True
+                    break
+                except RetryAfter as e:
+                    await asyncio.sleep(float(e.retry_after))
+                except Exception as e:
+                    attempts += 1
+                    logging.exception("Fallo bloque @all (intento %s)", attempts)
+                    if isinstance(e, BadRequest) or attempts >= ALL_BLOCK_RETRIES:
+                        break
+                    await asyncio.sleep(2 ** attempts)
+            job["next"] += count
+            if sent:
+                job["blocks"] = job.get("blocks", 0) + 1
+            else:
+                job["failed"] = job.get("failed", 0) + count
+            _all_jobs_save()
+            if time.monotonic() - last_edit >= ALL_PROGRESS_EVERY and job["next"] < total:
+                last_edit = time.monotonic()
+                await _all_edit_status(bot, chat_id, job, txt_all_progress(job["next"] - job.get("failed", 0), total), _all_stop_markup())
+            await asyncio.sleep(0.3)
+    except asyncio.CancelledError:
+        if not job.get("cancelled"):
+            raise
+        failed = job.get("failed", 0)
+        await _all_edit_status(bot, chat_id, job, txt_all_cancelled(job["next"] - failed, total, failed))
+    else:
+        failed = job.get("failed", 0)
+        await _all_edit_status(bot, chat_id, job, txt_all_done(job["next"] - failed, job.get("blocks", 0), failed))
+        log_admin_action(
+            "all", admin_id=job["by_id"],
+            detail={"motivo": job["extra"], "bloques": job.get("blocks", 0), "dias": job["days"], "fallidas": failed}, chat_id=chat_id,
+        )
+    finally:
+        if ALL_TASKS.get(chat_id) is asyncio.current_task():
+            ALL_TASKS.pop(chat_id, None)
+    _all_jobs().pop(key, None)
+    _all_jobs_save()
+def _start_all_task(bot, chat_id: int) -> None:
+    ALL_TASKS[chat_id] = asyncio.create_task(_run_all_job(bot, chat_id))
+def cancel_all_job(chat_id: int) -> bool:
+    """Detiene la tarea @all en curso del chat; devuelve False si no había ninguna."""
+    job = _all_jobs().get(str(chat_id))
+    task = ALL_TASKS.get(chat_id)
+    if not job or task is None:
+        return False
+    job["cancelled"] = True
+    task.cancel()
+    return True
+def resume_all_jobs(bot) -> None:
+    """Relanza las tareas @all que quedaron a medias (p. ej. tras un reinicio)."""
+    for key in list(_all_jobs()):
+        try:
+            chat_id = int(key)
+        except ValueError:
+            continue
+        if chat_id not in ALL_TASKS:
+            logging.info("Reanudando @all en %s (%s/%s)", chat_id, _all_jobs()[key]["next"], len(_all_jobs()[key]["uids"]))
+            _start_all_task(bot, chat_id)
 async def execute_all(chat, context: ContextTypes.DEFAULT_TYPE, extra: str, by_user):
+    if chat.id in ALL_TASKS:
+        await context.bot.send_message(chat_id=chat.id, text=txt_all_running())
+        return
+    days, extra = split_all_days(extra)
     await prune_roster(chat.id, context)
-    members = get_chat_roster(chat.id)
-    if not members:
+    if not load_roster().get(str(chat.id)):
         await context.bot.send_message(chat_id=chat.id, text=txt_no_users())
         return
-    parts = build_mentions_html(members)
-    if not parts:
-        await msg.reply_text("⚠️ Debes escribir el texto que el bot enviará automáticamente.")
+    uids = chat_mentions(chat.id)["uids"]
+    if days:
+        active = {m["id"] for m in get_chat_roster(chat.id, active_days=days)}
+        uids = [uid for uid in uids if uid in active]
+    if not uids:
         await context.bot.send_message(chat_id=chat.id, text=txt_no_targets())
         return
-    header = txt_all_header(by_user.first_name, extra)
+    job = {"by_id": by_user.id, "by_name": by_user.first_name, "extra": extra, "days": days,
+           "uids": uids, "next": 0, "blocks": 0, "status_id": None, "started": time.time()}
     try:
-        await context.bot.send_message(chat_id=chat.id, text=header)
+        status = await context.bot.send_message(
+            chat_id=chat.id, text=_all_status_text(job, txt_all_progress(0, len(uids))), reply_markup=_all_stop_markup()
+        )
+        job["status_id"] = status.message_id
     except Exception as e:
         logging.exception("Fallo cabecera @all", exc_info=e)
-    motivo_html = ("\n\n" + txt_motivo_label() + html.escape(extra)) if extra else ""
-    for block in parts:
-        try:
-            body = block + motivo_html
-            await context.bot.send_message(chat_id=chat.id, text=body, parse_mode="HTML", disable_web_page_preview=True)
-            await asyncio.sleep(0.3)
-        except Exception:
-            logging.exception("Fallo bloque @all")
+    _all_jobs()[str(chat.id)] = job
+    _all_jobs_save()
     _last_all[chat.id] = time.time()
+    _start_all_task(context.bot, chat.id)
+async def alljob_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str = ""):
+    q = update.callback_query
+    if not await is_admin(context, q.message.chat.id, q.from_user.id):
+        return await safe_q_answer(q, "🛡️ Solo los administradores pueden detener el @all.", show_alert=True)
+    if action == "stop" and cancel_all_job(q.message.chat.id):
+        return await safe_q_answer(q, "⛔ Deteniendo…")
+    await safe_q_answer(q)
 async def confirm_all(chat_id: int, context: ContextTypes.DEFAULT_TYPE, extra: str, initiator_id: int):
-    data_yes = f"allconfirm:{chat_id}:yes:{initiator_id}"
-    data_no = f"allconfirm:{chat_id}:no:{initiator_id}"
+    data_yes = cb_encode("allconfirm", "yes", initiator_id)
+    data_no = cb_encode("allconfirm", "no", initiator_id)
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(btn_confirm(), callback_data=data_yes),
          InlineKeyboardButton(btn_cancel(), callback_data=data_no)]
     ])
-async def callback_allconfirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def callback_allconfirm(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str = "", initiator: int = 0):
     q = update.callback_query
-    chat_id = q.message.chat.id
     await safe_q_answer(q)
-    try:
-        _, cid, action, initiator = q.data.split(":")
-        cid = int(cid)
-        initiator = int(initiator)
-    except Exception:
+    if not isinstance(initiator, int) or not initiator:
         return await q.edit_message_text(txt_all_confirm_bad())
     if q.from_user.id != initiator:
         return await q.reply_text(txt_only_initiator())
     if action == "yes":
         extra = context.user_data.get("pending_all", "")
         await q.edit_message_text(txt_sending_mentions())
-        chat = await context.bot.get_chat(cid)
-        await execute_all(chat, context, extra, q.from_user)
+        await execute_all(q.message.chat, context, extra, q.from_user)
         context.user_data.pop("pending_all", None)
     else:
         context.user_data.pop("pending_all", None)
@@ -771,6 +1426,7 @@ async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await msg.reply_text("🛡️ Este comando solo pueden usarlo administradores.")
     context.user_data.pop("pending_all", None)
     context.user_data.pop("pending_admin", None)
+    cancel_all_job(msg.chat.id)
     await msg.reply_text(txt_cancel_cmd())
 async def all_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
@@ -865,29 +1521,23 @@ async def execute_admin(chat, context: ContextTypes.DEFAULT_TYPE, extra: str, by
             logging.exception("Fallo bloque @admin")
     _admin_last[chat.id] = time.time()
 async def confirm_admin(chat_id: int, context: ContextTypes.DEFAULT_TYPE, extra: str, initiator_id: int):
-    data_yes = f"adminconfirm:{chat_id}:yes:{initiator_id}"
-    data_no = f"adminconfirm:{chat_id}:no:{initiator_id}"
+    data_yes = cb_encode("adminconfirm", "yes", initiator_id)
+    data_no = cb_encode("adminconfirm", "no", initiator_id)
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(btn_confirm(), callback_data=data_yes),
          InlineKeyboardButton(btn_cancel(), callback_data=data_no)]
     ])
-async def callback_adminconfirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def callback_adminconfirm(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str = "", initiator: int = 0):
     q = update.callback_query
-    chat_id = q.message.chat.id
     await safe_q_answer(q)
-    try:
-        _, cid, action, initiator = q.data.split(":")
-        cid = int(cid)
-        initiator = int(initiator)
-    except Exception:
+    if not isinstance(initiator, int) or not initiator:
         return await q.edit_message_text(txt_all_confirm_bad())
     if q.from_user.id != initiator:
         return await q.reply_text(txt_only_initiator())
     if action == "yes":
         extra = context.user_data.get("pending_admin", "")
         await q.edit_message_text(txt_calling_admins())
-        chat = await context.bot.get_chat(cid)
-        await execute_admin(chat, context, extra, q.from_user)
+        await execute_admin(q.message.chat, context, extra, q.from_user)
         context.user_data.pop("pending_admin", None)
     else:
         context.user_data.pop("pending_admin", None)
@@ -928,16 +1578,13 @@ async def admin_mention_detector(update: Update, context: ContextTypes.DEFAULT_T
         return
     await execute_admin(chat, context, extra, user)
 def _ttt_stats_load() -> dict:
-    s = load_settings()
-    return s.setdefault("_ttt_stats", {})
+    return load_settings().get("_ttt_stats", {})
 def _ttt_stats_save(stats: dict) -> None:
-    s = load_settings()
-    s["_ttt_stats"] = stats
-    save_settings(s)
+    save_settings_entry("_ttt_stats", stats)
 def _ttt_stats_bump(chat_id: int, user_id: int, name: str, key: str):
-    stats = _ttt_stats_load()
-    c = stats.setdefault(str(chat_id), {})
-    u = c.setdefault(str(user_id), {"name": name or f"ID {user_id}", "wins": 0, "draws": 0, "losses": 0})
+    stats = dict(_ttt_stats_load())
+    c = stats[str(chat_id)] = dict(stats.get(str(chat_id), {}))
+    u = c[str(user_id)] = dict(c.get(str(user_id)) or {"name": name or f"ID {user_id}", "wins": 0, "draws": 0, "losses": 0})
     u["name"] = name or u["name"]
     u[key] = int(u.get(key, 0)) + 1
     _ttt_stats_save(stats)
@@ -964,42 +1611,137 @@ def _ttt_stats_top(chat_id: int, metric: str = "wins", limit: int = 10) -> str:
     for i, (val, name, _uid) in enumerate(rows, start=1):
         out.append(f"{i}. {name} — {val}")
     return "\n".join(out)
+def _game_snapshot_path(kind: str, chat_id: int, msg_id: int) -> str:
+    return os.path.join(GAMES_DIR, f"{kind}_{chat_id}_{msg_id}.json")
+def _game_snapshot_save(kind: str, chat_id: int, msg_id: int, data: Dict[str, Any]) -> None:
+    """Guarda el estado de una partida en su propio fichero (escritura atómica en el hilo escritor)."""
+    path = _game_snapshot_path(kind, chat_id, msg_id)
+    try:
+        persist_json(path, data, f"games/{kind}", mutable=True)
+    except Exception:
+        logging.exception("❌ Error guardando partida: %s", path)
+def _game_snapshot_load(kind: str, chat_id: int, msg_id: int) -> Dict[str, Any] | None:
+    path = _game_snapshot_path(kind, chat_id, msg_id)
+    pending = persist_pending(path)
+    try:
+        if pending is not None:
+            data = json_loads(pending[0]) if isinstance(pending[0], bytes) else pending[0]
+        else:
+            data = json_read(path)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logging.exception("❌ Error leyendo partida: %s", path)
+        return None
+    return data if isinstance(data, dict) else None
+def _game_snapshot_delete(kind: str, chat_id: int, msg_id: int) -> None:
+    persist_delete(_game_snapshot_path(kind, chat_id, msg_id), f"games/{kind}")
+def prune_game_snapshots(max_age: float = GAME_SNAPSHOT_TTL) -> None:
+    """Elimina los snapshots de partidas sin actividad desde hace más de max_age segundos."""
+    if not os.path.isdir(GAMES_DIR):
+        return
+    limit = time.time() - max_age
+    try:
+        with os.scandir(GAMES_DIR) as it:
+            for entry in it:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < limit:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+    except Exception:
+        logging.exception("❌ Error limpiando partidas antiguas")
 def _ttt_get_game(chat_id: int, msg_id: int) -> Dict[str, Any] | None:
-    return TTT_GAMES.get(chat_id, {}).get(msg_id)
+    state = TTT_GAMES.get(chat_id, {}).get(msg_id)
+    if state is None:
+        state = _game_snapshot_load("ttt", chat_id, msg_id)
+        if state is not None:
+            TTT_GAMES.setdefault(chat_id, {})[msg_id] = _ttt_migrate_state(state)
+    return state
 def _ttt_set_game(chat_id: int, msg_id: int, data: Dict[str, Any]) -> None:
     TTT_GAMES.setdefault(chat_id, {})[msg_id] = data
+    _game_snapshot_save("ttt", chat_id, msg_id, data)
 def _ttt_del_game(chat_id: int, msg_id: int) -> None:
     if chat_id in TTT_GAMES and msg_id in TTT_GAMES[chat_id]:
         del TTT_GAMES[chat_id][msg_id]
         if not TTT_GAMES[chat_id]:
             del TTT_GAMES[chat_id]
-def _ttt_new_board() -> list[str]:
-    return [TTT_EMPTY] * 9
-def _ttt_winner(board: list[str]) -> str | None:
-    wins = [
-        (0, 1, 2), (3, 4, 5), (6, 7, 8),
-        (0, 3, 6), (1, 4, 7), (2, 5, 8),
-        (0, 4, 8), (2, 4, 6)
-    ]
-    for a, b, c in wins:
-        if board[a] != TTT_EMPTY and board[a] == board[b] == board[c]:
-            return board[a]
-    return None
-def _ttt_full(board: list[str]) -> bool:
-    return all(c != TTT_EMPTY for c in board)
-def _ttt_board_markup(chat_id: int, msg_id: int, board: list[str], playing: bool) -> InlineKeyboardMarkup:
+    _game_snapshot_delete("ttt", chat_id, msg_id)
+TTT_WIN_MASKS = tuple(
+    (1 << a) | (1 << b) | (1 << c)
+    for a, b, c in ((0, 1, 2), (3, 4, 5), (6, 7, 8), (0, 3, 6), (1, 4, 7), (2, 5, 8), (0, 4, 8), (2, 4, 6))
+)
+TTT_FULL_MASK = 0x1FF
+TTT_IS_WIN = bytes(1 if any(m & w == w for w in TTT_WIN_MASKS) else 0 for m in range(1 << 9))
+_TTT_BOT_MOVES: bytearray | None = None
+def _ttt_masks_from_board(board: list) -> tuple[int, int]:
+    x = o = 0
+    for idx, cell in enumerate(board[:9]):
+        if cell == TTT_X:
+            x |= 1 << idx
+        elif cell == TTT_O:
+            o |= 1 << idx
+    return x, o
+def _ttt_migrate_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Convierte partidas guardadas con tablero en lista al formato de bitboards."""
+    if "board" in state:
+        state["x"], state["o"] = _ttt_masks_from_board(state.pop("board") or [])
+    state.setdefault("x", 0)
+    state.setdefault("o", 0)
+    return state
+def _ttt_bot_moves() -> bytearray:
+    """
+    Tabla minimax precalculada (una sola vez) con la mejor casilla para quien mueve,
+    indexada por mis_fichas | fichas_rivales << 9. 9 = sin jugada.
+    """
+    global _TTT_BOT_MOVES
+    if _TTT_BOT_MOVES is not None:
+        return _TTT_BOT_MOVES
+    table = bytearray(b"\x09") * (1 << 18)
+    scores: dict[int, int] = {}
+    def negamax(me: int, opp: int) -> int:
+        key = me | (opp << 9)
+        if key in scores:
+            return scores[key]
+        free = TTT_FULL_MASK & ~(me | opp)
+        best, best_idx = 0 if not free else -10, 9
+        for idx in range(9):
+            bit = 1 << idx
+            if not free & bit:
+                continue
+            mine = me | bit
+            if TTT_IS_WIN[mine]:
+                score = bin(free).count("1")
+            else:
+                score = -negamax(opp, mine)
+            if score > best:
+                best, best_idx = score, idx
+        scores[key] = best
+        table[key] = best_idx
+        return best
+    negamax(0, 0)
+    _TTT_BOT_MOVES = table
+    return table
+def _ttt_board_rows(x: int, o: int, playing: bool) -> list[list[InlineKeyboardButton]]:
     rows = []
     for r in range(3):
         btns = []
         for c in range(3):
             idx = r * 3 + c
-            label = board[idx]
-            if label == TTT_EMPTY and playing:
-                cb = f"ttt:play:{chat_id}:{msg_id}:{idx}"
-            else:
-                cb = f"ttt:nop:{chat_id}:{msg_id}:{idx}"
-            btns.append(InlineKeyboardButton(label, callback_data=cb))
+            bit = 1 << idx
+            label = TTT_X if x & bit else TTT_O if o & bit else TTT_EMPTY
+            action = "play" if label == TTT_EMPTY and playing else "nop"
+            btns.append(InlineKeyboardButton(label, callback_data=cb_encode("ttt", action, idx)))
         rows.append(btns)
+    return rows
+@functools.lru_cache(maxsize=4096)
+def _ttt_markup(status: str, x: int, o: int) -> InlineKeyboardMarkup:
+    rows = _ttt_board_rows(x, o, status == "playing")
+    if status == "waiting":
+        rows.append([InlineKeyboardButton("Unirme", callback_data=cb_encode("ttt", "join"))])
+        rows.append([InlineKeyboardButton("Cancelar", callback_data=cb_encode("ttt", "cancel"))])
+    elif status == "ended":
+        rows.append([InlineKeyboardButton("Nueva partida", callback_data=cb_encode("ttt", "rematch"))])
     return InlineKeyboardMarkup(rows)
 def _ttt_header_text(state: Dict[str, Any]) -> str:
     pX = state["players"].get("X_name", "X")
@@ -1015,28 +1757,58 @@ def _ttt_header_text(state: Dict[str, Any]) -> str:
         result = state.get("result", "fin de partida")
         return f"Tres en raya — {result}"
     return "Tres en raya"
-def _ttt_footer_markup(chat_id: int, msg_id: int, state: Dict[str, Any]) -> InlineKeyboardMarkup:
-    buttons = []
-    if state["status"] == "waiting":
-        buttons.append([InlineKeyboardButton("Unirme", callback_data=f"ttt:join:{chat_id}:{msg_id}")])
-        buttons.append([InlineKeyboardButton("Cancelar", callback_data=f"ttt:cancel:{chat_id}:{msg_id}")])
-    elif state["status"] == "ended":
-        buttons.append([InlineKeyboardButton("Nueva partida", callback_data=f"ttt:rematch:{chat_id}:{msg_id}")])
-    board_kb = _ttt_board_markup(chat_id, msg_id, state["board"], state["status"] == "playing")
-    all_rows = [list(row) for row in board_kb.inline_keyboard]
-    all_rows.extend(buttons)
-    return InlineKeyboardMarkup(all_rows)
+def _ttt_footer_markup(state: Dict[str, Any]) -> InlineKeyboardMarkup:
+    return _ttt_markup(state["status"], state["x"], state["o"])
 def _ttt_can_play(state: Dict[str, Any], user_id: int) -> bool:
     if state["status"] != "playing":
         return False
     symbol = state["turn"]
     pid = state["players"].get(f"{symbol}_id")
     return pid == user_id
+def _ttt_apply_move(chat_id: int, state: Dict[str, Any], idx: int) -> None:
+    """Coloca la ficha del turno actual en idx y resuelve victoria, empate o cambio de turno."""
+    turn = state["turn"]
+    key = "x" if turn == "X" else "o"
+    mask = state[key] | (1 << idx)
+    state[key] = mask
+    players = state["players"]
+    px, po = players["X_name"], players["O_name"]
+    x_id, o_id = players["X_id"], players["O_id"]
+    if TTT_IS_WIN[mask]:
+        if turn == "X":
+            ganador, ganador_id = px, x_id
+            perdedor, perdedor_id = po, o_id
+        else:
+            ganador, ganador_id = po, o_id
+            perdedor, perdedor_id = px, x_id
+        state["status"] = "ended"
+        state["result"] = f"¡{ganador} ha ganado!"
+        if ganador_id and perdedor_id and not state.get("bot"):
+            _ttt_stats_record_winloss(chat_id, ganador_id, ganador or "Jugador", perdedor_id, perdedor or "Jugador")
+    elif (state["x"] | state["o"]) == TTT_FULL_MASK:
+        state["status"] = "ended"
+        state["result"] = "Empate. Buen duelo."
+        if x_id and o_id and not state.get("bot"):
+            _ttt_stats_record_draw(chat_id, x_id, px or "Jugador X", o_id, po or "Jugador O")
+    else:
+        state["turn"] = "O" if turn == "X" else "X"
+def _ttt_bot_turn(chat_id: int, state: Dict[str, Any]) -> None:
+    """Si le toca al bot, juega la jugada óptima consultando la tabla minimax."""
+    if state["status"] != "playing" or state.get("bot") != state["turn"]:
+        return
+    if state["turn"] == "X":
+        me, opp = state["x"], state["o"]
+    else:
+        me, opp = state["o"], state["x"]
+    idx = _ttt_bot_moves()[me | (opp << 9)]
+    if idx < 9:
+        _ttt_apply_move(chat_id, state, idx)
 async def ttt_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     /ttt  o  /tres
     - Si respondes a un mensaje, desafías a ese usuario.
     - Si pasas @usuario en args, reto directo.
+    - Si pasas "bot", juegas contra RuruBot.
     - Si no, partida abierta (botón Unirme).
     """
     msg = update.message
@@ -1046,7 +1818,12 @@ async def ttt_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pX = msg.from_user
     opponent_id = None
     opponent_name = None
-    if msg.reply_to_message and msg.reply_to_message.from_user and msg.reply_to_message.from_user.id != pX.id:
+    vs_bot = False
+    if context.args and context.args[0].lower() == "bot":
+        vs_bot = True
+        opponent_id = context.bot.id
+        opponent_name = "🤖 RuruBot"
+    elif msg.reply_to_message and msg.reply_to_message.from_user and msg.reply_to_message.from_user.id != pX.id:
         opponent_id = msg.reply_to_message.from_user.id
         opponent_name = msg.reply_to_message.from_user.first_name
     elif context.args and context.args[0].startswith("@"):
@@ -1063,7 +1840,8 @@ async def ttt_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             opponent_id = member.user.id
             opponent_name = member.user.first_name
     state = {
-        "board": _ttt_new_board(),
+        "x": 0,
+        "o": 0,
         "status": "waiting",
         "turn": "X",
         "players": {
@@ -1074,15 +1852,14 @@ async def ttt_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         },
         "created_ts": time.time()
     }
-    text = _ttt_header_text(state)
-    sent = await context.bot.send_message(chat_id=chat.id, text=text)
-    _ttt_set_game(chat.id, sent.message_id, state)
+    if vs_bot:
+        state["bot"] = "O"
     if opponent_id and opponent_id != pX.id:
         state["status"] = "playing"
         state["turn"] = random.choice(["X", "O"])
-        _ttt_set_game(chat.id, sent.message_id, state)
-    kb = _ttt_footer_markup(chat.id, sent.message_id, state)
-    await sent.edit_text(_ttt_header_text(state), reply_markup=kb)
+        _ttt_bot_turn(chat.id, state)
+    sent = await context.bot.send_message(chat_id=chat.id, text=_ttt_header_text(state), reply_markup=_ttt_footer_markup(state))
+    _ttt_set_game(chat.id, sent.message_id, state)
 async def ttt_join_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, msg_id: int):
     q = update.callback_query
     user = q.from_user
@@ -1101,7 +1878,7 @@ async def ttt_join_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_i
     state["turn"] = random.choice(["X", "O"])
     _ttt_set_game(chat_id, msg_id, state)
     await safe_q_answer(q, "¡Partida iniciada!")
-    await q.edit_message_text(_ttt_header_text(state), reply_markup=_ttt_footer_markup(chat_id, msg_id, state))
+    await q.edit_message_text(_ttt_header_text(state), reply_markup=_ttt_footer_markup(state))
 async def ttt_cancel_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, msg_id: int):
     q = update.callback_query
     user = q.from_user
@@ -1121,7 +1898,8 @@ async def ttt_rematch_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, cha
     if not old:
         return await safe_q_answer(q, "No hay partida para reiniciar.", show_alert=True)
     new_state = {
-        "board": _ttt_new_board(),
+        "x": 0,
+        "o": 0,
         "status": "playing",
         "turn": random.choice(["X", "O"]),
         "players": {
@@ -1132,9 +1910,12 @@ async def ttt_rematch_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, cha
         },
         "created_ts": time.time()
     }
+    if old.get("bot"):
+        new_state["bot"] = "X" if old["bot"] == "O" else "O"
+        _ttt_bot_turn(chat_id, new_state)
     _ttt_set_game(chat_id, msg_id, new_state)
     await safe_q_answer(q, "¡Nueva partida!")
-    await q.edit_message_text(_ttt_header_text(new_state), reply_markup=_ttt_footer_markup(chat_id, msg_id, new_state))
+    await q.edit_message_text(_ttt_header_text(new_state), reply_markup=_ttt_footer_markup(new_state))
 async def ttt_play_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, msg_id: int, idx: int):
     q = update.callback_query
     user = q.from_user
@@ -1145,54 +1926,21 @@ async def ttt_play_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_i
         return await safe_q_answer(q, "La partida no está disponible.", show_alert=True)
     if not _ttt_can_play(state, user.id):
         return await safe_q_answer(q, "No es tu turno.", show_alert=True)
-    board = state["board"]
-    if board[idx] != TTT_EMPTY:
+    if not 0 <= idx < 9 or (state["x"] | state["o"]) & (1 << idx):
         return await safe_q_answer(q, "Esa casilla ya está ocupada.", show_alert=True)
-    symbol = TTT_X if state["turn"] == "X" else TTT_O
-    board[idx] = symbol
-    winner = _ttt_winner(board)
-    if winner:
-        px = state["players"]["X_name"]
-        po = state["players"]["O_name"]
-        x_id = state["players"]["X_id"]
-        o_id = state["players"]["O_id"]
-        if winner == TTT_X:
-            ganador, ganador_id = px, x_id
-            perdedor, perdedor_id = po, o_id
-        else:
-            ganador, ganador_id = po, o_id
-            perdedor, perdedor_id = px, x_id
-        state["status"] = "ended"
-        state["result"] = f"¡{ganador} ha ganado!"
-        if ganador_id and perdedor_id:
-            _ttt_stats_record_winloss(chat_id, ganador_id, ganador or "Jugador", perdedor_id, perdedor or "Jugador")
-    elif _ttt_full(board):
-        px = state["players"]["X_name"]
-        po = state["players"]["O_name"]
-        x_id = state["players"]["X_id"]
-        o_id = state["players"]["O_id"]
-        state["status"] = "ended"
-        state["result"] = "Empate. Buen duelo."
-        if x_id and o_id:
-            _ttt_stats_record_draw(chat_id, x_id, px or "Jugador X", o_id, po or "Jugador O")
-    else:
-        state["turn"] = "O" if state["turn"] == "X" else "X"
+    _ttt_apply_move(chat_id, state, idx)
+    _ttt_bot_turn(chat_id, state)
     _ttt_set_game(chat_id, msg_id, state)
     await safe_q_answer(q)
-    await q.edit_message_text(_ttt_header_text(state), reply_markup=_ttt_footer_markup(chat_id, msg_id, state))
-async def ttt_router_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await q.edit_message_text(_ttt_header_text(state), reply_markup=_ttt_footer_markup(state))
+async def ttt_router_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str = "", idx: int | None = None):
     q = update.callback_query
     try:
-        parts = q.data.split(":")
-        if parts[0] != "ttt":
-            return await safe_q_answer(q)
-        action = parts[1]
-        chat_id = int(parts[2])
-        msg_id = int(parts[3])
+        chat_id = q.message.chat.id
+        msg_id = q.message.message_id
         if not is_module_enabled(chat_id, "ttt_enabled"):
             return await safe_q_answer(q, "🚫 El módulo TTT está desactivado en este chat.", show_alert=True)
-        if action == "play":
-            idx = int(parts[4])
+        if action == "play" and isinstance(idx, int):
             return await ttt_play_cb(update, context, chat_id, msg_id, idx)
         elif action == "join":
             return await ttt_join_cb(update, context, chat_id, msg_id)
@@ -1234,6 +1982,31 @@ async def trivia_top_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         mention = f'<a href="tg://user?id={uid}">{name}</a>'
         lines.append(f"{i}. {mention} — <b>{pts}</b> puntos")
     await msg.reply_text("\n".join(lines), parse_mode="HTML")
+async def actividad_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ranking de los miembros más activos del chat en los últimos N días (/actividad [días])."""
+    msg = update.message
+    if not msg:
+        return
+    days = 7
+    if context.args and context.args[0].isdigit():
+        days = max(1, min(ACTIVITY_DAYS, int(context.args[0])))
+    data = load_roster().get(str(msg.chat.id)) or {}
+    now = time.time()
+    rows = []
+    for uid, info in data.items():
+        if info.get("is_bot"):
+            continue
+        n = activity_count(info, days, now)
+        if n:
+            rows.append((n, str(info.get("name") or "usuario"), uid))
+    if not rows:
+        return await msg.reply_text(f"Nadie ha escrito en los últimos {days} días.")
+    rows.sort(key=lambda x: x[0], reverse=True)
+    lines = [f"📈 <b>TOP 10 — Actividad ({days} días)</b>\n"]
+    for i, (n, name, uid) in enumerate(rows[:10], start=1):
+        lines.append(f'{i}. <a href="tg://user?id={uid}">{html.escape(name)}</a> — <b>{n}</b> mensajes')
+    lines.append(f"\n👥 {len(rows)} miembros activos")
+    await msg.reply_text("\n".join(lines), parse_mode="HTML")
 async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     if not msg or not msg.from_user or not msg.text:
@@ -1269,7 +2042,7 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pass
     upsert_roster_member(chat.id, user)
     if msg.reply_to_message and msg.reply_to_message.from_user:
-        upsert_roster_member(chat.id, msg.reply_to_message.from_user)
+        upsert_roster_member(chat.id, msg.reply_to_message.from_user, active=False)
     if context.user_data.get("afk_skip_message_id") == msg.message_id:
         context.user_data.pop("afk_skip_message_id", None)
         return
@@ -1298,20 +2071,17 @@ PPT_SCISSORS = "✂️"
 
 
 def _ppt_stats_load() -> dict:
-    s = load_settings()
-    return s.setdefault("_ppt_stats", {})
+    return load_settings().get("_ppt_stats", {})
 
 
 def _ppt_stats_save(stats: dict) -> None:
-    s = load_settings()
-    s["_ppt_stats"] = stats
-    save_settings(s)
+    save_settings_entry("_ppt_stats", stats)
 
 
 def _ppt_stats_bump(chat_id: int, user_id: int, name: str, key: str):
-    stats = _ppt_stats_load()
-    c = stats.setdefault(str(chat_id), {})
-    u = c.setdefault(str(user_id), {"name": name or f"ID {user_id}", "wins": 0, "losses": 0, "draws": 0})
+    stats = dict(_ppt_stats_load())
+    c = stats[str(chat_id)] = dict(stats.get(str(chat_id), {}))
+    u = c[str(user_id)] = dict(c.get(str(user_id)) or {"name": name or f"ID {user_id}", "wins": 0, "losses": 0, "draws": 0})
     u["name"] = name or u["name"]
     u[key] = int(u.get(key, 0)) + 1
     _ppt_stats_save(stats)
@@ -1357,11 +2127,17 @@ def _ppt_stats_top(chat_id: int, metric: str = "wins", limit: int = 10) -> str:
 
 
 def _ppt_get_game(chat_id: int, msg_id: int) -> Dict[str, Any] | None:
-    return PPT_GAMES.get(chat_id, {}).get(msg_id)
+    state = PPT_GAMES.get(chat_id, {}).get(msg_id)
+    if state is None:
+        state = _game_snapshot_load("ppt", chat_id, msg_id)
+        if state is not None:
+            PPT_GAMES.setdefault(chat_id, {})[msg_id] = state
+    return state
 
 
 def _ppt_set_game(chat_id: int, msg_id: int, data: Dict[str, Any]) -> None:
     PPT_GAMES.setdefault(chat_id, {})[msg_id] = data
+    _game_snapshot_save("ppt", chat_id, msg_id, data)
 
 
 def _ppt_del_game(chat_id: int, msg_id: int) -> None:
@@ -1369,6 +2145,7 @@ def _ppt_del_game(chat_id: int, msg_id: int) -> None:
         del PPT_GAMES[chat_id][msg_id]
         if not PPT_GAMES[chat_id]:
             del PPT_GAMES[chat_id]
+    _game_snapshot_delete("ppt", chat_id, msg_id)
 
 
 def _ppt_result(choice_a: str, choice_b: str) -> str:
@@ -1413,22 +2190,22 @@ def _ppt_status_text(state: Dict[str, Any]) -> str:
     return "Piedra, papel o tijera"
 
 
-def _ppt_keyboard(chat_id: int, msg_id: int, state: Dict[str, Any]) -> InlineKeyboardMarkup:
+def _ppt_keyboard(state: Dict[str, Any]) -> InlineKeyboardMarkup:
     status = state.get("status", "waiting")
     rows: list[list[InlineKeyboardButton]] = []
     if status == "waiting":
         if state.get("mode") == "open" and not state.get("p2_id"):
-            rows.append([InlineKeyboardButton("Unirme", callback_data=f"ppt:join:{chat_id}:{msg_id}")])
-        rows.append([InlineKeyboardButton("Cancelar", callback_data=f"ppt:cancel:{chat_id}:{msg_id}")])
+            rows.append([InlineKeyboardButton("Unirme", callback_data=cb_encode("ppt", "join"))])
+        rows.append([InlineKeyboardButton("Cancelar", callback_data=cb_encode("ppt", "cancel"))])
     elif status == "choosing":
         rows.append([
-            InlineKeyboardButton(PPT_ROCK, callback_data=f"ppt:play:{chat_id}:{msg_id}:r"),
-            InlineKeyboardButton(PPT_PAPER, callback_data=f"ppt:play:{chat_id}:{msg_id}:p"),
-            InlineKeyboardButton(PPT_SCISSORS, callback_data=f"ppt:play:{chat_id}:{msg_id}:s"),
+            InlineKeyboardButton(PPT_ROCK, callback_data=cb_encode("ppt", "play", "r")),
+            InlineKeyboardButton(PPT_PAPER, callback_data=cb_encode("ppt", "play", "p")),
+            InlineKeyboardButton(PPT_SCISSORS, callback_data=cb_encode("ppt", "play", "s")),
         ])
-        rows.append([InlineKeyboardButton("Cancelar", callback_data=f"ppt:cancel:{chat_id}:{msg_id}")])
+        rows.append([InlineKeyboardButton("Cancelar", callback_data=cb_encode("ppt", "cancel"))])
     elif status == "finished":
-        rows.append([InlineKeyboardButton("Revancha", callback_data=f"ppt:rematch:{chat_id}:{msg_id}")])
+        rows.append([InlineKeyboardButton("Revancha", callback_data=cb_encode("ppt", "rematch"))])
     return InlineKeyboardMarkup(rows)
 
 
@@ -1486,11 +2263,8 @@ async def ppt_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "choices": {},
         "created_ts": time.time(),
     }
-    text = _ppt_status_text(state)
-    sent = await context.bot.send_message(chat_id=chat.id, text=text)
+    sent = await context.bot.send_message(chat_id=chat.id, text=_ppt_status_text(state), reply_markup=_ppt_keyboard(state))
     _ppt_set_game(chat.id, sent.message_id, state)
-    kb = _ppt_keyboard(chat.id, sent.message_id, state)
-    await sent.edit_text(_ppt_status_text(state), reply_markup=kb)
 
 
 async def ppt_join_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, msg_id: int):
@@ -1510,7 +2284,7 @@ async def ppt_join_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_i
     state["status"] = "choosing"
     _ppt_set_game(chat_id, msg_id, state)
     await safe_q_answer(q, "¡Te has unido a la partida!")
-    await q.edit_message_text(_ppt_status_text(state), reply_markup=_ppt_keyboard(chat_id, msg_id, state))
+    await q.edit_message_text(_ppt_status_text(state), reply_markup=_ppt_keyboard(state))
 
 
 async def ppt_cancel_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, msg_id: int):
@@ -1567,7 +2341,7 @@ async def ppt_play_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_i
         _ppt_set_game(chat_id, msg_id, state)
         if p1_id and p2_id:
             _ppt_stats_record(chat_id, p1_id, p1_name, p2_id, p2_name, res)
-        await q.edit_message_text(result_text, reply_markup=_ppt_keyboard(chat_id, msg_id, state))
+        await q.edit_message_text(result_text, reply_markup=_ppt_keyboard(state))
 
 
 async def ppt_rematch_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, msg_id: int):
@@ -1591,19 +2365,14 @@ async def ppt_rematch_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, cha
     }
     _ppt_set_game(chat_id, msg_id, new_state)
     await safe_q_answer(q, "¡Nueva ronda!")
-    await q.edit_message_text(_ppt_status_text(new_state), reply_markup=_ppt_keyboard(chat_id, msg_id, new_state))
+    await q.edit_message_text(_ppt_status_text(new_state), reply_markup=_ppt_keyboard(new_state))
 
 
-async def ppt_router_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def ppt_router_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str = "", choice_code: str = ""):
     q = update.callback_query
-    data = q.data or ""
     try:
-        parts = data.split(":")
-        if parts[0] != "ppt":
-            return await safe_q_answer(q)
-        action = parts[1]
-        chat_id = int(parts[2])
-        msg_id = int(parts[3])
+        chat_id = q.message.chat.id
+        msg_id = q.message.message_id
         if not is_module_enabled(chat_id, "ppt_enabled"):
             return await safe_q_answer(q, "🚫 El módulo PPT está desactivado en este chat.", show_alert=True)
         if action == "join":
@@ -1611,7 +2380,6 @@ async def ppt_router_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if action == "cancel":
             return await ppt_cancel_cb(update, context, chat_id, msg_id)
         if action == "play":
-            choice_code = parts[4]
             return await ppt_play_cb(update, context, chat_id, msg_id, choice_code)
         if action == "rematch":
             return await ppt_rematch_cb(update, context, chat_id, msg_id)
@@ -1634,95 +2402,509 @@ async def ppt_top_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=msg.chat.id, text=_ppt_stats_top(msg.chat.id, metric))
 
 TRIVIA_POOL_FILE = os.path.join(PERSIST_DIR, "pool.json")
-TRIVIA_STATE_FILE = os.path.join(PERSIST_DIR, "trivia_state.json")
-TRIVIA_STATS_FILE = os.path.join(PERSIST_DIR, "trivia_stats.json")
+TRIVIA_BASE_POOL_FILE = os.environ.get("TRIVIA_BASE_POOL", os.path.join(os.path.dirname(os.path.abspath(__file__)), "trivia_pool.json"))
+TRIVIA_BASE_POOL: list[dict] | None = None
+TRIVIA_POOL_JOURNAL_FILE = os.path.join(PERSIST_DIR, "pool_changes.jsonl")
+TRIVIA_POOL_COMPACT_MIN = 500
+POOL_CACHE: list[dict] | None = None
+POOL_INDEX: Dict[str, Any] = {"by_id": {}, "by_hash": {}, "max_id": 0, "journal": 0, "stamp": None, "base": True}
+TRIVIA_STATE_FILE = os.path.join(SHARD_DIR, "trivia_state.json")
+TRIVIA_ACTIVE: Dict[int, str] | None = None
+TRIVIA_OPEN_PERIOD = 300
+TRIVIA_EXPIRY_GRACE = 60
+TRIVIA_STATS_FILE = os.path.join(SHARD_DIR, "trivia_stats.json")
+TRIVIA_QSTATS_FILE = os.path.join(SHARD_DIR, "trivia_qstats.json")
+TRIVIA_QSTATS: Dict[str, Any] | None = None
+TRIVIA_TTC_SAMPLES = 15
+TRIVIA_DIFFICULTY_BANDS = 5
+TRIVIA_SAMPLER_REFRESH = 50
+TRIVIA_SAMPLER: Dict[str, Any] = {"key": None, "valid": [], "prob": [], "alias": [], "cats": {}, "dirty": 0}
+MARATHON_DEFAULT_QUESTIONS = 10
+MARATHON_DEFAULT_SECS = 20
+MARATHON_MAX_QUESTIONS = 50
+MARATHONS: Dict[int, Dict[str, Any]] = {}
+MARATHON_POLLS: Dict[str, int] = {}
 TRIVIA_ADMIN_LOG_FILE = os.path.join(PERSIST_DIR, "trivia_admin_log.json")
+ADMIN_LOG_FILE = os.path.join(PERSIST_DIR, "admin_audit.jsonl")
+ADMIN_LOG_MAX_BYTES = int(os.environ.get("ADMIN_LOG_MAX_BYTES", str(1024 * 1024)))
+ADMIN_LOG_KEEP = 3
 TRIVIA_BACKUP_DIR = os.path.join(PERSIST_DIR, "backups")
+TRIVIA_BACKUP_KEEP = int(os.environ.get("TRIVIA_BACKUP_KEEP", "10"))
+TRIVIA_BACKUP_KEEP_DAYS = int(os.environ.get("TRIVIA_BACKUP_KEEP_DAYS", "7"))
+POOL_BACKUP_RE = re.compile(r"^pool_(?:backup_)?(\d{8}T\d{6})(?:_([0-9a-f]{12}))?\.json(?:\.gz)?$")
+TRIVIA_IMPORT_DIR = os.path.join(PERSIST_DIR, "imports")
+TRIVIA_IMPORT_MAX_BYTES = int(os.environ.get("TRIVIA_IMPORT_MAX_BYTES", str(5 * 1024 * 1024)))
+TRIVIA_IMPORT_MAX_ERRORS = 20
+TRIVIA_STAGE_RE = re.compile(r"^import_(-?\d+)_\d+\.jsonl(?:\.tmp)?$")
 def _ensure_trivia_files() -> None:
     """Crea directorios y ficheros mínimos para Trivia."""
     try:
-        os.makedirs(PERSIST_DIR, exist_ok=True)
+        os.makedirs(SHARD_DIR, exist_ok=True)
         os.makedirs(TRIVIA_BACKUP_DIR, exist_ok=True)
     except Exception:
         logging.exception("❌ Error creando directorios de Trivia")
     def _ensure(path: str, default):
-        if not os.path.exists(path):
+        if not os.path.exists(path) and _shard_legacy(path) is None:
             try:
-                with open(path, "w", encoding="utf-8") as f:
-                    json.dump(default, f, ensure_ascii=False, indent=2)
+                with open(path, "wb") as f:
+                    f.write(json_dumps(default))
             except Exception:
                 logging.exception("❌ Error creando fichero de Trivia: %s", path)
     _ensure(TRIVIA_POOL_FILE, [])
     _ensure(TRIVIA_STATE_FILE, {})
     _ensure(TRIVIA_STATS_FILE, {})
-    _ensure(TRIVIA_ADMIN_LOG_FILE, {"entries": []})
+    _migrate_legacy_admin_log()
 def _load_json_file(path: str, default):
+    pending = persist_pending(path)
+    if pending is not None:
+        payload = pending[0]
+        if payload is None:
+            return default
+        return json_loads(payload) if isinstance(payload, bytes) else payload
     if not os.path.exists(path):
-        return default
+        legacy = _shard_legacy(path)
+        return legacy if legacy is not None else default
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data
+        return json_read(path)
     except Exception:
         logging.exception("❌ Error leyendo JSON: %s", path)
         return default
 def _save_json_file(path: str, data) -> None:
     try:
-        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        persist_json(path, data, mutable=True)
     except Exception:
         logging.exception("❌ Error guardando JSON: %s", path)
+def _pool_norm_text(text) -> str:
+    return " ".join(_strip_accents(str(text or "")).casefold().split())
+def pool_content_hash(q: dict) -> str:
+    """Hash del contenido normalizado (pregunta + opciones) para detectar duplicados sin id."""
+    parts = [_pool_norm_text(q.get("question"))] + [_pool_norm_text(c) for c in q.get("choices") or []]
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()[:16]
+def _pool_rebuild_index(pool: list[dict]) -> None:
+    by_id: dict[int, int] = {}
+    by_hash: dict[str, int] = {}
+    max_id = 0
+    for pos, q in enumerate(pool):
+        if not isinstance(q, dict):
+            continue
+        qid = q.get("id")
+        if isinstance(qid, int):
+            by_id[qid] = pos
+            by_hash.setdefault(pool_content_hash(q), qid)
+            max_id = max(max_id, qid)
+    POOL_INDEX.update(by_id=by_id, by_hash=by_hash, max_id=max_id, journal=0)
+def _pool_put(pool: list[dict], rec: dict) -> None:
+    """Inserta o sustituye (por id) un registro en el pool en memoria manteniendo el índice."""
+    qid = rec["id"]
+    by_id, by_hash = POOL_INDEX["by_id"], POOL_INDEX["by_hash"]
+    pos = by_id.get(qid)
+    if pos is None:
+        by_id[qid] = len(pool)
+        pool.append(rec)
+    else:
+        old_hash = pool_content_hash(pool[pos])
+        if by_hash.get(old_hash) == qid:
+            del by_hash[old_hash]
+        pool[pos] = rec
+    by_hash.setdefault(pool_content_hash(rec), qid)
+    POOL_INDEX["max_id"] = max(POOL_INDEX["max_id"], qid)
+def _pool_stamp() -> tuple:
+    """Huella (mtime, tamaño) de pool.json y su journal: con varios shards, otro proceso puede haberlos cambiado."""
+    out = []
+    for path in (TRIVIA_POOL_FILE, TRIVIA_POOL_JOURNAL_FILE):
+        try:
+            st = os.stat(path)
+            out.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            out.append(None)
+    return tuple(out)
+def load_base_pool() -> list[dict]:
+    """Pool de serie (trivia_pool.json del repo), de solo lectura; se carga una vez y las preguntas inválidas se ignoran."""
+    global TRIVIA_BASE_POOL
+    if TRIVIA_BASE_POOL is None:
+        TRIVIA_BASE_POOL = []
+        raw = _load_json_file(TRIVIA_BASE_POOL_FILE, []) if TRIVIA_BASE_POOL_FILE else []
+        for idx, item in enumerate(raw if isinstance(raw, list) else [], start=1):
+            try:
+                q = _validate_pool_item(item, idx)
+            except ValueError:
+                continue
+            if isinstance(q["id"], int):
+                TRIVIA_BASE_POOL.append(q)
+    return TRIVIA_BASE_POOL
 def load_pool() -> list[dict]:
-    return _load_json_file(TRIVIA_POOL_FILE, [])
-def save_pool(pool: list[dict]) -> None:
-    _save_json_file(TRIVIA_POOL_FILE, pool)
+    """
+    Pool en memoria: el pool de serie como capa base, y encima pool.json más los cambios del journal
+    (a igual id gana la capa persistente). pool.json es {"base": bool, "items": [...]}; una lista plana
+    es un pool anterior al pool de serie y se carga sin capa base, salvo que esté vacía (despliegue nuevo).
+    Las preguntas de serie cuyo contenido ya está en la capa persistente se omiten.
+    """
+    if POOL_CACHE is not None and (SHARDS == 1 or POOL_INDEX["stamp"] == _pool_stamp()):
+        return POOL_CACHE
+    with file_lock(TRIVIA_POOL_JOURNAL_FILE):
+        return _pool_reload()
+def _pool_reload() -> list[dict]:
+    global POOL_CACHE
+    if POOL_CACHE is not None and (SHARDS == 1 or POOL_INDEX["stamp"] == _pool_stamp()):
+        return POOL_CACHE
+    raw = _load_json_file(TRIVIA_POOL_FILE, [])
+    if isinstance(raw, dict):
+        use_base = raw.get("base", True) is not False
+        raw = raw.get("items")
+    else:
+        use_base = not raw
+    if not isinstance(raw, list):
+        raw = []
+    pool = []
+    if use_base:
+        seen = {pool_content_hash(rec) for rec in raw if isinstance(rec, dict)}
+        pool = [q for q in load_base_pool() if pool_content_hash(q) not in seen]
+    _pool_rebuild_index(pool)
+    POOL_INDEX["base"] = use_base
+    for rec in raw:
+        if isinstance(rec, dict) and isinstance(rec.get("id"), int):
+            _pool_put(pool, rec)
+    replayed = 0
+    if os.path.exists(TRIVIA_POOL_JOURNAL_FILE):
+        try:
+            with open(TRIVIA_POOL_JOURNAL_FILE, "rb") as f:
+                for line in f:
+                    try:
+                        rec = json_loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(rec, dict) and isinstance(rec.get("id"), int):
+                        _pool_put(pool, rec)
+                        replayed += 1
+        except Exception:
+            logging.exception("❌ Error leyendo journal del pool")
+    POOL_INDEX["journal"] = replayed
+    POOL_INDEX["stamp"] = _pool_stamp()
+    POOL_CACHE = pool
+    return pool
+def save_pool(pool: list[dict], base: bool | None = None) -> bool:
+    """
+    Reescribe pool.json y vacía el journal. Solo se guarda la capa persistente: las preguntas que siguen
+    siendo las del pool de serie no se copian. base=False deja fuera la capa base (replace/restore);
+    None mantiene lo que hubiera. Espera al hilo escritor, así que desde un handler se llama con
+    asyncio.to_thread. Si pool.json no llega a disco se conserva el journal y devuelve False.
+    """
+    with file_lock(TRIVIA_POOL_JOURNAL_FILE):
+        return _save_pool_locked(pool, base)
+def _save_pool_locked(pool: list[dict], base: bool | None) -> bool:
+    global POOL_CACHE
+    if base is None:
+        base = POOL_INDEX["base"]
+    if base:
+        base_by_id = {q["id"]: q for q in load_base_pool()}
+        overlay = [q for q in pool if not (isinstance(q, dict) and base_by_id.get(q.get("id")) is q)]
+    else:
+        overlay = pool
+    try:
+        persist_json(TRIVIA_POOL_FILE, {"base": bool(base), "items": overlay}, mutable=True)
+        saved = writer_flush(TRIVIA_POOL_FILE) and TRIVIA_POOL_FILE not in WRITER_ERRORS
+    except Exception:
+        logging.exception("❌ Error guardando JSON: %s", TRIVIA_POOL_FILE)
+        saved = False
+    if not saved:
+        logging.error("❌ pool.json no se ha guardado; se conserva el journal del pool")
+        POOL_CACHE = None
+        return False
+    try:
+        if os.path.exists(TRIVIA_POOL_JOURNAL_FILE):
+            os.remove(TRIVIA_POOL_JOURNAL_FILE)
+    except Exception:
+        logging.exception("❌ Error vaciando journal del pool")
+    POOL_CACHE = pool
+    _pool_rebuild_index(pool)
+    POOL_INDEX["base"] = base
+    POOL_INDEX["stamp"] = _pool_stamp()
+    return True
+def merge_into_pool(incoming) -> tuple[int, int, int]:
+    """
+    Fusiona preguntas en el pool en O(len(incoming)) usando el índice por id y por hash de contenido.
+    Solo los registros nuevos o modificados se añaden al journal. Devuelve (añadidas, actualizadas, duplicadas).
+    Puede compactar el pool (save_pool), así que desde un handler se llama con asyncio.to_thread.
+    """
+    with file_lock(TRIVIA_POOL_JOURNAL_FILE):
+        return _merge_into_pool_locked(incoming)
+def _merge_into_pool_locked(incoming) -> tuple[int, int, int]:
+    pool = load_pool()
+    by_id, by_hash = POOL_INDEX["by_id"], POOL_INDEX["by_hash"]
+    changed: list[dict] = []
+    added = updated = duplicates = 0
+    for q in incoming:
+        rec = {"id": None, "question": q["question"], "choices": q["choices"], "answer": q["answer"]}
+        rec.update((k, q[k]) for k in ("category", "tags") if k in q)
+        qid = q.get("id")
+        if not (isinstance(qid, int) and qid in by_id):
+            qid = by_hash.get(pool_content_hash(rec))
+        if qid is None:
+            qid = POOL_INDEX["max_id"] + 1
+            added += 1
+        else:
+            cur = pool[by_id[qid]]
+            if all(cur.get(k) == rec.get(k) for k in ("question", "choices", "answer", "category", "tags")):
+                duplicates += 1
+                continue
+            updated += 1
+        rec["id"] = qid
+        _pool_put(pool, rec)
+        changed.append(rec)
+    if not changed:
+        return added, updated, duplicates
+    POOL_INDEX["journal"] += len(changed)
+    if POOL_INDEX["journal"] > max(TRIVIA_POOL_COMPACT_MIN, len(pool) // 2) and save_pool(pool):
+        return added, updated, duplicates
+    try:
+        with open(TRIVIA_POOL_JOURNAL_FILE, "ab") as f:
+            for rec in changed:
+                f.write(json_dumps(rec) + b"\n")
+        POOL_INDEX["stamp"] = _pool_stamp()
+    except Exception:
+        logging.exception("❌ Error escribiendo journal del pool")
+        save_pool(pool)
+    return added, updated, duplicates
+def list_pool_backups() -> list[dict]:
+    """Backups del pool (gzip y antiguos .json) del más reciente al más antiguo."""
+    try:
+        names = os.listdir(TRIVIA_BACKUP_DIR)
+    except FileNotFoundError:
+        return []
+    out = []
+    for name in names:
+        m = POOL_BACKUP_RE.match(name)
+        if not m:
+            continue
+        path = os.path.join(TRIVIA_BACKUP_DIR, name)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        out.append({"name": name, "path": path, "ts": m.group(1), "hash": m.group(2), "size": size})
+    out.sort(key=lambda b: (b["ts"], b["name"]), reverse=True)
+    return out
+def _prune_pool_backups(backups: list[dict]) -> None:
+    """Conserva los TRIVIA_BACKUP_KEEP más recientes y el último de cada uno de los TRIVIA_BACKUP_KEEP_DAYS días."""
+    keep = {b["name"] for b in backups[:TRIVIA_BACKUP_KEEP]}
+    days: set[str] = set()
+    for b in backups:
+        day = b["ts"][:8]
+        if day not in days and len(days) < TRIVIA_BACKUP_KEEP_DAYS:
+            days.add(day)
+            keep.add(b["name"])
+    for b in backups:
+        if b["name"] in keep:
+            continue
+        try:
+            os.remove(b["path"])
+        except OSError:
+            logging.exception("❌ Error borrando backup antiguo: %s", b["path"])
 def backup_pool() -> str | None:
-    """Crea un backup timestamped del pool y devuelve la ruta."""
+    """
+    Crea un backup gzip del pool y devuelve la ruta. Si el pool no ha cambiado
+    desde el último backup (mismo hash de contenido) reutiliza ese fichero.
+    """
     try:
-        os.makedirs(TRIVIA_BACKUP_DIR, exist_ok=True)
-        ts = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
-        dest = os.path.join(TRIVIA_BACKUP_DIR, f"pool_backup_{ts}.json")
-        src_data = load_pool()
-        _save_json_file(dest, src_data)
-        return dest
+        with file_lock(TRIVIA_BACKUP_DIR):
+            return _backup_pool_locked()
     except Exception:
         logging.exception("❌ Error creando backup de pool")
         return None
+def _backup_pool_locked() -> str:
+    os.makedirs(TRIVIA_BACKUP_DIR, exist_ok=True)
+    raw = json_dumps(load_pool())
+    digest = hashlib.sha1(raw).hexdigest()[:12]
+    backups = list_pool_backups()
+    if backups and backups[0]["hash"] == digest:
+        return backups[0]["path"]
+    ts = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    name = f"pool_{ts}_{digest}.json.gz"
+    dest = os.path.join(TRIVIA_BACKUP_DIR, name)
+    with gzip.open(dest + ".tmp", "wb") as f:
+        f.write(raw)
+    os.replace(dest + ".tmp", dest)
+    _prune_pool_backups([{"name": name, "path": dest, "ts": ts, "hash": digest, "size": 0}] + backups)
+    return dest
+def load_pool_backup(path: str) -> list[dict]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        pool = _validate_pool_list(json_loads(f.read()))
+    next_id = max((q["id"] for q in pool if isinstance(q["id"], int)), default=0)
+    for q in pool:
+        if q["id"] is None:
+            next_id += 1
+            q["id"] = next_id
+    return pool
+def _validate_pool_item(item, idx: int) -> dict:
+    """Valida y normaliza una pregunta de Trivia; lanza ValueError con el motivo."""
+    if not isinstance(item, dict):
+        raise ValueError(f"Pregunta #{idx}: debe ser un objeto JSON válido.")
+    q = item.get("question")
+    choices = item.get("choices")
+    ans = item.get("answer")
+    qid = item.get("id")
+    if not isinstance(q, str) or not q.strip():
+        raise ValueError(f"Pregunta #{idx}: campo 'question' inválido o vacío.")
+    if not isinstance(choices, list) or len(choices) < 2:
+        raise ValueError(f"Pregunta #{idx}: 'choices' debe ser una lista con mínimo 2 opciones.")
+    clean_choices: list[str] = []
+    for c in choices:
+        if not isinstance(c, str) or not c.strip():
+            raise ValueError(f"Pregunta #{idx}: una de las opciones está vacía o no es texto.")
+        clean_choices.append(c.strip())
+    if not isinstance(ans, int) or not (0 <= ans < len(clean_choices)):
+        raise ValueError(f"Pregunta #{idx}: 'answer' debe ser un índice entero válido.")
+    if qid is not None and not isinstance(qid, int):
+        raise ValueError(f"Pregunta #{idx}: el campo 'id' debe ser un entero o no estar presente.")
+    out = {
+        "id": qid,
+        "question": q.strip(),
+        "choices": clean_choices,
+        "answer": ans,
+    }
+    category = item.get("category")
+    tags = item.get("tags")
+    if category is not None:
+        if not isinstance(category, str) or not category.strip():
+            raise ValueError(f"Pregunta #{idx}: 'category' debe ser un texto no vacío.")
+        out["category"] = category.strip()
+    if tags is not None:
+        if not isinstance(tags, list) or not all(isinstance(t, str) and t.strip() for t in tags):
+            raise ValueError(f"Pregunta #{idx}: 'tags' debe ser una lista de textos.")
+        out["tags"] = [t.strip() for t in tags]
+    return out
+def pool_categories(q: dict) -> list[str]:
+    """Claves de categoría normalizadas de una pregunta: su 'category' más sus 'tags'."""
+    cats = [q["category"]] if isinstance(q.get("category"), str) else []
+    cats += [t for t in q.get("tags") or [] if isinstance(t, str)]
+    return list(dict.fromkeys(_pool_norm_text(c) for c in cats if c.strip()))
 def _validate_pool_list(raw) -> list[dict]:
     """Valida y normaliza una lista de preguntas de Trivia."""
     if not isinstance(raw, list):
         raise ValueError("El JSON importado debe ser una lista de preguntas.")
-    norm: list[dict] = []
-    for idx, item in enumerate(raw, start=1):
-        if not isinstance(item, dict):
-            raise ValueError(f"Pregunta #{idx}: debe ser un objeto JSON válido.")
-        q = item.get("question")
-        choices = item.get("choices")
-        ans = item.get("answer")
-        qid = item.get("id")
-        if not isinstance(q, str) or not q.strip():
-            raise ValueError(f"Pregunta #{idx}: campo 'question' inválido o vacío.")
-        if not isinstance(choices, list) or len(choices) < 2:
-            raise ValueError(f"Pregunta #{idx}: 'choices' debe ser una lista con mínimo 2 opciones.")
-        clean_choices: list[str] = []
-        for c in choices:
-            if not isinstance(c, str) or not c.strip():
-                raise ValueError(f"Pregunta #{idx}: una de las opciones está vacía o no es texto.")
-            clean_choices.append(c.strip())
-        if not isinstance(ans, int) or not (0 <= ans < len(clean_choices)):
-            raise ValueError(f"Pregunta #{idx}: 'answer' debe ser un índice entero válido.")
-        if qid is not None and not isinstance(qid, int):
-            raise ValueError(f"Pregunta #{idx}: el campo 'id' debe ser un entero o no estar presente.")
-        norm.append({
-            "id": qid,
-            "question": q.strip(),
-            "choices": clean_choices,
-            "answer": ans,
-        })
-    return norm
+    return [_validate_pool_item(item, idx) for idx, item in enumerate(raw, start=1)]
+async def _download_text_chunks(url: str, max_bytes: int):
+    """Descarga url en streaming y va entregando texto; aborta si supera max_bytes."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    total = 0
+    async with httpx.AsyncClient(timeout=20, follow_redirects=True) as client:
+        async with client.stream("GET", url) as resp:
+            resp.raise_for_status()
+            declared = resp.headers.get("content-length", "")
+            if declared.isdigit() and int(declared) > max_bytes:
+                raise ValueError(f"El fichero supera el límite de {max_bytes // 1024} KB.")
+            async for raw in resp.aiter_bytes():
+                total += len(raw)
+                if total > max_bytes:
+                    raise ValueError(f"El fichero supera el límite de {max_bytes // 1024} KB.")
+                yield decoder.decode(raw)
+    yield decoder.decode(b"", final=True)
+async def _iter_json_array(chunks):
+    """Entrega los elementos de un array JSON de nivel superior a medida que llegan completos."""
+    decoder = json.JSONDecoder()
+    buf, pos = "", 0
+    started = done = False
+    expect = "first"  # first: elemento o "]"; value: elemento; sep: "," o "]"
+    async for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos >= len(buf):
+                break
+            ch = buf[pos]
+            if not started:
+                if ch != "[":
+                    raise ValueError("El JSON importado debe ser una lista de preguntas.")
+                started = True
+                pos += 1
+                continue
+            if done:
+                raise ValueError("Contenido inesperado tras el final de la lista.")
+            if ch == "]":
+                if expect == "value":
+                    raise ValueError("Coma sobrante antes del cierre de la lista.")
+                done = True
+                pos += 1
+                continue
+            if ch == ",":
+                if expect != "sep":
+                    raise ValueError("Coma inesperada en la lista (falta un elemento).")
+                expect = "value"
+                pos += 1
+                continue
+            if expect == "sep":
+                raise ValueError(f"Falta una coma entre elementos cerca de: {buf[pos:pos + 40]!r}")
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break
+            if end == len(buf) and not isinstance(item, (dict, list, str)):
+                break
+            yield item
+            pos = end
+            expect = "sep"
+    rest = buf[pos:].strip()
+    if rest:
+        raise ValueError(f"JSON inválido cerca de: {rest[:40]!r}")
+    if not started:
+        raise ValueError("El JSON importado está vacío.")
+    if not done:
+        raise ValueError("JSON incompleto: falta el cierre de la lista.")
+def _trivia_stage_path(chat_id: int, user_id: int) -> str:
+    return os.path.join(TRIVIA_IMPORT_DIR, f"import_{chat_id}_{user_id}.jsonl")
+def prune_staged_imports() -> None:
+    """
+    Borra las importaciones preparadas que quedaron en disco de una ejecución anterior: la importación
+    pendiente vive en user_data (memoria), así que tras reiniciar ya nadie puede confirmarlas.
+    En un worker solo toca las de los chats de su shard.
+    """
+    if not os.path.isdir(TRIVIA_IMPORT_DIR):
+        return
+    try:
+        with os.scandir(TRIVIA_IMPORT_DIR) as it:
+            for entry in it:
+                m = TRIVIA_STAGE_RE.match(entry.name)
+                if not m or not entry.is_file():
+                    continue
+                if SHARD_INDEX >= 0 and shard_of(int(m.group(1))) != SHARD_INDEX:
+                    continue
+                _discard_staged_import(entry.path)
+    except Exception:
+        logging.exception("❌ Error limpiando importaciones preparadas")
+def _read_staged_import(path: str):
+    """Lee una importación preparada en disco (una pregunta por línea)."""
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json_loads(line)
+def _discard_staged_import(path: str | None) -> None:
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        logging.exception("❌ Error borrando importación preparada: %s", path)
 def load_trivia_state() -> dict:
     return _load_json_file(TRIVIA_STATE_FILE, {})
+def trivia_active_rounds() -> Dict[int, str]:
+    """Índice chat_id -> poll_id de las rondas abiertas; se construye una vez desde el estado y se mantiene al abrir/cerrar rondas."""
+    global TRIVIA_ACTIVE
+    if TRIVIA_ACTIVE is None:
+        TRIVIA_ACTIVE = {}
+        for pid, info in load_trivia_state().items():
+            if isinstance(info, dict) and isinstance(info.get("chat_id"), int) and not info.get("finished"):
+                TRIVIA_ACTIVE[info["chat_id"]] = pid
+    return TRIVIA_ACTIVE
+def trivia_round_closed(chat_id: Any, poll_id: str) -> None:
+    active = trivia_active_rounds()
+    if active.get(chat_id) == poll_id:
+        del active[chat_id]
 def save_trivia_state(state: dict) -> None:
     _save_json_file(TRIVIA_STATE_FILE, state)
 def load_trivia_stats() -> dict:
@@ -1730,24 +2912,228 @@ def load_trivia_stats() -> dict:
 def save_trivia_stats(stats: dict) -> None:
     _save_json_file(TRIVIA_STATS_FILE, stats)
 def trivia_add_point(chat_id: int, user_id: int, name: str):
+    trivia_add_points(chat_id, {user_id: (name, 1)})
+def trivia_add_points(chat_id: int, points: Dict[int, tuple[str, int]]) -> None:
+    """Suma puntos a varios usuarios del chat con una sola escritura. `points` = {user_id: (nombre, puntos)}."""
     stats = load_trivia_stats()
     chat_stats = stats.setdefault(str(chat_id), {})
-    entry = chat_stats.setdefault(str(user_id), {"name": name, "points": 0})
-    entry["name"] = name
-    entry["points"] += 1
+    for user_id, (name, pts) in points.items():
+        entry = chat_stats.setdefault(str(user_id), {"name": name, "points": 0})
+        entry["name"] = name
+        entry["points"] += pts
     save_trivia_stats(stats)
-def log_admin_action(action: str, admin_id: int, detail: dict) -> None:
-    log = _load_json_file(TRIVIA_ADMIN_LOG_FILE, {"entries": []})
-    if "entries" not in log or not isinstance(log["entries"], list):
-        log = {"entries": []}
+def _trivia_qkey(q: dict) -> str:
+    qid = q.get("id")
+    if qid is not None:
+        return f"id:{qid}"
+    return f"q:{q.get('question')}"
+def load_trivia_qstats() -> dict:
+    global TRIVIA_QSTATS
+    if TRIVIA_QSTATS is None:
+        data = _load_json_file(TRIVIA_QSTATS_FILE, {})
+        TRIVIA_QSTATS = data if isinstance(data, dict) else {}
+    return TRIVIA_QSTATS
+def trivia_record_round(info: dict, save: bool = True) -> None:
+    """
+    Suma una ronda cerrada a los agregados de su pregunta: intentos, aciertos, rondas con ganador y
+    mediana del tiempo hasta el primer acierto (sobre las últimas TRIVIA_TTC_SAMPLES rondas ganadas).
+    """
+    key = info.get("qkey") or (f"id:{info['question_id']}" if info.get("question_id") is not None else None)
+    correct_index = (info.get("question_snapshot") or {}).get("answer")
+    if not key or not isinstance(correct_index, int):
+        return
+    stats = load_trivia_qstats()
+    rec = stats.setdefault(key, {"rounds": 0, "won": 0, "attempts": 0, "correct": 0, "ttc": [], "ttc_med": None})
+    answers = info.get("answers") or {}
+    rec["rounds"] += 1
+    rec["attempts"] += len(answers)
+    rec["correct"] += sum(1 for a in answers.values() if a.get("choice_index") == correct_index)
+    winner = info.get("winner")
+    if winner is not None:
+        rec["won"] += 1
+        try:
+            started = datetime.fromisoformat(info["started_at"])
+            answered = datetime.fromisoformat(answers[str(winner)]["answered_at"])
+            rec["ttc"] = (rec["ttc"] + [round((answered - started).total_seconds(), 1)])[-TRIVIA_TTC_SAMPLES:]
+            rec["ttc_med"] = sorted(rec["ttc"])[len(rec["ttc"]) // 2]
+        except (KeyError, TypeError, ValueError):
+            pass
+    TRIVIA_SAMPLER["dirty"] += 1
+    if save:
+        _save_json_file(TRIVIA_QSTATS_FILE, stats)
+def _trivia_difficulty(rec: dict | None) -> float:
+    """Dificultad en [0, 1]: tasa de fallo con prior de Laplace, así las preguntas nuevas quedan en el medio."""
+    if not rec:
+        return 0.5
+    return 1.0 - (rec.get("correct", 0) + 1) / (rec.get("attempts", 0) + 2)
+def _alias_table(weights: list[float]) -> tuple[list[float], list[int]]:
+    """Tabla de alias de Vose para muestrear índices con probabilidad proporcional a `weights` en O(1)."""
+    n = len(weights)
+    total = sum(weights) or 1.0
+    prob = [w * n / total for w in weights]
+    alias = list(range(n))
+    small = [i for i, p in enumerate(prob) if p < 1.0]
+    large = [i for i, p in enumerate(prob) if p >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        alias[s] = l
+        prob[l] -= 1.0 - prob[s]
+        (small if prob[l] < 1.0 else large).append(l)
+    for i in small + large:
+        prob[i] = 1.0
+    return prob, alias
+def _trivia_band_weights(bands: list[int]) -> list[float]:
+    band_size = collections.Counter(bands)
+    return [1.0 / band_size[b] for b in bands]
+def _trivia_build_sampler(valid: list[dict]) -> None:
+    """
+    Tablas de alias (Vose) sobre las preguntas válidas: una global y una por categoría, con el array de
+    posiciones de cada categoría. Cada pregunta pesa 1/(tamaño de su franja de dificultad dentro de la
+    tabla), de modo que todas las franjas salen con la misma probabilidad y los chats reciben mezcla.
+    """
+    stats = load_trivia_qstats()
+    bands = [min(TRIVIA_DIFFICULTY_BANDS - 1, int(_trivia_difficulty(stats.get(_trivia_qkey(q))) * TRIVIA_DIFFICULTY_BANDS)) for q in valid]
+    prob, alias = _alias_table(_trivia_band_weights(bands))
+    by_cat: Dict[str, list[int]] = {}
+    for pos, q in enumerate(valid):
+        for cat in pool_categories(q):
+            by_cat.setdefault(cat, []).append(pos)
+    cats = {}
+    for cat, positions in by_cat.items():
+        cprob, calias = _alias_table(_trivia_band_weights([bands[p] for p in positions]))
+        cats[cat] = (positions, cprob, calias)
+    TRIVIA_SAMPLER.update(valid=valid, prob=prob, alias=alias, cats=cats, dirty=0)
+def trivia_sampler() -> list[dict]:
+    """Preguntas válidas del pool con su tabla de alias al día; se reconstruye al cambiar el pool o tras TRIVIA_SAMPLER_REFRESH rondas."""
+    pool = load_pool()
+    key = (id(pool), len(pool), POOL_INDEX["stamp"])
+    if TRIVIA_SAMPLER["key"] != key or TRIVIA_SAMPLER["dirty"] >= TRIVIA_SAMPLER_REFRESH:
+        valid = [q for q in pool if isinstance(q, dict) and q.get("question") and isinstance(q.get("choices"), list)]
+        _trivia_build_sampler(valid)
+        TRIVIA_SAMPLER["key"] = key
+    return TRIVIA_SAMPLER["valid"]
+def trivia_chat_categories(chat_id: int) -> list[str]:
+    """Categorías del filtro del chat que existen en el pool actual (vacío = sin filtro)."""
+    cats = TRIVIA_SAMPLER["cats"]
+    return [c for c in get_chat_settings(chat_id).get("trivia_categories") or [] if c in cats]
+def trivia_sample(cats: list[str] | None = None) -> dict:
+    """
+    Una pregunta con la distribución de la tabla de alias: O(1). Con `cats`, primero se elige una de
+    esas categorías en proporción a su tamaño y luego se muestrea en su tabla, sin copiar el pool.
+    """
+    positions = None
+    prob, alias = TRIVIA_SAMPLER["prob"], TRIVIA_SAMPLER["alias"]
+    if cats:
+        tables = [TRIVIA_SAMPLER["cats"][c] for c in cats]
+        r = random.randrange(sum(len(t[0]) for t in tables))
+        for positions, prob, alias in tables:
+            if r < len(positions):
+                break
+            r -= len(positions)
+    i = random.randrange(len(prob))
+    if random.random() >= prob[i]:
+        i = alias[i]
+    return TRIVIA_SAMPLER["valid"][positions[i] if positions is not None else i]
+def _migrate_legacy_admin_log() -> None:
+    """Pasa las entradas del antiguo trivia_admin_log.json al log de auditoría JSONL (una sola vez)."""
+    if not os.path.exists(TRIVIA_ADMIN_LOG_FILE) or os.path.exists(ADMIN_LOG_FILE):
+        return
+    try:
+        with file_lock(ADMIN_LOG_FILE):
+            if not os.path.exists(TRIVIA_ADMIN_LOG_FILE) or os.path.exists(ADMIN_LOG_FILE):
+                return
+            log = _load_json_file(TRIVIA_ADMIN_LOG_FILE, {"entries": []})
+            entries = log.get("entries") if isinstance(log, dict) else None
+            with open(ADMIN_LOG_FILE, "ab") as f:
+                for entry in entries if isinstance(entries, list) else []:
+                    f.write(json_dumps(entry) + b"\n")
+            os.replace(TRIVIA_ADMIN_LOG_FILE, TRIVIA_ADMIN_LOG_FILE + ".migrated")
+    except Exception:
+        logging.exception("❌ Error migrando el log de administración")
+def _rotate_admin_log() -> None:
+    for i in range(ADMIN_LOG_KEEP - 1, 0, -1):
+        src = f"{ADMIN_LOG_FILE}.{i}"
+        if os.path.exists(src):
+            os.replace(src, f"{ADMIN_LOG_FILE}.{i + 1}")
+    os.replace(ADMIN_LOG_FILE, f"{ADMIN_LOG_FILE}.1")
+def log_admin_action(action: str, admin_id: int, detail: dict, chat_id: int | None = None) -> None:
+    """Añade una entrada al log de auditoría (JSONL, solo append) y rota por tamaño, con file_lock entre shards."""
     entry = {
         "ts": datetime.utcnow().isoformat(),
         "admin_id": admin_id,
         "accion": action,
         "detalle": detail,
     }
-    log["entries"].append(entry)
-    _save_json_file(TRIVIA_ADMIN_LOG_FILE, log)
+    if chat_id is not None:
+        entry["chat_id"] = chat_id
+    try:
+        with file_lock(ADMIN_LOG_FILE):
+            with open(ADMIN_LOG_FILE, "ab") as f:
+                f.write(json_dumps(entry) + b"\n")
+                size = f.tell()
+            if size > ADMIN_LOG_MAX_BYTES:
+                _rotate_admin_log()
+    except Exception:
+        logging.exception("❌ Error escribiendo log de administración")
+def _iter_lines_reversed(path: str, block: int = 8192):
+    """Recorre las líneas de un fichero desde el final sin cargarlo entero."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        rest = b""
+        while pos > 0:
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + rest).split(b"\n")
+            rest = lines[0]
+            for line in reversed(lines[1:]):
+                if line.strip():
+                    yield line
+        if rest.strip():
+            yield rest
+def read_admin_log(limit: int, chat_id: int | None = None) -> list[dict]:
+    """Últimas entradas del log (más reciente primero), opcionalmente de un chat y las globales."""
+    out: list[dict] = []
+    paths = [ADMIN_LOG_FILE] + [f"{ADMIN_LOG_FILE}.{i}" for i in range(1, ADMIN_LOG_KEEP + 1)]
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        for line in _iter_lines_reversed(path):
+            try:
+                entry = json_loads(line)
+            except ValueError:
+                continue
+            if chat_id is not None and entry.get("chat_id", chat_id) != chat_id:
+                continue
+            out.append(entry)
+            if len(out) >= limit:
+                return out
+    return out
+async def audit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin: muestra las últimas acciones de administración de este chat (/audit [n])."""
+    msg = update.message
+    if not msg or not msg.from_user:
+        return
+    chat = msg.chat
+    if not await is_admin(context, chat.id, msg.from_user.id):
+        return await msg.reply_text("🛡️ Este comando solo pueden usarlo administradores.")
+    limit = 10
+    if context.args and context.args[0].isdigit():
+        limit = max(1, min(50, int(context.args[0])))
+    entries = read_admin_log(limit, chat_id=chat.id)
+    if not entries:
+        return await msg.reply_text("ℹ️ No hay acciones registradas.")
+    lines = [f"📋 <b>Últimas {len(entries)} acciones de administración</b>"]
+    for e in entries:
+        when = str(e.get("ts", ""))[:19].replace("T", " ")
+        detalle = json.dumps(e.get("detalle") or {}, ensure_ascii=False, separators=(",", ":"))
+        if len(detalle) > 120:
+            detalle = detalle[:117] + "…"
+        lines.append(
+            f"• <code>{when}</code> {e.get('admin_id')} — <b>{html.escape(str(e.get('accion')))}</b> {html.escape(detalle, quote=False)}"
+        )
+    await msg.reply_text("\n".join(lines), parse_mode="HTML", disable_web_page_preview=True)
 async def trivia_import_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Importa preguntas de Trivia desde una URL (merge|replace)."""
     msg = update.message
@@ -1768,61 +3154,73 @@ async def trivia_import_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if mode not in {"merge", "replace"}:
         await msg.reply_text("⚠️ Modo inválido. Usa 'merge' o 'replace'.")
         return
+    path = _trivia_stage_path(chat.id, user.id)
+    tmp = path + ".tmp"
+    count = 0
+    invalid = 0
+    errors: list[str] = []
     try:
-        import urllib.request
-        with urllib.request.urlopen(url, timeout=20) as resp:
-            raw_data = resp.read().decode("utf-8")
-        data = json.loads(raw_data)
+        os.makedirs(TRIVIA_IMPORT_DIR, exist_ok=True)
+        with open(tmp, "wb") as out:
+            idx = 0
+            async for item in _iter_json_array(_download_text_chunks(url, TRIVIA_IMPORT_MAX_BYTES)):
+                idx += 1
+                try:
+                    pregunta = _validate_pool_item(item, idx)
+                except ValueError as e:
+                    invalid += 1
+                    if len(errors) < TRIVIA_IMPORT_MAX_ERRORS:
+                        errors.append(str(e))
+                    continue
+                out.write(json_dumps(pregunta) + b"\n")
+                count += 1
+        os.replace(tmp, path)
     except Exception as e:
+        _discard_staged_import(tmp)
         logging.exception("❌ Error descargando/importando trivia")
         await msg.reply_text(f"❌ Error al descargar o parsear el JSON: {e}")
         return
-    try:
-        preguntas = _validate_pool_list(data)
-    except Exception as e:
-        await msg.reply_text(f"❌ Error de validación del pool: {e}")
+    if not count:
+        _discard_staged_import(path)
+        detalle = "\n".join(errors[:5])
+        await msg.reply_text(f"❌ Error de validación del pool: ninguna pregunta válida.\n{detalle}".strip())
         return
-    count = len(preguntas)
+    old_pending = context.user_data.get("pending_trivia_import") or {}
+    if old_pending.get("path") not in (None, path):
+        _discard_staged_import(old_pending.get("path"))
     context.user_data["pending_trivia_import"] = {
         "chat_id": chat.id,
         "mode": mode,
         "url": url,
-        "preguntas": preguntas,
+        "path": path,
         "count": count,
+        "invalid": invalid,
         "initiator_id": user.id,
     }
     kb = InlineKeyboardMarkup([
         [
             InlineKeyboardButton(
                 "✅ Confirmar importación",
-                callback_data=f"triviaimport:{chat.id}:yes:{mode}:{user.id}",
+                callback_data=cb_encode("triviaimport", "yes", mode, user.id),
             ),
         ],
         [
             InlineKeyboardButton(
                 "❌ Cancelar",
-                callback_data=f"triviaimport:{chat.id}:no:0:{user.id}",
+                callback_data=cb_encode("triviaimport", "no", mode, user.id),
             ),
         ],
     ])
-    await msg.reply_text(
-        f"ℹ️ Se han cargado {count} preguntas desde la URL.\\n"
-        f"Modo: {mode.upper()}.\\n\\n"
-        "Pulsa “Confirmar importación” para aplicar los cambios.",
-        reply_markup=kb,
-    )
-async def trivia_import_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    txt = f"ℹ️ Se han cargado {count} preguntas desde la URL.\nModo: {mode.upper()}.\n"
+    if invalid:
+        txt += f"⚠️ Se han descartado {invalid} preguntas inválidas:\n" + "\n".join(errors[:5]) + "\n"
+    txt += "\nPulsa “Confirmar importación” para aplicar los cambios."
+    await msg.reply_text(txt, reply_markup=kb)
+async def trivia_import_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE, decision: str = "", mode: str = "", initiator_id: int = 0):
     """Callback de confirmación/cancelación de importación de Trivia."""
     query = update.callback_query
-    if not query or not query.data:
-        return
-    parts = query.data.split(":")
-    if len(parts) != 5 or parts[0] != "triviaimport":
+    if not query:
         return
-    _chat_id = int(parts[1])
-    decision = parts[2]
-    mode = parts[3]
-    initiator_id = int(parts[4])
     user = query.from_user
     msg_chat = query.message.chat if query.message else None
     if not user or not msg_chat:
@@ -1837,70 +3235,58 @@ async def trivia_import_confirm_cb(update: Update, context: ContextTypes.DEFAULT
         return
     if decision == "no":
         context.user_data.pop("pending_trivia_import", None)
+        _discard_staged_import(pending.get("path"))
         await safe_q_answer(query, "❌ Importación cancelada.")
         try:
             await query.edit_message_reply_markup(reply_markup=None)
         except Exception:
             pass
         return
-    preguntas = pending["preguntas"]
+    if not os.path.exists(pending.get("path") or ""):
+        context.user_data.pop("pending_trivia_import", None)
+        await safe_q_answer(query, "⚠️ La importación preparada ya no está disponible.", show_alert=True)
+        return
     url = pending["url"]
     mode = pending["mode"]
     count = pending["count"]
-    old_pool = load_pool()
     backup_path = backup_pool()
-    new_pool: list[dict] = []
+    duplicates = 0
     if mode == "replace":
-        for i, q in enumerate(preguntas, start=1):
-            new_pool.append({
-                "id": i,
+        new_pool: list[dict] = []
+        seen: set[str] = set()
+        for q in _read_staged_import(pending["path"]):
+            h = pool_content_hash(q)
+            if h in seen:
+                duplicates += 1
+                continue
+            seen.add(h)
+            rec = {
+                "id": len(new_pool) + 1,
                 "question": q["question"],
                 "choices": q["choices"],
                 "answer": q["answer"],
-            })
+            }
+            rec.update((k, q[k]) for k in ("category", "tags") if k in q)
+            new_pool.append(rec)
+        if not await asyncio.to_thread(save_pool, new_pool, False):
+            await safe_q_answer(query, "❌ No se pudo guardar el pool en disco; revisa los logs.", show_alert=True)
+            return
         added = len(new_pool)
         updated = 0
     else:
-        by_id: dict[int, dict] = {}
-        max_id = 0
-        for q in old_pool:
-            qid = q.get("id")
-            if isinstance(qid, int):
-                by_id[qid] = q
-                if qid > max_id:
-                    max_id = qid
-        added = 0
-        updated = 0
-        for q in preguntas:
-            qid = q.get("id")
-            if isinstance(qid, int) and qid in by_id:
-                by_id[qid] = {
-                    "id": qid,
-                    "question": q["question"],
-                    "choices": q["choices"],
-                    "answer": q["answer"],
-                }
-                updated += 1
-            else:
-                max_id += 1
-                by_id[max_id] = {
-                    "id": max_id,
-                    "question": q["question"],
-                    "choices": q["choices"],
-                    "answer": q["answer"],
-                }
-                added += 1
-        new_pool = [by_id[k] for k in sorted(by_id.keys())]
-    save_pool(new_pool)
+        added, updated, duplicates = await asyncio.to_thread(merge_into_pool, _read_staged_import(pending["path"]))
     context.user_data.pop("pending_trivia_import", None)
+    _discard_staged_import(pending["path"])
     log_admin_action(
         f"trivia_import_{mode}",
         admin_id=user.id,
+        chat_id=msg_chat.id,
         detail={
             "url": url,
             "count": count,
             "added": added,
             "updated": updated,
+            "duplicates": duplicates,
             "backup": backup_path,
         },
     )
@@ -1910,18 +3296,68 @@ async def trivia_import_confirm_cb(update: Update, context: ContextTypes.DEFAULT
     except Exception:
         pass
     if mode == "replace":
-        txt = f"Pool reemplazado con éxito ({len(new_pool)} preguntas)."
+        txt = f"Pool reemplazado con éxito ({added} preguntas)."
     else:
         txt = f"Importación MERGE completada. Añadidas: {added}. Actualizadas: {updated}."
+    if duplicates:
+        txt += f" Duplicadas (ignoradas): {duplicates}."
     if backup_path:
-        txt += f"\\nBackup: {backup_path}"
+        txt += f"\nBackup: {backup_path}"
     await query.message.reply_text(txt)
+async def trivia_restore_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin: lista los backups del pool o restaura uno (/trivia_restore [n])."""
+    msg = update.message
+    if not msg:
+        return
+    chat = msg.chat
+    user = msg.from_user
+    if not user:
+        return
+    if not await is_admin(context, chat.id, user.id):
+        await msg.reply_text("🛡️ 🛡️ Solo un administrador puede usar /trivia_restore.")
+        return
+    backups = list_pool_backups()
+    if not backups:
+        await msg.reply_text("ℹ️ No hay backups del pool.")
+        return
+    if not context.args:
+        lines = ["🗂️ Backups del pool (más reciente primero):"]
+        for i, b in enumerate(backups, start=1):
+            when = datetime.strptime(b["ts"], "%Y%m%dT%H%M%S").strftime("%Y-%m-%d %H:%M:%S")
+            lines.append(f"{i}. {when} UTC — {max(1, b['size'] // 1024)} KB")
+        lines.append("\nUsa /trivia_restore <n> para restaurar uno.")
+        await msg.reply_text("\n".join(lines))
+        return
+    arg = context.args[0]
+    if arg.isdigit() and 1 <= int(arg) <= len(backups):
+        chosen = backups[int(arg) - 1]
+    else:
+        chosen = next((b for b in backups if b["name"] == arg), None)
+    if not chosen:
+        await msg.reply_text("⚠️ Backup no encontrado. Usa /trivia_restore para ver la lista.")
+        return
+    try:
+        pool = load_pool_backup(chosen["path"])
+    except Exception as e:
+        logging.exception("❌ Error leyendo backup de pool")
+        await msg.reply_text(f"❌ No se pudo leer el backup: {e}")
+        return
+    previous = backup_pool()
+    if not await asyncio.to_thread(save_pool, pool, False):
+        await msg.reply_text("❌ No se pudo guardar el pool en disco; revisa los logs.")
+        return
+    log_admin_action(
+        "trivia_restore",
+        admin_id=user.id,
+        chat_id=chat.id,
+        detail={"backup": chosen["path"], "count": len(pool), "previous": previous},
+    )
+    await msg.reply_text(f"♻️ Pool restaurado desde {chosen['name']} ({len(pool)} preguntas).")
 async def _start_trivia_round(context: ContextTypes.DEFAULT_TYPE, chat_id: int, started_by: int | None = None, automated: bool = False):
     """Lanza una ronda de Trivia en un chat concreto."""
-    if not is_module_enabled(chat_id, "trivia_enabled"):
+    if not is_module_enabled(chat_id, "trivia_enabled") or chat_id in MARATHONS:
         return
-    pool = load_pool()
-    valid = [q for q in pool if isinstance(q, dict) and q.get("question") and isinstance(q.get("choices"), list)]
+    valid = trivia_sampler()
     if not valid:
         if not automated:
             try:
@@ -1933,24 +3369,26 @@ async def _start_trivia_round(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
         return
 
     state = load_trivia_state()
-    state = _cleanup_stale_trivia_rounds(context, state)
     history = state.setdefault("_history", {})
     chat_history: list[str] = history.get(str(chat_id), []) if isinstance(history, dict) else []
 
-    def _qid(qdata: dict) -> str:
-        qid = qdata.get("id")
-        if qid is not None:
-            return f"id:{qid}"
-        return f"q:{qdata.get('question')}"
-
     used_keys = set(chat_history)
-    available = [q for q in valid if _qid(q) not in used_keys]
-    if not available:
-        chat_history = []
-        used_keys = set()
-        available = valid
-
-    pregunta = random.choice(available)
+    cats = trivia_chat_categories(chat_id)
+    pregunta = None
+    for _ in range(32):
+        cand = trivia_sample(cats)
+        if _trivia_qkey(cand) not in used_keys:
+            pregunta = cand
+            break
+    if pregunta is None:
+        candidates = [valid[p] for c in cats for p in TRIVIA_SAMPLER["cats"][c][0]] if cats else valid
+        available = [q for q in candidates if _trivia_qkey(q) not in used_keys]
+        if available:
+            pregunta = random.choice(available)
+        else:
+            reset = {_trivia_qkey(q) for q in candidates}
+            chat_history = [k for k in chat_history if k not in reset]
+            pregunta = trivia_sample(cats)
     question_text = pregunta["question"]
     choices = pregunta["choices"]
     correct_index = int(pregunta["answer"])
@@ -1968,7 +3406,7 @@ async def _start_trivia_round(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
             type="quiz",
             correct_option_id=correct_index,
             is_anonymous=False,
-            open_period=300,
+            open_period=TRIVIA_OPEN_PERIOD,
         )
     except Exception:
         logging.exception("❌ Error enviando poll de trivia")
@@ -1979,7 +3417,9 @@ async def _start_trivia_round(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
         "message_id_poll": poll_msg.message_id,
         "message_id_intro": intro.message_id if intro else None,
         "question_id": qid,
+        "qkey": _trivia_qkey(pregunta),
         "started_at": datetime.utcnow().isoformat(),
+        "deadline": time.time() + TRIVIA_OPEN_PERIOD + TRIVIA_EXPIRY_GRACE,
         "finished": False,
         "winner": None,
         "answers": {},
@@ -1990,10 +3430,12 @@ async def _start_trivia_round(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
         },
     }
     if isinstance(history, dict):
-        chat_history.append(_qid(pregunta))
+        chat_history.append(_trivia_qkey(pregunta))
         history[str(chat_id)] = chat_history
         state["_history"] = history
     save_trivia_state(state)
+    trivia_active_rounds()[chat_id] = str(poll_id)
+    trivia_register_deadline(str(poll_id), state[str(poll_id)]["deadline"])
 async def trivia_start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin: inicia una ronda de trivia en este chat."""
     msg = update.message
@@ -2023,15 +3465,15 @@ async def trivia_stop_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(context, chat.id, user.id):
         await msg.reply_text("🛡️ 🛡️ Solo un administrador puede usar /trivia_stop.")
         return
+    if chat.id in MARATHONS:
+        MARATHONS[chat.id]["task"].cancel()
+        return
     state = load_trivia_state()
-    active_key = None
-    active = None
-    for pid, info in state.items():
-        if info.get("chat_id") == chat.id and not info.get("finished"):
-            active_key = pid
-            active = info
-            break
-    if not active:
+    active_key = trivia_active_rounds().get(chat.id)
+    active = state.get(active_key) if active_key else None
+    if not active or active.get("finished"):
+        if active_key:
+            trivia_round_closed(chat.id, active_key)
         await msg.reply_text("⚠️ No hay ninguna ronda de trivia activa en este chat.")
         return
     snapshot = active.get("question_snapshot") or {}
@@ -2047,6 +3489,8 @@ async def trivia_stop_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     active["finished"] = True
     state[active_key] = active
     save_trivia_state(state)
+    trivia_round_closed(chat.id, active_key)
+    trivia_record_round(active)
     if correct_text is not None:
         letra = chr(ord("A") + correct_index)
         await msg.reply_text(f"🧠 Ronda detenida. La respuesta correcta era {letra}) {correct_text}.")
@@ -2064,6 +3508,12 @@ async def trivia_poll_answer_handler(update: Update, context: ContextTypes.DEFAU
     selected = pa.option_ids[0] if pa.option_ids else None
     if selected is None:
         return
+    marathon_chat = MARATHON_POLLS.get(poll_id)
+    if marathon_chat is not None:
+        m = MARATHONS[marathon_chat]
+        m["answers"].append((time.time(), user_id, int(selected)))
+        m["names"][user_id] = pa.user.full_name
+        return
     state = load_trivia_state()
     info = state.get(poll_id)
     if not info:
@@ -2086,6 +3536,8 @@ async def trivia_poll_answer_handler(update: Update, context: ContextTypes.DEFAU
         del state[poll_id]
         save_trivia_state(state)
         chat_id = info.get("chat_id")
+        trivia_round_closed(chat_id, poll_id)
+        trivia_record_round(info)
         trivia_add_point(chat_id, user_id, pa.user.full_name)
         message_id_poll = info.get("message_id_poll")
         try:
@@ -2115,6 +3567,160 @@ async def trivia_poll_answer_handler(update: Update, context: ContextTypes.DEFAU
     else:
         state[poll_id] = info
         save_trivia_state(state)
+def _marathon_board_text(m: Dict[str, Any], line: str = "") -> str:
+    title = "🏁 <b>Maratón de trivia terminada</b>" if m["done"] else f"🏃 <b>Maratón de trivia</b> — pregunta {m['idx']}/{m['total']}"
+    lines = [title]
+    if line:
+        lines.append(line)
+    rows = sorted(m["scores"].items(), key=lambda kv: kv[1], reverse=True)[:10]
+    lines.append("")
+    if not rows:
+        lines.append("Aún no hay puntos.")
+    for i, (uid, pts) in enumerate(rows, start=1):
+        lines.append(f"{i}. {html.escape(m['names'].get(uid, str(uid)))} — {pts}")
+    return "\n".join(lines)
+async def _marathon_edit_board(bot, m: Dict[str, Any], line: str = "") -> None:
+    try:
+        await bot.edit_message_text(chat_id=m["chat_id"], message_id=m["board_id"], text=_marathon_board_text(m, line), parse_mode="HTML")
+    except (BadRequest, RetryAfter):
+        pass
+    except Exception:
+        logging.exception("Fallo actualizando el marcador de la maratón")
+def _marathon_score(m: Dict[str, Any], correct_index: int) -> tuple[int, int | None]:
+    """Puntúa en bloque las respuestas acumuladas de la pregunta: +1 por acierto y +1 extra al más rápido. Devuelve (aciertos, más rápido)."""
+    first = None
+    aciertos = 0
+    for ts, uid, choice in m["answers"]:
+        if choice != correct_index:
+            continue
+        aciertos += 1
+        m["scores"][uid] = m["scores"].get(uid, 0) + 1
+        if first is None or ts < first[0]:
+            first = (ts, uid)
+    if first is None:
+        return aciertos, None
+    m["scores"][first[1]] += 1
+    return aciertos, first[1]
+def _marathon_close_question(m: Dict[str, Any], q: dict, started: datetime, closed: list[dict]) -> int:
+    """Puntúa la pregunta en curso y guarda su resumen para las estadísticas por pregunta; devuelve los aciertos."""
+    MARATHON_POLLS.pop(m["poll_id"], None)
+    correct_index = int(q["answer"])
+    aciertos, fastest = _marathon_score(m, correct_index)
+    closed.append({
+        "qkey": _trivia_qkey(q),
+        "started_at": started.isoformat(),
+        "winner": fastest,
+        "answers": {str(uid): {"choice_index": ch, "answered_at": datetime.utcfromtimestamp(ts).isoformat()} for ts, uid, ch in m["answers"]},
+        "question_snapshot": {"answer": correct_index},
+    })
+    m["answers"] = []
+    return aciertos
+async def _marathon_wait(app, secs: float) -> None:
+    """Espera `secs` segundos; si la Application se está deteniendo, corta la maratón como si se cancelara."""
+    end = time.monotonic() + secs
+    while time.monotonic() < end:
+        if not app.running:
+            raise asyncio.CancelledError()
+        await asyncio.sleep(min(1.0, end - time.monotonic()))
+async def _run_marathon(app, chat_id: int) -> None:
+    """
+    Lanza las preguntas de la maratón una tras otra. Las respuestas se guardan solo en memoria
+    (MARATHONS) y se puntúan al cerrar cada pregunta; el marcador es un único mensaje que se edita.
+    Los puntos y las estadísticas por pregunta se persisten una sola vez, al terminar, también si la
+    maratón se cancela o el bot se detiene (la pregunta en curso se puntúa con lo recibido).
+    """
+    bot = app.bot
+    m = MARATHONS[chat_id]
+    used: set[str] = set()
+    closed: list[dict] = []
+    current = None
+    line = ""
+    try:
+        while m["idx"] < m["total"]:
+            valid = trivia_sampler()
+            if not valid:
+                line = "No hay preguntas de trivia disponibles."
+                break
+            cats = trivia_chat_categories(chat_id)
+            q = trivia_sample(cats)
+            for _ in range(32):
+                if _trivia_qkey(q) not in used or len(used) >= len(valid):
+                    break
+                q = trivia_sample(cats)
+            used.add(_trivia_qkey(q))
+            m["idx"] += 1
+            correct_index = int(q["answer"])
+            m["answers"] = []
+            started = datetime.utcnow()
+            try:
+                poll_msg = await bot.send_poll(
+                    chat_id=chat_id,
+                    question=f"[{m['idx']}/{m['total']}] {q['question']}",
+                    options=q["choices"],
+                    type="quiz",
+                    correct_option_id=correct_index,
+                    is_anonymous=False,
+                    open_period=m["secs"],
+                )
+            except RetryAfter as e:
+                await asyncio.sleep(float(e.retry_after) + 1)
+                m["idx"] -= 1
+                continue
+            m["poll_id"] = str(poll_msg.poll.id)
+            MARATHON_POLLS[m["poll_id"]] = chat_id
+            current = (q, started)
+            await _marathon_wait(app, m["secs"] + 1)
+            current = None
+            aciertos = _marathon_close_question(m, q, started, closed)
+            letra = chr(ord("A") + correct_index)
+            line = f"➡️ Respuesta anterior: <b>{letra}) {html.escape(str(q['choices'][correct_index]))}</b> ({aciertos} aciertos)"
+            await _marathon_edit_board(bot, m, line)
+    except asyncio.CancelledError:
+        line = "⏹️ Maratón detenida."
+        raise
+    except Exception:
+        logging.exception("❌ Error en la maratón de trivia de %s", chat_id)
+    finally:
+        if current is not None:
+            _marathon_close_question(m, *current, closed)
+        MARATHON_POLLS.pop(m.get("poll_id"), None)
+        m["done"] = True
+        if m["scores"]:
+            trivia_add_points(chat_id, {uid: (m["names"].get(uid, str(uid)), pts) for uid, pts in m["scores"].items()})
+        for info in closed:
+            trivia_record_round(info, save=False)
+        if closed:
+            _save_json_file(TRIVIA_QSTATS_FILE, load_trivia_qstats())
+        await _marathon_edit_board(bot, m, line)
+        MARATHONS.pop(chat_id, None)
+async def trivia_maraton_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin: /trivia_maraton [preguntas] [segundos] — N preguntas seguidas con un único marcador."""
+    msg = update.message
+    if not msg or not msg.from_user:
+        return
+    chat = msg.chat
+    if not await is_admin(context, chat.id, msg.from_user.id):
+        await msg.reply_text("🛡️ Solo un administrador puede usar /trivia_maraton.")
+        return
+    if not is_module_enabled(chat.id, "trivia_enabled"):
+        await msg.reply_text("🚫 El módulo de Trivia está desactivado en este chat.")
+        return
+    if chat.id in MARATHONS or chat.id in trivia_active_rounds():
+        await msg.reply_text("⚠️ Ya hay una ronda o maratón de trivia en curso. Detenla con /trivia_stop.")
+        return
+    try:
+        total = int(context.args[0]) if context.args else MARATHON_DEFAULT_QUESTIONS
+        secs = int(context.args[1]) if len(context.args or []) > 1 else MARATHON_DEFAULT_SECS
+        if not (1 <= total <= MARATHON_MAX_QUESTIONS and 5 <= secs <= 600):
+            raise ValueError
+    except ValueError:
+        await msg.reply_text(f"Uso: /trivia_maraton [preguntas 1-{MARATHON_MAX_QUESTIONS}] [segundos 5-600]")
+        return
+    m = {"chat_id": chat.id, "total": total, "secs": secs, "idx": 0, "done": False, "scores": {}, "names": {}, "answers": [], "poll_id": None}
+    board = await context.bot.send_message(chat_id=chat.id, text=_marathon_board_text(m, f"{total} preguntas, {secs} s cada una. ¡Suerte!"), parse_mode="HTML")
+    m["board_id"] = board.message_id
+    MARATHONS[chat.id] = m
+    m["task"] = context.application.create_task(_run_marathon(context.application, chat.id))
 async def trivia_poll_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     poll = update.poll
     if not poll:
@@ -2133,6 +3739,8 @@ async def trivia_poll_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     save_trivia_state(state)
     del state[poll_id]
     save_trivia_state(state)
+    trivia_round_closed(info.get("chat_id"), poll_id)
+    trivia_record_round(info)
     snapshot = info.get("question_snapshot") or {}
     correct_index = snapshot.get("answer")
     choices = snapshot.get("choices") or []
@@ -2153,84 +3761,529 @@ async def trivia_poll_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
         except Exception:
             logging.exception("❌ Error anunciando respuesta correcta sin ganador")
-def _cleanup_stale_trivia_rounds(context: ContextTypes.DEFAULT_TYPE, state: dict) -> dict:
-    """Marca como finalizadas las rondas que ya deberían haber cerrado."""
-
-    now = datetime.utcnow()
-    stale_keys: list[str] = []
-    for pid, info in list(state.items()):
-        if not isinstance(info, dict):
-            continue
-        if info.get("finished"):
-            continue
-        started_at = info.get("started_at")
-        try:
-            started_dt = datetime.fromisoformat(started_at) if isinstance(started_at, str) else None
-        except ValueError:
-            started_dt = None
-        if started_dt and now - started_dt > timedelta(minutes=6):
-            info["finished"] = True
-            state[pid] = info
-            stale_keys.append(pid)
-            snapshot = info.get("question_snapshot") or {}
-            choices = snapshot.get("choices") or []
-            correct_index = snapshot.get("answer")
-            correct_text = None
-            if isinstance(correct_index, int) and 0 <= correct_index < len(choices):
-                correct_text = choices[correct_index]
-            chat_id = info.get("chat_id")
-            letra = chr(ord("A") + correct_index) if isinstance(correct_index, int) else "?"
-            try:
-                if chat_id and correct_text is not None:
-                    asyncio.create_task(
-                        context.bot.send_message(
-                            chat_id=chat_id,
-                            text=(
-                                "⏰ La ronda de trivia anterior finalizó sin ganador.\n"
-                                f"➡️ Respuesta correcta: <b>{letra}) {correct_text}</b>"
-                            ),
-                            parse_mode="HTML",
-                        )
-                    )
-            except Exception:
-                logging.exception("❌ Error anunciando cierre automático de trivia")
-
-    if stale_keys:
-        for k in stale_keys:
-            state.pop(k, None)
-        save_trivia_state(state)
-    return state
-async def scheduled_trivia_job(context: ContextTypes.DEFAULT_TYPE):
-    """Job que intenta lanzar una trivia automática en cada chat con trivia_enabled."""
-    roster = load_roster()
+TRIVIA_DEADLINES: list[tuple[float, str]] = []
+def trivia_register_deadline(poll_id: str, deadline: float) -> None:
+    """Programa el cierre de respaldo de una ronda: O(log n). Las rondas ya cerradas se descartan al salir del heap."""
+    heapq.heappush(TRIVIA_DEADLINES, (deadline, poll_id))
+def _trivia_round_deadline(info: dict) -> float | None:
+    deadline = info.get("deadline")
+    if isinstance(deadline, (int, float)):
+        return float(deadline)
+    try:
+        started = datetime.fromisoformat(info.get("started_at") or "")
+    except (TypeError, ValueError):
+        return None
+    return (started - datetime(1970, 1, 1)).total_seconds() + TRIVIA_OPEN_PERIOD + TRIVIA_EXPIRY_GRACE
+def trivia_deadlines_rebuild() -> None:
+    """Reconstruye el heap de vencimientos desde las rondas abiertas persistidas (tras un reinicio)."""
+    TRIVIA_DEADLINES.clear()
+    for pid, info in load_trivia_state().items():
+        if isinstance(info, dict) and info.get("chat_id") and not info.get("finished"):
+            deadline = _trivia_round_deadline(info)
+            if deadline is not None:
+                TRIVIA_DEADLINES.append((deadline, pid))
+    heapq.heapify(TRIVIA_DEADLINES)
+async def trivia_expiry_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Cierra las rondas cuyo vencimiento ya pasó sin que Telegram avisara del cierre del poll (solo en
+    la réplica líder). Solo lee el estado si hay algún vencimiento en el heap.
+    """
+    now = time.time()
+    if not is_leader(now) or not TRIVIA_DEADLINES or TRIVIA_DEADLINES[0][0] > now:
+        return
+    due: list[str] = []
+    while TRIVIA_DEADLINES and TRIVIA_DEADLINES[0][0] <= now:
+        due.append(heapq.heappop(TRIVIA_DEADLINES)[1])
     state = load_trivia_state()
-    state = _cleanup_stale_trivia_rounds(context, state)
-    activos_por_chat: dict[int, bool] = {}
-    for info in state.values():
-        if not isinstance(info, dict):
+    expired = [(pid, state.pop(pid)) for pid in due if isinstance(state.get(pid), dict) and not state[pid].get("finished")]
+    if not expired:
+        return
+    save_trivia_state(state)
+    for pid, info in expired:
+        chat_id = info.get("chat_id")
+        trivia_round_closed(chat_id, pid)
+        trivia_record_round(info)
+        snapshot = info.get("question_snapshot") or {}
+        choices = snapshot.get("choices") or []
+        correct_index = snapshot.get("answer")
+        if not chat_id or not isinstance(correct_index, int) or not 0 <= correct_index < len(choices):
             continue
-        cid = info.get("chat_id")
-        if isinstance(cid, int) and not info.get("finished"):
-            activos_por_chat[cid] = True
-    for chat_id_str in roster.keys():
+        letra = chr(ord("A") + correct_index)
         try:
-            chat_id = int(chat_id_str)
-        except ValueError:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=(
+                    "⏰ La ronda de trivia anterior finalizó sin ganador.\n"
+                    f"➡️ Respuesta correcta: <b>{letra}) {choices[correct_index]}</b>"
+                ),
+                parse_mode="HTML",
+            )
+        except Exception:
+            logging.exception("❌ Error anunciando cierre automático de trivia")
+LEADER_LEASE_FILE = os.path.join(SHARD_DIR, "leader.lease")
+LEADER_LEASE_TTL = float(os.environ.get("LEADER_LEASE_TTL", "15") or 15)
+LEADER_RENEW_EVERY = max(1.0, LEADER_LEASE_TTL / 3)
+LEADER: Dict[str, Any] = {"id": f"{socket.gethostname()}:{os.getpid()}:{random.getrandbits(32):08x}", "leader": False, "expires": 0.0}
+def is_leader(now: float | None = None) -> bool:
+    """Esta réplica es líder mientras no venza el lease que escribió; si el bucle se atasca más que el TTL deja de serlo aunque no haya vuelto a renovar."""
+    return (time.time() if now is None else now) < LEADER["expires"]
+def leader_tick(now: float | None = None, release: bool = False) -> bool:
+    """
+    Renueva o intenta adquirir el lease de líder de esta réplica. El lease es un fichero JSON
+    {owner, expires} en SHARD_DIR que solo se lee y escribe con flock exclusivo; si el dueño deja de
+    renovarlo durante LEADER_LEASE_TTL segundos, otra réplica lo toma. Con release=True lo suelta.
+    """
+    if fcntl is None:
+        if not release and not LEADER["leader"]:
+            _leader_takeover()
+        LEADER["leader"] = not release
+        LEADER["expires"] = float("inf") if LEADER["leader"] else 0.0
+        return LEADER["leader"]
+    now = time.time() if now is None else now
+    was = is_leader(now)
+    if LEADER["leader"] and not was:
+        logging.warning("👑 Réplica %s: el lease de líder venció sin renovarse", LEADER["id"])
+    LEADER["leader"] = was
+    try:
+        os.makedirs(os.path.dirname(LEADER_LEASE_FILE) or ".", exist_ok=True)
+        with open(os.open(LEADER_LEASE_FILE, os.O_RDWR | os.O_CREAT, 0o644), "r+", encoding="utf-8") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return was
+            f.seek(0)
+            try:
+                lease = json.loads(f.read() or "{}")
+            except ValueError:
+                lease = {}
+            mine = lease.get("owner") == LEADER["id"]
+            if release:
+                LEADER["leader"] = False
+                if mine:
+                    lease = {"owner": None, "expires": 0}
+            elif mine or float(lease.get("expires") or 0) < now:
+                LEADER["leader"] = True
+                lease = {"owner": LEADER["id"], "expires": now + LEADER_LEASE_TTL}
+            else:
+                LEADER["leader"] = False
+            if LEADER["leader"] or (release and mine):
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(lease))
+                f.flush()
+            LEADER["expires"] = lease["expires"] if LEADER["leader"] else 0.0
+    except Exception:
+        logging.exception("❌ Error renovando el lease de líder")
+        LEADER["leader"] = False
+        LEADER["expires"] = 0.0
+    if LEADER["leader"] != was:
+        logging.info("👑 Réplica %s: %s", LEADER["id"], "ahora es líder" if LEADER["leader"] else "deja de ser líder")
+        if LEADER["leader"]:
+            _leader_takeover()
+    return LEADER["leader"]
+def _leader_takeover() -> None:
+    """
+    Al pasar a líder, recarga desde disco lo que la réplica anterior pudo cambiar: settings, roster e
+    índice de chats con trivia (las cachés son de cuando esta réplica arrancó), y las rondas que abrió
+    (vencimientos e índice de rondas abiertas). La rueda se reprograma desde ahora: los huecos que
+    vencieron mientras esta réplica era seguidora ya los cubrió la líder anterior.
+    """
+    global SETTINGS_CACHE, ROSTER_CACHE, TRIVIA_ENABLED_CHATS, TRIVIA_ACTIVE
+    SETTINGS_CACHE = None
+    ROSTER_CACHE = None
+    TRIVIA_ENABLED_CHATS = None
+    MENTION_CACHE.clear()
+    TRIVIA_ACTIVE = None
+    trivia_deadlines_rebuild()
+    trivia_wheel_rebuild(time.time())
+async def leader_job(context: ContextTypes.DEFAULT_TYPE):
+    leader_tick()
+TRIVIA_WHEEL_TICK = 5.0
+TRIVIA_SEND_BUDGET = max(1, int(os.environ.get("TRIVIA_SEND_BUDGET", "20") or 20))
+TRIVIA_DEFAULT_INTERVAL = 60
+TRIVIA_DEFAULT_TZ = "Europe/Madrid"
+TRIVIA_HOURS_RE = re.compile(r"^(\d{1,2})-(\d{1,2})$")
+TRIVIA_WHEEL: list[tuple[float, int]] = []
+TRIVIA_DUE: Dict[int, float] = {}
+TRIVIA_BUCKET: Dict[str, float] = {"tokens": float(TRIVIA_SEND_BUDGET), "ts": 0.0}
+def trivia_schedule_cfg(chat_id: int) -> tuple[int, int, int, str, int]:
+    """
+    Horario automático de trivia del chat: (intervalo_min, hora_inicio, hora_fin, zona, offset_s).
+    Sin offset configurado se deriva uno estable del chat_id, así los chats quedan repartidos a lo
+    largo del intervalo en lugar de coincidir todos en el mismo segundo.
+    """
+    cfg = get_chat_settings(chat_id)
+    interval = max(10, min(1440, int(cfg.get("trivia_interval_min") or TRIVIA_DEFAULT_INTERVAL)))
+    start, end = 0, 24
+    m = TRIVIA_HOURS_RE.match(str(cfg.get("trivia_hours") or ""))
+    if m and 0 <= int(m.group(1)) <= 24 and 0 <= int(m.group(2)) <= 24:
+        start, end = int(m.group(1)), int(m.group(2))
+    tz = cfg.get("trivia_tz") or TRIVIA_DEFAULT_TZ
+    offset = cfg.get("trivia_offset_s")
+    if not isinstance(offset, int):
+        offset = (abs(chat_id) * 2654435761) % (interval * 60)
+    return interval, start, end, tz, offset % (interval * 60)
+def _trivia_in_hours(ts: float, start: int, end: int, tz: str) -> bool:
+    if start == end or (start, end) == (0, 24):
+        return True
+    try:
+        hour = datetime.fromtimestamp(ts, ZoneInfo(tz)).hour
+    except Exception:
+        hour = datetime.utcfromtimestamp(ts).hour
+    return start <= hour < end if start < end else (hour >= start or hour < end)
+def trivia_next_due(chat_id: int, now: float) -> float | None:
+    """Siguiente hueco (> now) del chat que cae dentro de sus horas activas."""
+    interval, start, end, tz, offset = trivia_schedule_cfg(chat_id)
+    step = interval * 60
+    due = now - ((now - offset) % step) + step
+    for _ in range(2 * 1440 // interval + 2):
+        if _trivia_in_hours(due, start, end, tz):
+            return due
+        due += step
+    return None
+def trivia_schedule_chat(chat_id: int, now: float | None = None) -> None:
+    """(Re)programa la próxima ronda automática del chat en la rueda: O(log n). Las entradas viejas quedan invalidadas."""
+    due = trivia_next_due(chat_id, time.time() if now is None else now)
+    if due is None:
+        TRIVIA_DUE.pop(chat_id, None)
+        return
+    TRIVIA_DUE[chat_id] = due
+    heapq.heappush(TRIVIA_WHEEL, (due, chat_id))
+def trivia_unschedule_chat(chat_id: int) -> None:
+    TRIVIA_DUE.pop(chat_id, None)
+def trivia_wheel_rebuild(now: float | None = None) -> None:
+    """Reconstruye la rueda con los chats del índice de trivia activada."""
+    now = time.time() if now is None else now
+    TRIVIA_WHEEL.clear()
+    TRIVIA_DUE.clear()
+    for chat_id in trivia_enabled_chats():
+        trivia_schedule_chat(chat_id, now)
+def _trivia_take_budget(now: float) -> int:
+    """Cubo de fichas global: como mucho TRIVIA_SEND_BUDGET rondas automáticas por minuto."""
+    b = TRIVIA_BUCKET
+    if b["ts"]:
+        b["tokens"] = min(float(TRIVIA_SEND_BUDGET), b["tokens"] + (now - b["ts"]) * TRIVIA_SEND_BUDGET / 60.0)
+    b["ts"] = now
+    return int(b["tokens"])
+async def trivia_wheel_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Tick de la rueda de trivia (solo en la réplica líder): saca los chats vencidos, respeta el
+    presupuesto global de envíos y reprograma cada chat en su siguiente hueco. Lo que no cabe en el
+    presupuesto se queda en la rueda para el siguiente tick.
+    """
+    now = time.time()
+    if not is_leader(now) or not TRIVIA_WHEEL or TRIVIA_WHEEL[0][0] > now:
+        return
+    budget = _trivia_take_budget(now)
+    if budget <= 0:
+        return
+    activos_por_chat = trivia_active_rounds()
+    started = 0
+    while TRIVIA_WHEEL and TRIVIA_WHEEL[0][0] <= now and started < budget:
+        due, chat_id = heapq.heappop(TRIVIA_WHEEL)
+        if TRIVIA_DUE.get(chat_id) != due:
             continue
-        if not is_module_enabled(chat_id, "trivia_enabled"):
+        del TRIVIA_DUE[chat_id]
+        if chat_id not in trivia_enabled_chats():
             continue
-        if activos_por_chat.get(chat_id):
+        trivia_schedule_chat(chat_id, now)
+        if chat_id in activos_por_chat or chat_id in MARATHONS:
             continue
-        asyncio.create_task(_start_trivia_round(context, chat_id, started_by=None, automated=True))
+        started += 1
+        context.application.create_task(_start_trivia_round(context, chat_id, started_by=None, automated=True))
+    TRIVIA_BUCKET["tokens"] -= started
+async def trivia_categorias_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/trivia_categorias [cat1, cat2 | todas] — muestra las categorías del pool o fija el filtro del chat (admin)."""
+    msg = update.message
+    if not msg or not msg.from_user:
+        return
+    chat = msg.chat
+    trivia_sampler()
+    cats = TRIVIA_SAMPLER["cats"]
+    if context.args:
+        if not await is_admin(context, chat.id, msg.from_user.id):
+            await msg.reply_text("🛡️ Solo un administrador puede cambiar las categorías de la trivia.")
+            return
+        wanted = [_pool_norm_text(c) for c in " ".join(context.args).split(",") if c.strip()]
+        if wanted == ["todas"]:
+            wanted = []
+        unknown = [c for c in wanted if c not in cats]
+        if unknown:
+            await msg.reply_text(f"⚠️ Categorías desconocidas: {', '.join(unknown)}")
+            return
+        set_chat_setting(chat.id, "trivia_categories", wanted)
+    active = trivia_chat_categories(chat.id)
+    lines = [f"🗂️ Categorías de trivia en este chat: {', '.join(active) if active else 'todas'}"]
+    if cats:
+        lines.append("\nDisponibles:")
+        lines += [f"• {c} ({len(cats[c][0])})" for c in sorted(cats)]
+    else:
+        lines.append("\nEl pool actual no tiene preguntas con categoría.")
+    lines.append("\nUso: /trivia_categorias cat1, cat2 — o /trivia_categorias todas")
+    await msg.reply_text("\n".join(lines))
+async def trivia_horario_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin: /trivia_horario [minutos] [HH-HH] [zona] — muestra o cambia el horario de la trivia automática."""
+    msg = update.message
+    if not msg or not msg.from_user:
+        return
+    chat = msg.chat
+    args = list(context.args or [])
+    if args:
+        if not await is_admin(context, chat.id, msg.from_user.id):
+            await msg.reply_text("🛡️ Solo un administrador puede cambiar el horario de la trivia.")
+            return
+        cfg = dict(get_chat_settings(chat.id))
+        try:
+            interval = int(args[0])
+            if not 10 <= interval <= 1440:
+                raise ValueError
+            cfg["trivia_interval_min"] = interval
+            cfg.pop("trivia_offset_s", None)
+            if len(args) > 1:
+                m = TRIVIA_HOURS_RE.match(args[1])
+                if not m or int(m.group(1)) > 24 or int(m.group(2)) > 24:
+                    raise ValueError
+                cfg["trivia_hours"] = args[1]
+            if len(args) > 2:
+                ZoneInfo(args[2])
+                cfg["trivia_tz"] = args[2]
+        except Exception:
+            await msg.reply_text("Uso: /trivia_horario [minutos 10-1440] [HH-HH] [zona]\nEj: /trivia_horario 120 9-23 Europe/Madrid")
+            return
+        save_settings_entry(str(chat.id), cfg)
+        if is_module_enabled(chat.id, "trivia_enabled"):
+            trivia_schedule_chat(chat.id)
+    interval, start, end, tz, _offset = trivia_schedule_cfg(chat.id)
+    due = TRIVIA_DUE.get(chat.id)
+    nxt = datetime.fromtimestamp(due, ZoneInfo(tz)).strftime("%H:%M") if due else "—"
+    await msg.reply_text(
+        f"🕒 Trivia automática cada {interval} min, de {start:02d}:00 a {end:02d}:00 ({tz}).\n"
+        f"Próxima ronda: {nxt}"
+    )
 def _setup_trivia_scheduler(app) -> None:
-    """Configura el job_queue para lanzar Trivia automática cada hora a y 30 (UTC)."""
-    from datetime import timedelta, timezone
+    """Configura el job_queue: lease de líder, tick de la rueda de trivia automática y vencimiento de rondas."""
     jq = app.job_queue
-    now = datetime.now(timezone.utc)
-    first_run = now.replace(minute=30, second=0, microsecond=0)
-    if first_run <= now:
-        first_run = first_run + timedelta(hours=1)
-    jq.run_repeating(scheduled_trivia_job, interval=3600, first=first_run)
+    jq.run_repeating(leader_job, interval=LEADER_RENEW_EVERY, first=0)
+    trivia_deadlines_rebuild()
+    jq.run_repeating(trivia_expiry_job, interval=TRIVIA_WHEEL_TICK, first=TRIVIA_WHEEL_TICK)
+    trivia_wheel_rebuild()
+    jq.run_repeating(trivia_wheel_job, interval=TRIVIA_WHEEL_TICK, first=TRIVIA_WHEEL_TICK)
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest que cuenta las llamadas a la Bot API por método, código y latencia."""
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api = url.rsplit("/", 1)[-1] or "unknown"
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metric_inc("rurubot_telegram_requests_total", (("method", api), ("code", "error")))
+            raise
+        metric_observe("rurubot_telegram_request_seconds", (("method", api),), time.perf_counter() - started)
+        metric_inc("rurubot_telegram_requests_total", (("method", api), ("code", str(code))))
+        if code == 429:
+            metric_inc("rurubot_telegram_retry_after_total", (("method", api),))
+        return code, payload
+def _callback_route_label(update: Any) -> str | None:
+    """Ruta decodificada del callback_data, para etiquetar las métricas por botón; None si no decodifica."""
+    q = getattr(update, "callback_query", None)
+    decoded = cb_decode(q.data or "") if q is not None else None
+    return decoded[0] if decoded else None
+def _timed_callback(callback, label=None):
+    """Mide el handler; con `label(update)` la serie se etiqueta por llamada (cae en el nombre del callback si devuelve None)."""
+    default = getattr(callback, "__name__", repr(callback))
+    @functools.wraps(callback)
+    async def wrapper(update, context, *args, **kwargs):
+        started = time.perf_counter()
+        name = (label(update) if label else None) or default
+        task = asyncio.current_task()
+        prev = _HANDLER_RUNNING.get(task)
+        _HANDLER_RUNNING[task] = (name, _update_kind(update))
+        try:
+            return await callback(update, context, *args, **kwargs)
+        except Exception:
+            metric_inc("rurubot_handler_errors_total", (("handler", name),))
+            raise
+        finally:
+            if prev is None:
+                _HANDLER_RUNNING.pop(task, None)
+            else:
+                _HANDLER_RUNNING[task] = prev
+            metric_observe("rurubot_handler_seconds", (("handler", name),), time.perf_counter() - started)
+    return wrapper
+def _update_kind(update: Any) -> str:
+    for attr in ("message", "edited_message", "callback_query", "poll_answer", "poll", "chat_member", "my_chat_member"):
+        if getattr(update, attr, None) is not None:
+            return attr
+    return type(update).__name__
+def _stall_context(frame, loop) -> tuple[str, str]:
+    """
+    Handler instrumentado que ocupa el bucle: lo anota _timed_callback por tarea en _HANDLER_RUNNING,
+    así el vigilante no toca las variables locales de una pila en ejecución. Si la tarea actual no es
+    un handler, devuelve la función más externa de bot.py en la pila (solo nombres de código).
+    """
+    try:
+        running = _HANDLER_RUNNING.get(asyncio.current_task(loop))
+    except RuntimeError:
+        running = None
+    if running is not None:
+        return running
+    outer = "?"
+    f = frame
+    while f is not None:
+        if f.f_code.co_filename == __file__:
+            outer = f.f_code.co_name
+        f = f.f_back
+    return outer, "-"
+async def _loop_heartbeat() -> None:
+    while True:
+        before = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        now = time.monotonic()
+        metric_observe("rurubot_loop_lag_seconds", (), max(0.0, now - before - LOOP_LAG_INTERVAL))
+        _LOOP_WATCH["beat"] = now
+def _stall_watchdog(thread_id: int, loop, stop: threading.Event) -> None:
+    """Hilo vigilante: si el latido del bucle se retrasa más de STALL_THRESHOLD, registra la pila del hilo del bucle."""
+    reported = 0.0
+    while not stop.wait(STALL_THRESHOLD / 2):
+        beat = _LOOP_WATCH["beat"]
+        lag = time.monotonic() - beat - LOOP_LAG_INTERVAL
+        if lag < STALL_THRESHOLD or beat == reported:
+            continue
+        reported = beat
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            continue
+        handler, kind = _stall_context(frame, loop)
+        stack = "".join(traceback.format_stack(frame, limit=STALL_STACK_DEPTH))
+        del frame
+        metric_inc("rurubot_loop_stalls_total", (("handler", handler),))
+        logging.warning("⏱️ Bucle bloqueado %.2f s en %s (%s):\n%s", lag, handler, kind, stack)
+def start_stall_watchdog(app) -> None:
+    if STALL_THRESHOLD <= 0 or _LOOP_WATCH["stop"] is not None:
+        return
+    _LOOP_WATCH["beat"] = time.monotonic()
+    _LOOP_WATCH["stop"] = stop = threading.Event()
+    app.bot_data["_loop_heartbeat"] = asyncio.create_task(_loop_heartbeat())
+    threading.Thread(
+        target=_stall_watchdog, args=(threading.get_ident(), asyncio.get_running_loop(), stop), name="stall-watchdog", daemon=True
+    ).start()
+def stop_stall_watchdog(app) -> None:
+    stop = _LOOP_WATCH["stop"]
+    if stop is not None:
+        stop.set()
+        _LOOP_WATCH["stop"] = None
+    task = app.bot_data.pop("_loop_heartbeat", None)
+    if task:
+        task.cancel()
+def instrument_handlers(app) -> None:
+    """Envuelve el callback de todos los handlers registrados para medir su latencia."""
+    for handlers in app.handlers.values():
+        for h in handlers:
+            if not getattr(h.callback, "__wrapped__", None):
+                h.callback = _timed_callback(h.callback, _callback_route_label if h.callback is callback_router else None)
+async def _metrics_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+        path = head.split(b" ", 2)[1] if head.count(b" ") >= 2 else b"/"
+        if path.split(b"?", 1)[0] in (b"/", b"/metrics"):
+            status, body = b"200 OK", render_metrics().encode("utf-8")
+        else:
+            status, body = b"404 Not Found", b"not found\n"
+        writer.write(
+            b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            + b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+async def start_metrics_server(app) -> None:
+    if not METRICS_PORT:
+        return
+    try:
+        app.bot_data["_metrics_server"] = await asyncio.start_server(_metrics_http, METRICS_HOST, METRICS_PORT)
+        logging.info("Métricas disponibles en http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    except Exception:
+        logging.exception("❌ No se pudo iniciar el servidor de métricas")
+async def on_startup(app) -> None:
+    await start_metrics_server(app)
+    start_stall_watchdog(app)
+    resume_all_jobs(app.bot)
+async def on_shutdown(app) -> None:
+    stop_stall_watchdog(app)
+    leader_tick(release=True)
+    await asyncio.to_thread(writer_flush)
+def is_owner(user_id: int) -> bool:
+    return user_id in OWNER_IDS
+class _SlowCallbackCollector(logging.Handler):
+    """Recoge los avisos «Executing … took …» que emite asyncio en modo debug."""
+    def __init__(self) -> None:
+        super().__init__(logging.WARNING)
+        self.entries: List[tuple[float, str]] = []
+    def emit(self, record: logging.LogRecord) -> None:
+        args = record.args if isinstance(record.args, tuple) else ()
+        if isinstance(record.msg, str) and record.msg.startswith("Executing") and len(args) >= 2:
+            self.entries.append((float(args[1]), str(args[0])))
+async def _run_profile(bot, chat_id: int, seconds: int, top: int, sort: str) -> None:
+    """
+    Perfila el hilo del bucle durante `seconds` con cProfile y activa el modo debug de asyncio
+    para registrar los callbacks que bloquean el bucle más de PROFILE_SLOW_CALLBACK segundos.
+    """
+    global _profile_task
+    loop = asyncio.get_running_loop()
+    asyncio_log = logging.getLogger("asyncio")
+    collector = _SlowCallbackCollector()
+    was_debug, was_slow = loop.get_debug(), loop.slow_callback_duration
+    profiler = cProfile.Profile()
+    asyncio_log.addHandler(collector)
+    loop.slow_callback_duration = PROFILE_SLOW_CALLBACK
+    loop.set_debug(True)
+    started = time.perf_counter()
+    try:
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        out = io.StringIO()
+        elapsed = time.perf_counter() - started
+        out.write(f"RuruBot — perfil de {elapsed:.1f} s, top {top} por {sort}\n\n")
+        pstats.Stats(profiler, stream=out).strip_dirs().sort_stats(sort).print_stats(top)
+        blocks = sorted(collector.entries, reverse=True)
+        out.write(f"\nBloqueos del bucle > {PROFILE_SLOW_CALLBACK * 1000:.0f} ms: {len(blocks)}\n")
+        for took, handle in blocks[:top]:
+            out.write(f"{took * 1000:9.1f} ms  {handle}\n")
+        caption = f"🔬 Perfil de {elapsed:.0f} s — {len(blocks)} bloqueo(s) del bucle"
+        await bot.send_document(
+            chat_id=chat_id,
+            document=out.getvalue().encode("utf-8"),
+            filename=f"profile_{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.txt",
+            caption=caption,
+        )
+    except Exception:
+        logging.exception("❌ Error generando el perfil")
+    finally:
+        loop.set_debug(was_debug)
+        loop.slow_callback_duration = was_slow
+        asyncio_log.removeHandler(collector)
+        _profile_task = None
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Propietario: perfila el bot durante N segundos (/profile [segundos] [top] [cumulative|tottime])."""
+    global _profile_task
+    msg = update.message
+    if not msg or not msg.from_user:
+        return
+    if not is_owner(msg.from_user.id):
+        return await msg.reply_text("🛡️ Este comando solo puede usarlo el propietario del bot.")
+    if _profile_task is not None:
+        return await msg.reply_text("⏳ Ya hay un perfil en curso.")
+    args = context.args or []
+    seconds = max(1, min(300, int(args[0]))) if len(args) > 0 and args[0].isdigit() else 30
+    top = max(5, min(200, int(args[1]))) if len(args) > 1 and args[1].isdigit() else 40
+    sort = args[2].lower() if len(args) > 2 and args[2].lower() in ("cumulative", "tottime", "ncalls") else "cumulative"
+    _profile_task = asyncio.create_task(_run_profile(context.bot, msg.chat.id, seconds, top, sort))
+    await msg.reply_text(f"🔬 Perfilando durante {seconds} s… te enviaré el informe al terminar.")
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.exception("Unhandled exception", exc_info=context.error)
 MODULES: Dict[str, Dict[str, str]] = {
@@ -2299,15 +4352,15 @@ def build_config_keyboard(chat_id: int) -> InlineKeyboardMarkup:
         label = info["label"]
         enabled = bool(cfg.get(key, DEFAULTS.get(key, False)))
         state = "✅" if enabled else "❌"
-        return InlineKeyboardButton(f"{label} {state}", callback_data=f"cfg:t:{mod_code}")
+        return InlineKeyboardButton(f"{label} {state}", callback_data=cb_encode("cfg", "t", mod_code))
     codes = list(MODULES.keys())
     rows = []
     for i in range(0, len(codes), 2):
         chunk = codes[i:i + 2]
         rows.append([b(c) for c in chunk])
     rows.append([
-        InlineKeyboardButton("🔄 Refrescar", callback_data="cfg:r"),
-        InlineKeyboardButton("✖️ Cerrar", callback_data="cfg:x"),
+        InlineKeyboardButton("🔄 Refrescar", callback_data=cb_encode("cfg", "r")),
+        InlineKeyboardButton("✖️ Cerrar", callback_data=cb_encode("cfg", "x")),
     ])
     return InlineKeyboardMarkup(rows)
 async def _assert_admin_or_warn(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int) -> bool:
@@ -2331,20 +4384,14 @@ async def config_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     kb = build_config_keyboard(chat.id)
     title = "⚙️ Configuración del chat\nToca para activar/desactivar módulos. Solo administradores."
     await msg.reply_text(title, reply_markup=kb)
-async def cfg_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cfg_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str = "", mod_code: str = ""):
     q = update.callback_query
-    data = q.data or ""
     chat = q.message.chat
     user_id = q.from_user.id
     if not await _assert_admin_or_warn(update, context, chat.id, user_id):
         return
     try:
-        parts = data.split(":", 2)
-        if len(parts) < 2 or parts[0] != "cfg":
-            return
-        action = parts[1]
         if action == "t":
-            mod_code = parts[2]
             info = MODULES.get(mod_code)
             if not info:
                 return await safe_q_answer(q, "Módulo desconocido.")
@@ -2352,6 +4399,12 @@ async def cfg_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             cfg = _with_defaults(get_chat_settings(chat.id))
             cur = bool(cfg.get(key, DEFAULTS.get(key, False)))
             set_chat_setting(chat.id, key, not cur)
+            if key == "trivia_enabled":
+                if cur:
+                    trivia_unschedule_chat(chat.id)
+                else:
+                    trivia_schedule_chat(chat.id)
+            log_admin_action("config_toggle", admin_id=user_id, detail={"modulo": key, "valor": not cur}, chat_id=chat.id)
             try:
                 await q.message.edit_reply_markup(reply_markup=build_config_keyboard(chat.id))
             except BadRequest:
@@ -2377,12 +4430,12 @@ async def cfg_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 HUB_MODULES = {
     "afk": {"title": "AFK", "desc": "Activa el modo ausente con un mensaje automático y aviso al volver.", "cmds": ["afk [motivo]"]},
-    "all": {"title": "@all", "desc": "Menciona a todos los miembros del grupo con control anti-spam.", "cmds": ["@all [motivo]"]},
+    "all": {"title": "@all", "desc": "Menciona a todos los miembros del grupo con control anti-spam.", "cmds": ["@all [motivo]", "@all 7d [motivo]", "actividad"]},
     "admin": {"title": "@admin", "desc": "Avisa solo al equipo de administradores.", "cmds": ["@admin [motivo]"]},
     "autoresp": {"title": "Autoresponder", "desc": "Respuestas automáticas personalizadas por usuario.", "cmds": ["autoresponder", "autoresponder_off"]},
     "ttt": {"title": "Tres en raya", "desc": "Juega partidas de TTT con el grupo y consulta clasificaciones.", "cmds": ["ttt", "top_ttt"]},
     "ppt": {"title": "Piedra, papel o tijera", "desc": "Duelo rápido 1v1 con ranking propio.", "cmds": ["ppt", "ppt_top"]},
-    "trivia": {"title": "Trivia", "desc": "Juego de preguntas programado cada hora (desde 00:30).", "cmds": ["trivia_on", "trivia_off", "trivia_stats"]},
+    "trivia": {"title": "Trivia", "desc": "Juego de preguntas automático con horario propio por chat (cada hora por defecto).", "cmds": ["trivia_on", "trivia_off", "trivia_horario", "trivia_maraton", "trivia_categorias", "trivia_stats"]},
     "namechg": {"title": "SangMata", "desc": "Notifica cambios de nombre y @ cuando la persona habla en el grupo.", "cmds": []},
 }
 def build_hub_keyboard() -> InlineKeyboardMarkup:
@@ -2390,9 +4443,9 @@ def build_hub_keyboard() -> InlineKeyboardMarkup:
     rows = []
     for i in range(0, len(codes), 2):
         chunk = codes[i:i + 2]
-        rows.append([InlineKeyboardButton(HUB_MODULES[c]["title"], callback_data=f"hub:m:{c}") for c in chunk])
-    rows.append([InlineKeyboardButton("⚙️ Configuración", callback_data="hub:cfg"), InlineKeyboardButton("📜 Ver comandos", callback_data="hub:help")])
-    rows.append([InlineKeyboardButton("❌ Cerrar", callback_data="hub:x")])
+        rows.append([InlineKeyboardButton(HUB_MODULES[c]["title"], callback_data=cb_encode("hub", "m", c)) for c in chunk])
+    rows.append([InlineKeyboardButton("⚙️ Configuración", callback_data=cb_encode("hub", "cfg")), InlineKeyboardButton("📜 Ver comandos", callback_data=cb_encode("hub", "help"))])
+    rows.append([InlineKeyboardButton("❌ Cerrar", callback_data=cb_encode("hub", "x"))])
     return InlineKeyboardMarkup(rows)
 def hub_module_text(code: str) -> str:
     m = HUB_MODULES.get(code)
@@ -2411,9 +4464,9 @@ def hub_module_text(code: str) -> str:
     return "\n".join(lines)
 def build_hub_module_keyboard(code: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("⬅️ Volver", callback_data="hub:back")],
-        [InlineKeyboardButton("⚙️ Configuración", callback_data="hub:cfg"), InlineKeyboardButton("📜 Ver comandos", callback_data="hub:help")],
-        [InlineKeyboardButton("❌ Cerrar", callback_data="hub:x")],
+        [InlineKeyboardButton("⬅️ Volver", callback_data=cb_encode("hub", "back"))],
+        [InlineKeyboardButton("⚙️ Configuración", callback_data=cb_encode("hub", "cfg")), InlineKeyboardButton("📜 Ver comandos", callback_data=cb_encode("hub", "help"))],
+        [InlineKeyboardButton("❌ Cerrar", callback_data=cb_encode("hub", "x"))],
     ])
 async def _hub_edit_message(q, text: str, reply_markup=None, parse_mode=None, disable_web_page_preview=None):
     try:
@@ -2426,13 +4479,9 @@ async def _hub_edit_message(q, text: str, reply_markup=None, parse_mode=None, di
             return await q.message.reply_text(text, reply_markup=reply_markup, parse_mode=parse_mode, disable_web_page_preview=disable_web_page_preview)
         except Exception:
             pass
-async def hub_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def hub_router(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str = "", code: str = ""):
     q = update.callback_query
-    data = q.data or ""
     await q.answer()
-    if not data.startswith("hub:"):
-        return
-    action = data.split(":", 1)[1]
     if action == "back":
         try:
             await _hub_edit_message(q, "Elige un módulo para ver su ayuda:", reply_markup=build_hub_keyboard())
@@ -2458,18 +4507,24 @@ async def hub_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             pass
         return
-    if action.startswith("m:"):
-        code = action.split(":", 1)[1]
+    if action == "m":
         txt = hub_module_text(code)
         try:
             await _hub_edit_message(q, txt, parse_mode="HTML", disable_web_page_preview=True, reply_markup=build_hub_module_keyboard(code))
         except Exception:
             pass
         return
-def main():
-    _ensure_trivia_files()
-    app = ApplicationBuilder().token(TOKEN).build()
-    ensure_import_once()
+def build_application(token: str, request=None, get_updates_request=None):
+    """Construye la Application con todos los handlers registrados (sin arrancar el polling)."""
+    app = (
+        ApplicationBuilder()
+        .token(token)
+        .request(request or InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(get_updates_request or InstrumentedRequest())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     if app.job_queue is None:
         from telegram.ext import JobQueue
         jq = JobQueue()
@@ -2479,13 +4534,17 @@ def main():
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(CommandHandler("config", config_cmd))
+    app.add_handler(CommandHandler("audit", audit_cmd))
+    app.add_handler(CommandHandler("profile", profile_cmd))
     app.add_handler(CallbackQueryHandler(callback_show_help, pattern=r"^show_help$"))
-    app.add_handler(CallbackQueryHandler(hub_router, pattern=r"^hub:"))
-    app.add_handler(CallbackQueryHandler(cfg_callback, pattern=r"^cfg:"))
+    app.add_handler(CallbackQueryHandler(callback_router, pattern=r"^(~|ttt:|ppt:|allconfirm:|adminconfirm:|triviaimport:|cfg:|hub:)"))
     app.add_handler(CommandHandler("trivia_import", trivia_import_cmd))
-    app.add_handler(CallbackQueryHandler(trivia_import_confirm_cb, pattern=r"^triviaimport:"))
+    app.add_handler(CommandHandler("trivia_restore", trivia_restore_cmd))
     app.add_handler(CommandHandler("trivia_start", trivia_start_cmd))
     app.add_handler(CommandHandler("trivia_stop", trivia_stop_cmd))
+    app.add_handler(CommandHandler("trivia_horario", trivia_horario_cmd))
+    app.add_handler(CommandHandler("trivia_maraton", trivia_maraton_cmd))
+    app.add_handler(CommandHandler("trivia_categorias", trivia_categorias_cmd))
     app.add_handler(PollAnswerHandler(trivia_poll_answer_handler))
     app.add_handler(PollHandler(trivia_poll_handler))
     app.add_handler(CommandHandler("afk", afk_cmd))
@@ -2495,43 +4554,145 @@ def main():
     app.add_handler(CommandHandler("autoresponder", autoresponder_cmd))
     app.add_handler(CommandHandler("autoresponder_off", autoresponder_off_cmd))
     app.add_handler(CommandHandler("all", all_cmd))
-    app.add_handler(CallbackQueryHandler(callback_allconfirm, pattern=r"^allconfirm:"))
     app.add_handler(CommandHandler("cancel", cancel_cmd))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Regex(r"(?i)^\s*@all\b"), mention_detector), group=-4)
     app.add_handler(CommandHandler("admin", admin_cmd))
-    app.add_handler(CallbackQueryHandler(callback_adminconfirm, pattern=r"^adminconfirm:"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Regex(r"(?i)^\s*@admin\b"), admin_mention_detector), group=-3)
     app.add_handler(CommandHandler("ttt", ttt_cmd))
     app.add_handler(CommandHandler("tres", ttt_cmd))
-    app.add_handler(CallbackQueryHandler(ttt_router_cb, pattern=r"^ttt:"))
     app.add_handler(CommandHandler("top_ttt", top_ttt_cmd))
     app.add_handler(CommandHandler("ppt", ppt_cmd))
     app.add_handler(CommandHandler("ppt_top", ppt_top_cmd))
-    app.add_handler(CallbackQueryHandler(ppt_router_cb, pattern=r"^ppt:"))
     app.add_handler(CommandHandler("trivia_top", trivia_top_cmd))
+    app.add_handler(CommandHandler("actividad", actividad_cmd))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, tiktok_detector), group=1)
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_message), group=50)
+    register_callback("hub", hub_router, (1, 2))
+    register_callback("cfg", cfg_callback, (1, 2))
+    register_callback("triviaimport", trivia_import_confirm_cb, (3, 3))
+    register_callback("allconfirm", callback_allconfirm, (2, 2))
+    register_callback("adminconfirm", callback_adminconfirm, (2, 2))
+    register_callback("ttt", ttt_router_cb, (1, 2))
+    register_callback("ppt", ppt_router_cb, (1, 2))
+    register_callback("alljob", alljob_cb)
     register_command("start", "muestra el mensaje de bienvenida del bot")
     register_command("help", "lista los comandos disponibles")
     register_command("config", "abrir panel de configuración del chat", admin=True)
+    register_command("audit", "muestra las últimas acciones de administración del chat", admin=True)
     register_command("afk", "activa el modo afk con un motivo opcional")
     register_command("autoresponder", "activa una respuesta automática para un usuario", admin=True)
     register_command("autoresponder_off", "desactiva el autoresponder de un usuario", admin=True)
     register_command("hora", "muestra la hora actual del país indicado (por defecto españa)")
-    register_command("all", "menciona a todos los miembros del grupo con un motivo opcional", admin=True)
+    register_command("all", "menciona a todos los miembros del grupo con un motivo opcional (/all 7d solo a los activos en 7 días)", admin=True)
     register_command("admin", "menciona solo a los administradores con un motivo opcional")
-    register_command("cancel", "cancela una acción pendiente (confirmaciones @all/@admin)", admin=True)
-    register_command("ttt", "inicia una partida de tres en raya (responde a alguien o usa @usuario opcionalmente)")
+    register_command("cancel", "cancela una acción pendiente (confirmaciones @all/@admin) o detiene un @all en curso", admin=True)
+    register_command("ttt", "inicia una partida de tres en raya (responde a alguien, usa @usuario o 'bot' para jugar contra mí)")
     register_command("tres", "alias de /ttt para iniciar tres en raya")
     register_command("top_ttt", "muestra el ranking de tres en raya (wins/draws/losses)")
     register_command("ppt", "inicia una partida de piedra, papel o tijera (responde a alguien o usa @usuario opcionalmente)")
     register_command("ppt_top", "muestra el ranking de piedra, papel o tijera (wins/losses/draws)")
     register_command("trivia_import", "importa un pool de preguntas desde una URL (merge|replace)", admin=True)
+    register_command("trivia_restore", "lista los backups del pool de trivia o restaura uno", admin=True)
     register_command("trivia_start", "inicia una ronda de trivia en este chat", admin=True)
     register_command("trivia_stop", "detiene la ronda de trivia activa y muestra la respuesta correcta", admin=True)
+    register_command("trivia_categorias", "muestra las categorías del pool o limita la trivia del chat a algunas", admin=True)
+    register_command("trivia_maraton", "maratón de N preguntas seguidas con un único marcador: [preguntas] [segundos]", admin=True)
+    register_command("trivia_horario", "muestra o cambia el horario de la trivia automática: [minutos] [HH-HH] [zona]", admin=True)
     register_command("trivia_top", "muestra el ranking de trivia")
-    print("🐸 RuruBot iniciado.")
+    register_command("actividad", "muestra los miembros más activos de los últimos días (por defecto 7)")
+    instrument_handlers(app)
     app.add_error_handler(error_handler)
+    return app
+def _update_chat_id(update: Update) -> int | None:
+    chat = update.effective_chat
+    return chat.id if chat else None
+async def run_worker(token: str, request=None, get_updates_request=None) -> None:
+    """
+    Worker de un shard: recibe por stdin los updates de sus chats (un JSON por línea) que le envía el
+    proceso frontal y los procesa con la Application normal. Al cerrarse stdin termina lo pendiente y sale.
+    """
+    _ensure_trivia_files()
+    prune_game_snapshots()
+    prune_staged_imports()
+    app = build_application(token, request=request, get_updates_request=get_updates_request)
+    ensure_import_once()
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=16 * 1024 * 1024)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    print(f"🐸 Worker {SHARD_INDEX}/{SHARDS} iniciado.", flush=True)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                update = Update.de_json(json_loads(line), app.bot)
+            except Exception:
+                logging.exception("❌ Update inválido recibido del frontal")
+                continue
+            await app.update_queue.put(update)
+    finally:
+        await app.stop()
+        await on_shutdown(app)
+        await app.shutdown()
+async def _spawn_shard_worker(index: int) -> asyncio.subprocess.Process:
+    env = dict(os.environ, SHARDS=str(SHARDS), SHARD_INDEX=str(index))
+    if METRICS_PORT:
+        env["METRICS_PORT"] = str(METRICS_PORT + 1 + index)
+    return await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), stdin=asyncio.subprocess.PIPE, env=env
+    )
+async def run_front(token: str) -> None:
+    """
+    Proceso frontal del modo multiproceso (SHARDS > 1): hace el long polling y reparte cada update
+    al worker dueño de su chat (chat_id % SHARDS) por su stdin. Los updates sin chat (respuestas a
+    encuestas) se envían a todos; solo el shard que conoce la encuesta los usa.
+    """
+    workers = [await _spawn_shard_worker(i) for i in range(SHARDS)]
+    bot = Bot(token, request=InstrumentedRequest(), get_updates_request=InstrumentedRequest(read_timeout=40))
+    print(f"🐸 RuruBot iniciado con {SHARDS} shards.")
+    offset = None
+    try:
+        async with bot:
+            while True:
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+                except Exception:
+                    logging.exception("❌ Error en getUpdates")
+                    await asyncio.sleep(3)
+                    continue
+                for i, w in enumerate(workers):
+                    if w.returncode is not None:
+                        logging.error("❌ Worker %s terminó (código %s); relanzando", i, w.returncode)
+                        workers[i] = await _spawn_shard_worker(i)
+                for update in updates:
+                    offset = update.update_id + 1
+                    line = json_dumps(update.to_dict()) + b"\n"
+                    chat_id = _update_chat_id(update)
+                    for w in workers if chat_id is None else (workers[shard_of(chat_id)],):
+                        w.stdin.write(line)
+                await asyncio.gather(*(w.stdin.drain() for w in workers), return_exceptions=True)
+    finally:
+        for w in workers:
+            if w.stdin and not w.stdin.is_closing():
+                w.stdin.close()
+        await asyncio.gather(*(w.wait() for w in workers), return_exceptions=True)
+def main():
+    if SHARD_INDEX >= 0:
+        asyncio.run(run_worker(TOKEN))
+        return
+    if SHARDS > 1:
+        asyncio.run(run_front(TOKEN))
+        return
+    _ensure_trivia_files()
+    prune_game_snapshots()
+    prune_staged_imports()
+    app = build_application(TOKEN)
+    ensure_import_once()
+    print("🐸 RuruBot iniciado.")
     app.run_polling()
 if __name__ == "__main__":
     main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("PERSIST_DIR", tempfile.mkdtemp(prefix="rurubot_test_"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest
+
+import bot
+
+
+def _fail(*args, **kwargs):
+    raise OSError("disco lleno")
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches():
+    bot.writer_flush()
+    bot.SETTINGS_CACHE = {"-1": {"all_enabled": True}}
+    bot.ROSTER_CACHE = {"-1": {"10": {"name": "Ana"}}}
+    bot.ROSTER_VERSIONS.clear()
+    yield
+    bot.writer_flush()
+
+
+def test_set_chat_setting_keeps_old_snapshot_when_persist_fails(monkeypatch):
+    before = bot.load_settings()
+    chat_before = before["-1"]
+    monkeypatch.setattr(bot, "persist_json", _fail)
+    bot.set_chat_setting(-1, "all_enabled", False)
+    assert bot.load_settings() is before
+    assert bot.get_chat_settings(-1) is chat_before
+    assert chat_before == {"all_enabled": True}
+
+
+def test_save_chat_roster_keeps_old_snapshot_when_persist_fails(monkeypatch):
+    before = bot.load_roster()
+    chat_before = before["-1"]
+    monkeypatch.setattr(bot, "persist_json", _fail)
+    bot.save_chat_roster(-1, {**chat_before, "11": {"name": "Bea"}})
+    assert bot.load_roster() is before
+    assert before["-1"] is chat_before and set(chat_before) == {"10"}
+    assert bot.roster_version(-1) == 0
+
+
+def test_successful_save_publishes_new_snapshot_without_touching_old():
+    before = bot.load_settings()
+    bot.set_chat_setting(-1, "all_enabled", False)
+    after = bot.load_settings()
+    assert after is not before
+    assert after["-1"]["all_enabled"] is False
+    assert before["-1"]["all_enabled"] is True
+
+
+def test_writer_failure_is_reported(monkeypatch):
+    path = os.path.join(bot.PERSIST_DIR, "no_dir_here", "x.json")
+
+    def broken_write(*args, **kwargs):
+        raise OSError("disco lleno")
+
+    monkeypatch.setattr(bot, "_write_file_atomic", broken_write)
+    bot.persist_json(path, {"a": 1})
+    assert bot.writer_flush(path)
+    assert "disco lleno" in bot.WRITER_ERRORS[path]